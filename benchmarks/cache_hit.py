@@ -0,0 +1,92 @@
+"""
+Сравнение CPU на одно попадание в кеш записей метрики:
+ - pickled: из кеша читается список словарей и заново рендерится в JSON
+ - rendered: из кеша читается готовое gzip-тело, которое отдаётся как есть
+
+Запуск (нужен Redis из настроек проекта):
+    python benchmarks/cache_hit.py --records 1000 --hits 500
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tatneft_metrics.settings")
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from metrics.responses import render_json  # noqa: E402
+
+PICKLED_KEY = "benchmark:cache-hit:pickled"
+RENDERED_KEY = "benchmark:cache-hit:rendered"
+
+
+def make_page(records: int) -> dict:
+    return {
+        "next": "http://127.0.0.1:8000/api/metrics/1/records/?cursor=MTcwMDAwMDAwMDox",
+        "results": [
+            {
+                "id": i,
+                "metric": 1,
+                "metric_name": "Добыча нефти",
+                "value": f"{1000 + i / 7:.4f}",
+                "timestamp": 1700000000 + i,
+                "tags": [1, 2, 3],
+            }
+            for i in range(records)
+        ],
+    }
+
+
+def pickled_hit() -> int:
+    data = cache.get(PICKLED_KEY)
+    return len(HttpResponse(JSONRenderer().render(data)).content)
+
+
+def rendered_hit() -> int:
+    rendered = cache.get(RENDERED_KEY)
+    response = HttpResponse(rendered.body)
+    response["Content-Encoding"] = "gzip"
+    response["ETag"] = rendered.etag
+    return len(response.content)
+
+
+def measure(hit, hits: int) -> tuple[float, int]:
+    hit()
+    started = time.process_time()
+    for _ in range(hits):
+        size = hit()
+    return (time.process_time() - started) / hits * 1000, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--hits", type=int, default=500)
+    args = parser.parse_args()
+
+    page = make_page(args.records)
+    cache.set(PICKLED_KEY, page, timeout=600)
+    cache.set(RENDERED_KEY, render_json(page), timeout=600)
+    try:
+        pickled_ms, pickled_size = measure(pickled_hit, args.hits)
+        rendered_ms, rendered_size = measure(rendered_hit, args.hits)
+    finally:
+        cache.delete_many([PICKLED_KEY, RENDERED_KEY])
+
+    print(f"Записей на странице: {args.records}, попаданий: {args.hits}")
+    print(f"pickled:  {pickled_ms:.3f} мс CPU на попадание, тело {pickled_size} байт")
+    print(f"rendered: {rendered_ms:.3f} мс CPU на попадание, тело {rendered_size} байт")
+    print(f"Экономия CPU: x{pickled_ms / max(rendered_ms, 1e-9):.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Набор нагрузочных замеров API и фоновых задач с отчётом в JSON.
+
+Сценарии:
+ - ingest_single: POST одной записи
+ - ingest_batch: POST пачки из --batch записей
+ - list_uncached: страница записей сразу после сброса кеша метрики
+ - list_cached: та же страница из кеша
+ - rename: переименование метрики с обновлением metric_name её записей
+   (сигнал ставит задачу после коммита, Celery выполняет её сразу - eager)
+ - report: generate_report (отчёт пишется во временный каталог, а не в reports/)
+
+Для каждого сценария считаются p50/p95/p99 и среднее время в мс и пропускная
+способность (операций или записей в секунду). Данные создаёт seed_metrics
+со своим префиксом на каждый запуск (bench-<id>) и фиксирует их. Сценарии
+выполняются в autocommit, как в работающем сервисе, поэтому в замер входят
+коммиты. В конце данные запуска удаляются (--keep - оставить).
+С --baseline печатается изменение относительно прошлого отчёта.
+
+Запуск (нужны БД и Redis из настроек проекта):
+    python benchmarks/suite.py --records 1000000 --output before.json
+    python benchmarks/suite.py --scenarios list_cached --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tatneft_metrics.settings")
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework.test import APIClient  # noqa: E402
+
+from metrics import tasks as metrics_tasks  # noqa: E402
+from metrics.cache import invalidate_metric_cache  # noqa: E402
+from metrics.models import Metric, Tag  # noqa: E402
+from metrics.retention import purge_deleted_metric  # noqa: E402
+from metrics.tasks import generate_report  # noqa: E402
+from tatneft_metrics.celery import app as celery_app  # noqa: E402
+
+PREFIX = "bench"
+START_TS = 1700000000
+STEP = 60
+
+
+def summarize(timings: list[float], items: int) -> dict:
+    """Перцентили времени одной операции и пропускная способность."""
+    ms = sorted(timing * 1000 for timing in timings)
+    quantiles = statistics.quantiles(ms, n=100, method="inclusive")
+    return {
+        "runs": len(ms),
+        "p50_ms": round(quantiles[49], 3),
+        "p95_ms": round(quantiles[94], 3),
+        "p99_ms": round(quantiles[98], 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "throughput_per_s": round(items / sum(timings), 1),
+    }
+
+
+def measure(operation, runs: int, warmup: int, prepare=None, items: int = 1) -> dict:
+    """
+    Время operation() за runs запусков после warmup прогревочных.
+    prepare() выполняется перед каждым запуском и не входит в замер.
+    """
+    timings = []
+    for run in range(warmup + runs):
+        if prepare is not None:
+            prepare()
+        started = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - started
+        if run >= warmup:
+            timings.append(elapsed)
+    return summarize(timings, items * runs)
+
+
+class Suite:
+    def __init__(self, client: APIClient, metric: Metric, args):
+        self.client = client
+        self.metric = metric
+        self.args = args
+        # Новые записи идут после сгенерированных
+        self.next_ts = START_TS + args.records * STEP
+        self.records_url = reverse(
+            "metric-record-list-create", kwargs={"metric_id": metric.id}
+        )
+        self.batch_url = reverse(
+            "metric-record-batch-create", kwargs={"metric_id": metric.id}
+        )
+
+    def request(self, method: str, url: str, data=None, expected=(200, 201, 202)):
+        response = getattr(self.client, method)(url, data, format="json")
+        if response.status_code not in expected:
+            raise RuntimeError(f"{method.upper()} {url}: {response.status_code}")
+        return response
+
+    def take_timestamps(self, count: int) -> list[int]:
+        timestamps = [self.next_ts + i * STEP for i in range(count)]
+        self.next_ts += count * STEP
+        return timestamps
+
+    def ingest_single(self) -> dict:
+        def operation():
+            [timestamp] = self.take_timestamps(1)
+            self.request(
+                "post", self.records_url, {"timestamp": timestamp, "value": "1.5"}
+            )
+
+        return measure(operation, self.args.runs, self.args.warmup)
+
+    def ingest_batch(self) -> dict:
+        def operation():
+            records = [
+                {
+                    "timestamp": timestamp,
+                    "value": "1.5",
+                    "tags": [f"{self.args.prefix}-tag-0"],
+                }
+                for timestamp in self.take_timestamps(self.args.batch)
+            ]
+            self.request("post", self.batch_url, records)
+
+        return measure(
+            operation, self.args.runs, self.args.warmup, items=self.args.batch
+        )
+
+    def list_page(self) -> None:
+        self.request("get", self.records_url, {"limit": self.args.page_size})
+
+    def list_uncached(self) -> dict:
+        return measure(
+            self.list_page,
+            self.args.runs,
+            self.args.warmup,
+            prepare=lambda: invalidate_metric_cache(self.metric.id),
+        )
+
+    def list_cached(self) -> dict:
+        return measure(self.list_page, self.args.runs, self.args.warmup)
+
+    def rename(self) -> dict:
+        names = iter(range(self.args.runs + self.args.warmup))
+
+        def operation():
+            self.metric.name = f"{self.args.prefix}-renamed-{next(names)}"
+            self.metric.save()
+
+        # Задача update_metric_records_name ставится из on_commit сигнала и
+        # в режиме eager выполняется в этом же процессе, входя в замер
+        eager = {
+            name: celery_app.conf[name]
+            for name in ("task_always_eager", "task_eager_propagates")
+        }
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+        try:
+            return measure(operation, self.args.runs, self.args.warmup)
+        finally:
+            celery_app.conf.update(eager)
+
+    def report(self) -> dict:
+        # Рабочий reports/metrics_report.txt не перезаписывается
+        saved = metrics_tasks.REPORT_DIR, metrics_tasks.REPORT_FILE
+        with tempfile.TemporaryDirectory(prefix=f"{self.args.prefix}-") as directory:
+            metrics_tasks.REPORT_DIR = Path(directory)
+            metrics_tasks.REPORT_FILE = metrics_tasks.REPORT_DIR / saved[1].name
+            try:
+                return measure(generate_report, self.args.runs, self.args.warmup)
+            finally:
+                metrics_tasks.REPORT_DIR, metrics_tasks.REPORT_FILE = saved
+
+
+SCENARIOS = (
+    "ingest_single",
+    "ingest_batch",
+    "list_uncached",
+    "list_cached",
+    "rename",
+    "report",
+)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cleanup(prefix: str) -> None:
+    """Удаляет данные запуска: метрики с записями пачками, теги и пользователей."""
+    users = get_user_model().objects.filter(username__startswith=f"{prefix}-")
+    metrics = Metric.objects.filter(author__in=users)
+    metrics.update(deleted_at=timezone.now())
+    for metric_id in metrics.values_list("id", flat=True):
+        purge_deleted_metric(metric_id, pause=0)
+    Tag.objects.filter(name__startswith=f"{prefix}-").delete()
+    users.delete()
+
+
+def print_comparison(results: dict, baseline_path: str) -> None:
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        changes = ", ".join(
+            f"{key} {(result[key] / previous[key] - 1) * 100:+.1f}%"
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_per_s")
+            if previous[key]
+        )
+        print(f"{name}: {changes}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=list(SCENARIOS),
+        help=f"Сценарии через запятую: {','.join(SCENARIOS)}",
+    )
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--metrics", type=int, default=10)
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument(
+        "--page-size", type=int, default=settings.METRIC_RECORDS_PAGE_SIZE
+    )
+    parser.add_argument("--output", "-o", help="Файл отчёта (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="Отчёт прошлого запуска для сравнения")
+    parser.add_argument(
+        "--prefix",
+        default=f"{PREFIX}-{uuid.uuid4().hex[:8]}",
+        help="Префикс данных запуска (по умолчанию новый на каждый запуск)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Не удалять сгенерированные данные"
+    )
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": int(time.time()),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "args": {key: value for key, value in vars(args).items()},
+            "settings": {
+                name: getattr(settings, name)
+                for name in (
+                    "METRIC_RECORDS_ASYNC_INGEST",
+                    "METRIC_ROLLUPS_ENABLED",
+                    "METRIC_LOCAL_CACHE_ENABLED",
+                    "METRIC_RECORDS_PARTITIONING",
+                    "METRIC_ARCHIVE_AFTER_DAYS",
+                )
+            },
+        },
+        "results": {},
+    }
+
+    try:
+        started = time.perf_counter()
+        call_command(
+            "seed_metrics",
+            prefix=args.prefix,
+            users=1,
+            metrics=args.metrics,
+            tags=args.tags,
+            records=args.records,
+            start=START_TS,
+            step=STEP,
+            stdout=sys.stderr,
+        )
+        report["meta"]["seed_seconds"] = round(time.perf_counter() - started, 1)
+
+        metric = (
+            Metric.objects.active()
+            .filter(
+                name=f"{args.prefix}-metric-0",
+                author__username=f"{args.prefix}-user-0",
+            )
+            .get()
+        )
+        client = APIClient(SERVER_NAME=settings.ALLOWED_HOSTS[0])
+        client.force_authenticate(user=metric.author)
+        suite = Suite(client, metric, args)
+        for name in args.scenarios:
+            print(f"Сценарий {name}...", file=sys.stderr)
+            report["results"][name] = getattr(suite, name)()
+    finally:
+        if not args.keep:
+            print(f"Удаляю данные {args.prefix}-*...", file=sys.stderr)
+            cleanup(args.prefix)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+    if args.baseline:
+        print_comparison(report["results"], args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Время фильтрации записей по тегу в зависимости от числа записей метрики.
+
+Редкий тег стоит на фиксированном числе записей, частый - на каждой десятой.
+С индексом (tag, record) время запросов по редкому тегу почти не растёт
+вместе с таблицей. Данные создаются в транзакции и откатываются.
+
+Запуск (нужна БД из настроек проекта):
+    python benchmarks/tag_filter.py --sizes 10000,100000,1000000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tatneft_metrics.settings")
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+
+from metrics.filters import (  # noqa: E402
+    filter_all_tags,
+    filter_metrics_by_tags,
+    filter_time_range,
+)
+from metrics.models import Metric, MetricRecord, Tag, TagsMetricRecord  # noqa: E402
+
+START_TS = 1700000000
+RARE_TAGGED = 50
+
+
+def seed(metric: Metric, common: Tag, start: int, stop: int) -> None:
+    """Добавляет записи с номерами [start, stop) и связи с частым тегом."""
+    records = MetricRecord._meta.db_table
+    through = TagsMetricRecord._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {records} (metric_id, metric_name, timestamp, value)
+            SELECT %s, %s, %s + n, n %% 1000
+            FROM generate_series(%s, %s - 1) AS n
+            """,
+            [metric.id, metric.name, START_TS, start, stop],
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO {through} (record_id, tag_id)
+            SELECT id, %s FROM {records}
+            WHERE metric_id = %s AND timestamp >= %s AND timestamp %% 10 = 0
+            """,
+            [common.id, metric.id, START_TS + start],
+        )
+
+
+def tag_rare_records(metric: Metric, rare: Tag, size: int) -> None:
+    """Переносит редкий тег на RARE_TAGGED записей, равномерно по диапазону."""
+    TagsMetricRecord.objects.filter(tag=rare).delete()
+    step = max(size // RARE_TAGGED, 1)
+    record_ids = MetricRecord.objects.filter(
+        metric=metric,
+        timestamp__in=[START_TS + n for n in range(0, size, step)],
+    ).values_list("id", flat=True)
+    TagsMetricRecord.objects.bulk_create(
+        TagsMetricRecord(record_id=record_id, tag=rare) for record_id in record_ids
+    )
+
+
+def measure(queryset, repeat: int) -> float:
+    """Медиана времени выполнения запроса, мс."""
+    list(queryset.all())
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        # .all() - новый QuerySet без кеша результатов, запрос идёт в БД
+        list(queryset.all())
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: sorted(int(size) for size in value.split(",")),
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'записей':>10} {'тег в диапазоне, мс':>20} {'метрики с тегом, мс':>20}")
+    with transaction.atomic():
+        user = get_user_model().objects.create_user(username="tag-filter-benchmark")
+        metric = Metric.objects.create(name="benchmark", author=user)
+        rare = Tag.objects.create(name="benchmark-rare")
+        common = Tag.objects.create(name="benchmark-common")
+
+        seeded = 0
+        for size in args.sizes:
+            seed(metric, common, seeded, size)
+            seeded = size
+            tag_rare_records(metric, rare, size)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+            records = filter_time_range(
+                MetricRecord.objects.filter(metric=metric),
+                START_TS + size // 4,
+                START_TS + size // 4 * 3,
+            )
+            in_range = filter_all_tags(records, [rare.id]).values_list("id")
+            metrics = filter_metrics_by_tags(Metric.objects.all(), [rare.id])
+
+            print(
+                f"{size:>10} {measure(in_range, args.repeat):>20.2f} "
+                f"{measure(metrics, args.repeat):>20.2f}"
+            )
+        transaction.set_rollback(True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,24 @@
+import json
+from datetime import datetime, timezone
 from pathlib import Path
 
 from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
 from django.http import FileResponse, HttpRequest, HttpResponse
 from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.views.decorators.http import require_POST
 from django.urls import path, reverse
 
 from metrics.models import Metric, MetricRecord, Tag, TagsMetricRecord
+from metrics.slow_queries import (
+    clear_slow_queries,
+    slow_queries,
+    slow_query_log_enabled,
+)
+from metrics.tasks import delete_metrics
 
 REPORT_FILE = Path(settings.BASE_DIR) / "reports" / "metrics_report.txt"
 
@@ -40,11 +51,14 @@ class MetricAdmin(admin.ModelAdmin):
         "id",
         "name",
         "author",
+        "retention_days",
         "created_at",
+        "deleted_at",
     )
     list_filter = (
         "author",
         "created_at",
+        ("deleted_at", admin.EmptyFieldListFilter),
     )
     search_fields = (
         "name",
@@ -56,23 +70,45 @@ class MetricAdmin(admin.ModelAdmin):
 
     inlines = [MetricRecordInline]
 
-    readonly_fields = ("created_at",)
+    readonly_fields = ("created_at", "deleted_at")
 
     fieldsets = (
         (
             None,
             {
-                "fields": ("name", "description", "author"),
+                "fields": ("name", "description", "author", "retention_days"),
             },
         ),
         (
             "Metadata",
             {
-                "fields": ("created_at",),
+                "fields": ("created_at", "deleted_at"),
             },
         ),
     )
 
+    def get_deleted_objects(self, objs, request):
+        """
+        Страница подтверждения без обхода записей: их удаляет фоновая задача,
+        а сбор всех связанных объектов для большой метрики занимает минуты.
+        """
+        objs = list(objs)
+        perms_needed = set()
+        if not self.has_delete_permission(request):
+            perms_needed.add(self.opts.verbose_name)
+        return (
+            [str(obj) for obj in objs],
+            {self.opts.verbose_name_plural: len(objs)},
+            perms_needed,
+            [],
+        )
+
+    def delete_model(self, request, obj):
+        delete_metrics(Metric.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        delete_metrics(queryset)
+
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
@@ -102,6 +138,7 @@ class MetricAdmin(admin.ModelAdmin):
 
 @admin.register(MetricRecord)
 class MetricRecordAdmin(admin.ModelAdmin):
+    change_list_template = "admin/metrics/metricrecord/change_list.html"
     list_display = (
         "id",
         "metric_name",
@@ -133,6 +170,71 @@ class MetricRecordAdmin(admin.ModelAdmin):
 
     autocomplete_fields = ("metric",)
 
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path(
+                "slow-queries/",
+                self.admin_site.admin_view(self.slow_queries_view),
+                name="metrics_metricrecord_slow_queries",
+            ),
+            path(
+                "slow-queries/export/",
+                self.admin_site.admin_view(self.export_slow_queries_view),
+                name="metrics_metricrecord_slow_queries_export",
+            ),
+            path(
+                "slow-queries/clear/",
+                self.admin_site.admin_view(require_POST(self.clear_slow_queries_view)),
+                name="metrics_metricrecord_slow_queries_clear",
+            ),
+        ]
+        return custom_urls + urls
+
+    @staticmethod
+    def check_slow_queries_access(request: HttpRequest) -> None:
+        """
+        Журнал медленных запросов - только суперпользователям: в нём SQL и
+        параметры любых таблиц, в том числе сессий, пользователей и токенов.
+        """
+        if not request.user.is_superuser:
+            raise PermissionDenied
+
+    def slow_queries_view(self, request: HttpRequest) -> HttpResponse:
+        """Журнал медленных запросов, ?o=duration - сначала самые долгие."""
+        self.check_slow_queries_access(request)
+        entries = slow_queries()
+        if request.GET.get("o") == "duration":
+            entries.sort(key=lambda entry: entry["duration_ms"], reverse=True)
+        for entry in entries:
+            entry["captured_at"] = datetime.fromtimestamp(
+                entry["captured_at"], tz=timezone.utc
+            )
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.opts,
+            "title": "Медленные запросы",
+            "entries": entries,
+            "enabled": slow_query_log_enabled(),
+            "threshold_ms": settings.METRIC_SLOW_QUERY_THRESHOLD_MS,
+        }
+        return TemplateResponse(request, "admin/metrics/slow_queries.html", context)
+
+    def export_slow_queries_view(self, request: HttpRequest) -> HttpResponse:
+        self.check_slow_queries_access(request)
+        content = "".join(
+            json.dumps(entry, ensure_ascii=False) + "\n" for entry in slow_queries()
+        )
+        response = HttpResponse(content, content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="slow_queries.ndjson"'
+        return response
+
+    def clear_slow_queries_view(self, request: HttpRequest) -> HttpResponse:
+        self.check_slow_queries_access(request)
+        clear_slow_queries()
+        self.message_user(request, "Журнал медленных запросов очищен.")
+        return redirect(reverse("admin:metrics_metricrecord_slow_queries"))
+
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
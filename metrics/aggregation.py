@@ -0,0 +1,172 @@
+from typing import Callable, Iterable
+
+from django.db.models import Avg, Count, F, Max, Min, Q, QuerySet, Sum
+
+from metrics.models import MetricRollup
+
+AGGREGATE_FUNCTIONS = {
+    "avg": Avg,
+    "min": Min,
+    "max": Max,
+    "count": Count,
+    "sum": Sum,
+}
+# Из агрегатов можно собрать любую функцию
+ROLLUP_FUNCTIONS = ("count", "sum", "min", "max")
+
+
+def aggregate_metric_records(
+    queryset: QuerySet,
+    bucket: int,
+    functions: list[str],
+    archived: Iterable[dict] | None = None,
+) -> list[dict]:
+    """
+    Группирует записи по корзинам в bucket секунд и считает функции на стороне БД.
+    Корзина - timestamp начала интервала, выровненный по Unix-эпохе.
+    archived - строки из архивных чанков (iter_archived_rows) с теми же
+    фильтрами, они добавляются к корзинам БД.
+    """
+    if archived is not None:
+        buckets = _aggregate_rows(archived, bucket)
+        if buckets:
+            for row in aggregate_metric_records(queryset, bucket, ROLLUP_FUNCTIONS):
+                _merge_bucket(buckets, row.pop("bucket"), row)
+            return [
+                {"bucket": key, **_bucket_functions(buckets[key], functions)}
+                for key in sorted(buckets)
+            ]
+    return list(
+        queryset.order_by()
+        .annotate(bucket=F("timestamp") - F("timestamp") % bucket)
+        .values("bucket")
+        .annotate(**{fn: AGGREGATE_FUNCTIONS[fn]("value") for fn in functions})
+        .order_by("bucket")
+    )
+
+
+def rollup_resolution(bucket: int) -> int | None:
+    """Самое крупное разрешение агрегатов, из которого собирается корзина."""
+    for resolution in sorted(MetricRollup.Resolution.values, reverse=True):
+        if bucket % resolution == 0:
+            return resolution
+    return None
+
+
+def aggregate_metric_rollups(
+    records: QuerySet,
+    rollups: QuerySet,
+    bucket: int,
+    functions: list[str],
+    from_ts: int | None = None,
+    to_ts: int | None = None,
+    archived: Callable[..., Iterable[dict]] | None = None,
+) -> list[dict]:
+    """
+    Считает корзины по MetricRollup, а сырые записи читает только для
+    неполных интервалов на краях диапазона [from_ts, to_ts].
+    records должны быть уже отфильтрованы по этому диапазону.
+    archived(from_ts=..., to_ts=...) - строки архивных чанков в диапазоне,
+    архив тоже читается только на краях.
+    """
+    resolution = rollup_resolution(bucket)
+    if resolution is None:
+        return aggregate_metric_records(
+            records,
+            bucket,
+            functions,
+            archived and archived(from_ts=from_ts, to_ts=to_ts),
+        )
+
+    # Полные интервалы агрегатов: [start, end)
+    start = None if from_ts is None else -(-from_ts // resolution) * resolution
+    end = None if to_ts is None else (to_ts + 1) // resolution * resolution
+
+    rollups = rollups.filter(resolution=resolution)
+    edges = Q(pk__in=[])
+    if start is not None:
+        rollups = rollups.filter(bucket__gte=start)
+        edges |= Q(timestamp__lt=start)
+    if end is not None:
+        rollups = rollups.filter(bucket__lt=end)
+        edges |= Q(timestamp__gte=end)
+
+    # Имена аннотаций не должны совпадать с полями MetricRollup
+    inner = (
+        rollups.order_by()
+        .annotate(out=F("bucket") - F("bucket") % bucket)
+        .values("out")
+        .annotate(
+            total_count=Sum("count"),
+            total_sum=Sum("sum"),
+            total_min=Min("min"),
+            total_max=Max("max"),
+        )
+    )
+    buckets = {
+        row["out"]: {
+            "count": row["total_count"],
+            "sum": row["total_sum"],
+            "min": row["total_min"],
+            "max": row["total_max"],
+        }
+        for row in inner
+    }
+    for row in aggregate_metric_records(
+        records.filter(edges), bucket, ROLLUP_FUNCTIONS
+    ):
+        _merge_bucket(buckets, row.pop("bucket"), row)
+    # Архивные записи полных интервалов уже учтены в агрегатах
+    if start is not None and end is not None and start > end:
+        # Диапазон внутри одного интервала: края перекрываются
+        edge_ranges = [(from_ts, to_ts)]
+    else:
+        edge_ranges = []
+        if start is not None and from_ts < start:
+            edge_ranges.append((from_ts, start - 1))
+        if end is not None and to_ts >= end:
+            edge_ranges.append((end, to_ts))
+    for low, high in edge_ranges if archived else ():
+        for key, row in _aggregate_rows(
+            archived(from_ts=low, to_ts=high), bucket
+        ).items():
+            _merge_bucket(buckets, key, row)
+
+    return [
+        {"bucket": key, **_bucket_functions(buckets[key], functions)}
+        for key in sorted(buckets)
+    ]
+
+
+def _aggregate_rows(rows: Iterable[dict], bucket: int) -> dict[int, dict]:
+    """count/sum/min/max строк по корзинам, для строк вне БД."""
+    buckets = {}
+    for row in rows:
+        timestamp, value = row["timestamp"], row["value"]
+        _merge_bucket(
+            buckets,
+            timestamp - timestamp % bucket,
+            {"count": 1, "sum": value, "min": value, "max": value},
+        )
+    return buckets
+
+
+def _merge_bucket(buckets: dict, key: int, row: dict) -> None:
+    current = buckets.get(key)
+    if current is None:
+        buckets[key] = row
+        return
+    current["count"] += row["count"]
+    current["sum"] += row["sum"]
+    current["min"] = min(current["min"], row["min"])
+    current["max"] = max(current["max"], row["max"])
+
+
+def _bucket_functions(row: dict, functions: list[str]) -> dict:
+    result = {}
+    for fn in functions:
+        if fn == "avg":
+            result[fn] = row["sum"] / row["count"]
+        else:
+            result[fn] = row[fn]
+    return result
@@ -6,4 +6,4 @@ class MetricsConfig(AppConfig):
     name = "metrics"
 
     def ready(self):
-        from . import signals
+        from . import signals, slow_queries, task_telemetry
@@ -0,0 +1,385 @@
+"""
+Архив записей метрик.
+
+Записи закрытых окон времени (METRIC_ARCHIVE_WINDOW секунд, выровненных по
+Unix-эпохе) старше METRIC_ARCHIVE_AFTER_DAYS суток упаковываются в один
+сжатый чанк MetricRecordChunk на окно и удаляются из MetricRecord:
+ - id - разности соседних значений;
+ - timestamp - первое значение, первая разность, дальше разности разностей
+   (delta-of-delta), у равномерного ряда это нули;
+ - value - целое в единицах последнего знака DecimalField (точно, без
+   потери точности) и разности соседних значений;
+ - теги - id тегов каждой записи в порядке добавления.
+Числа пишутся как zigzag-varint, поток сжимается zlib.
+
+Одна запись хранится либо в таблице, либо в чанке. Запись в архивное окно
+сначала распаковывает его чанк обратно в таблицу (restore_archived_records),
+поэтому уникальность (metric, timestamp) и агрегаты остаются точными.
+Чтение списков, выгрузки и агрегатов объединяет обе части
+(iter_archived_rows, merge_rows).
+
+При METRIC_ARCHIVE_AFTER_DAYS = 0 API не читает чанки и не распаковывает
+их при записи, поэтому перед выключением архива записи возвращаются в
+таблицу командой restore_metric_archive.
+"""
+
+import heapq
+import logging
+import zlib
+from bisect import bisect_left
+from decimal import Decimal
+from itertools import accumulate
+from typing import Iterable, Iterator, NamedTuple
+
+from django.conf import settings
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, QuerySet
+
+from metrics.models import MetricRecord, MetricRecordChunk, TagsMetricRecord
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+ZLIB_LEVEL = 9
+VALUE_PLACES = MetricRecord._meta.get_field("value").decimal_places
+# Пространство advisory-блокировок архива: (ARCHIVE_LOCK, id метрики)
+ARCHIVE_LOCK = 0x6D6574
+RESTORE_BATCH_SIZE = 1000
+CHUNK_ITERATOR_SIZE = 10
+
+
+def archive_enabled() -> bool:
+    return settings.METRIC_ARCHIVE_AFTER_DAYS > 0
+
+
+class ArchivedRecord(NamedTuple):
+    id: int
+    timestamp: int
+    value: Decimal
+    tag_ids: tuple[int, ...]
+
+
+def _write_varint(out: bytearray, number: int) -> None:
+    number = number * 2 if number >= 0 else -number * 2 - 1
+    while number >= 0x80:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varints(data: bytes) -> Iterator[int]:
+    number = shift = 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        yield number >> 1 if not number & 1 else -(number >> 1) - 1
+        number = shift = 0
+
+
+def encode_records(records: list[ArchivedRecord]) -> bytes:
+    """Упаковывает записи, отсортированные по timestamp, в сжатый чанк."""
+    out = bytearray()
+    _write_varint(out, len(records))
+
+    previous = 0
+    for record in records:
+        _write_varint(out, record.id - previous)
+        previous = record.id
+
+    previous = previous_delta = 0
+    for index, record in enumerate(records):
+        delta = record.timestamp - previous
+        _write_varint(out, delta - previous_delta)
+        previous, previous_delta = record.timestamp, delta if index else 0
+
+    previous = 0
+    for record in records:
+        scaled = int(record.value.scaleb(VALUE_PLACES))
+        _write_varint(out, scaled - previous)
+        previous = scaled
+
+    for record in records:
+        _write_varint(out, len(record.tag_ids))
+        for tag_id in record.tag_ids:
+            _write_varint(out, tag_id)
+
+    return bytes([FORMAT_VERSION]) + zlib.compress(out, ZLIB_LEVEL)
+
+
+def decode_records(data: bytes) -> list[ArchivedRecord]:
+    """Распаковывает чанк в записи по возрастанию timestamp."""
+    data = bytes(data)
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Неизвестная версия формата чанка: {data[0]}.")
+    numbers = _read_varints(zlib.decompress(data[1:]))
+    count = next(numbers)
+
+    ids = list(accumulate(next(numbers) for _ in range(count)))
+
+    timestamps = []
+    previous = previous_delta = 0
+    for index in range(count):
+        delta = next(numbers) + previous_delta
+        previous += delta
+        timestamps.append(previous)
+        previous_delta = delta if index else 0
+
+    values = [
+        Decimal(scaled).scaleb(-VALUE_PLACES)
+        for scaled in accumulate(next(numbers) for _ in range(count))
+    ]
+    tag_ids = [tuple(next(numbers) for _ in range(next(numbers))) for _ in range(count)]
+    return [ArchivedRecord(*fields) for fields in zip(ids, timestamps, values, tag_ids)]
+
+
+def _lock_metric(metric_id: int, shared: bool) -> None:
+    """
+    Блокировка метрики до конца транзакции: запись берёт разделяемую,
+    архивация окна - исключительную, чтобы запись не попала в окно,
+    которое сейчас упаковывается.
+    """
+    function = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {function}(%s, %s::integer)", [ARCHIVE_LOCK, metric_id])
+
+
+def _window_records(metric_id: int, start: int, end: int) -> list[ArchivedRecord]:
+    tag_ids = ArraySubquery(
+        TagsMetricRecord.objects.filter(record=OuterRef("pk"))
+        .order_by("id")
+        .values("tag_id")
+    )
+    rows = (
+        MetricRecord.objects.filter(
+            metric_id=metric_id, timestamp__gte=start, timestamp__lt=end
+        )
+        .annotate(tag_ids=tag_ids)
+        .order_by("timestamp")
+        .values_list("id", "timestamp", "value", "tag_ids")
+    )
+    return [
+        ArchivedRecord(record_id, timestamp, value, tuple(tags))
+        for record_id, timestamp, value, tags in rows
+    ]
+
+
+def _save_chunk(
+    metric_id: int, start: int, end: int, records: list[ArchivedRecord]
+) -> MetricRecordChunk:
+    return MetricRecordChunk.objects.create(
+        metric_id=metric_id,
+        start=start,
+        end=end,
+        count=len(records),
+        tags=sorted({tag_id for record in records for tag_id in record.tag_ids}),
+        data=encode_records(records),
+    )
+
+
+def _archive_window(metric_id: int, start: int, end: int) -> int:
+    """
+    Переносит записи окна [start, end) в чанк. Чанки, пересекающиеся с
+    окном (например, после смены METRIC_ARCHIVE_WINDOW), объединяются с ним.
+    """
+    with transaction.atomic():
+        _lock_metric(metric_id, shared=False)
+        records = _window_records(metric_id, start, end)
+        if not records:
+            return 0
+
+        overlapping = list(
+            MetricRecordChunk.objects.select_for_update().filter(
+                metric_id=metric_id, start__lt=end, end__gt=start
+            )
+        )
+        merged = list(records)
+        for chunk in overlapping:
+            merged.extend(decode_records(chunk.data))
+            start, end = min(start, chunk.start), max(end, chunk.end)
+        merged.sort(key=lambda record: record.timestamp)
+
+        MetricRecordChunk.objects.filter(
+            pk__in=[chunk.pk for chunk in overlapping]
+        ).delete()
+        _save_chunk(metric_id, start, end, merged)
+
+        # В обход ORM: сигналы удаления пересчитали бы агрегаты без этих записей
+        record_ids = [record.id for record in records]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {TagsMetricRecord._meta.db_table} "
+                f"WHERE record_id = ANY(%s)",
+                [record_ids],
+            )
+            cursor.execute(
+                f"DELETE FROM {MetricRecord._meta.db_table} "
+                f"WHERE metric_id = %s AND timestamp >= %s AND timestamp < %s "
+                f"AND id = ANY(%s)",
+                [metric_id, start, end, record_ids],
+            )
+    return len(records)
+
+
+def archive_metric_records(metric_id: int, before: int) -> int:
+    """
+    Архивирует записи метрики в окнах, которые целиком раньше before.
+    Каждое окно - отдельная транзакция. Возвращает число записей.
+    """
+    window = settings.METRIC_ARCHIVE_WINDOW
+    limit = before - before % window
+    starts = (
+        MetricRecord.objects.filter(metric_id=metric_id, timestamp__lt=limit)
+        .annotate(window=F("timestamp") - F("timestamp") % window)
+        .values_list("window", flat=True)
+        .distinct()
+        .order_by("window")
+    )
+    return sum(_archive_window(metric_id, start, start + window) for start in starts)
+
+
+def restore_chunks(chunks: QuerySet) -> int:
+    """
+    Распаковывает чанки обратно в MetricRecord с исходными id и тегами.
+    Данные не меняются, поэтому кеш и агрегаты не трогаются.
+    """
+    restored = 0
+    with transaction.atomic():
+        for chunk in chunks.select_for_update().annotate(metric_name=F("metric__name")):
+            records = decode_records(chunk.data)
+            MetricRecord.objects.bulk_create(
+                (
+                    MetricRecord(
+                        id=record.id,
+                        metric_id=chunk.metric_id,
+                        metric_name=chunk.metric_name,
+                        timestamp=record.timestamp,
+                        value=record.value,
+                    )
+                    for record in records
+                ),
+                batch_size=RESTORE_BATCH_SIZE,
+            )
+            TagsMetricRecord.objects.bulk_create(
+                (
+                    TagsMetricRecord(record_id=record.id, tag_id=tag_id)
+                    for record in records
+                    for tag_id in record.tag_ids
+                ),
+                batch_size=RESTORE_BATCH_SIZE,
+            )
+            chunk.delete()
+            restored += len(records)
+    return restored
+
+
+def restore_archived_records(metric_id: int, timestamps: Iterable[int]) -> int:
+    """
+    Перед записью в метрику распаковывает чанки окон, в которые попадают
+    timestamps. Вызывается внутри транзакции записи: блокировка метрики
+    держится до её конца.
+    """
+    timestamps = sorted(timestamps)
+    if not timestamps or not archive_enabled():
+        return 0
+    _lock_metric(metric_id, shared=True)
+    candidates = MetricRecordChunk.objects.filter(
+        metric_id=metric_id, start__lte=timestamps[-1], end__gt=timestamps[0]
+    ).values_list("id", "start", "end")
+    chunk_ids = [
+        chunk_id
+        for chunk_id, start, end in candidates
+        if (index := bisect_left(timestamps, start)) < len(timestamps)
+        and timestamps[index] < end
+    ]
+    if not chunk_ids:
+        return 0
+    return restore_chunks(MetricRecordChunk.objects.filter(pk__in=chunk_ids))
+
+
+def purge_archived_records(metric_id: int, cutoff: int) -> int:
+    """Удаляет из чанков метрики записи раньше cutoff, возвращает их число."""
+    deleted = 0
+    with transaction.atomic():
+        expired = MetricRecordChunk.objects.filter(metric_id=metric_id, end__lte=cutoff)
+        deleted += sum(expired.values_list("count", flat=True))
+        expired.delete()
+
+        for chunk in MetricRecordChunk.objects.select_for_update().filter(
+            metric_id=metric_id, start__lt=cutoff, end__gt=cutoff
+        ):
+            records = decode_records(chunk.data)
+            kept = [record for record in records if record.timestamp >= cutoff]
+            deleted += len(records) - len(kept)
+            chunk.delete()
+            if kept:
+                _save_chunk(metric_id, chunk.start, chunk.end, kept)
+    return deleted
+
+
+def iter_archived_rows(
+    chunks: QuerySet,
+    from_ts: int | None = None,
+    to_ts: int | None = None,
+    tags: list[int] | None = None,
+    tags_all: list[int] | None = None,
+    descending: bool = False,
+    before: tuple[int, int] | None = None,
+) -> Iterator[dict]:
+    """
+    Записи из чанков в виде строк metric_record_rows, по (timestamp, id).
+    Фильтры те же, что у списка записей; before - позиция курсора
+    (timestamp, id) при обратном порядке. Чанки читаются и распаковываются
+    по одному, по мере чтения строк.
+    """
+    if from_ts is not None:
+        chunks = chunks.filter(end__gt=from_ts)
+    if to_ts is not None:
+        chunks = chunks.filter(start__lte=to_ts)
+    if before is not None:
+        chunks = chunks.filter(start__lte=before[0])
+    if tags:
+        chunks = chunks.filter(tags__overlap=tags)
+    if tags_all:
+        chunks = chunks.filter(tags__contains=tags_all)
+    chunks = (
+        chunks.annotate(metric_name=F("metric__name"))
+        .order_by("-start" if descending else "start")
+        .values_list("metric_id", "metric_name", "data")
+    )
+    any_tags, all_tags = set(tags or ()), set(tags_all or ())
+
+    for metric_id, metric_name, data in chunks.iterator(chunk_size=CHUNK_ITERATOR_SIZE):
+        records = decode_records(data)
+        for record in reversed(records) if descending else records:
+            if from_ts is not None and record.timestamp < from_ts:
+                continue
+            if to_ts is not None and record.timestamp > to_ts:
+                continue
+            if before is not None and (record.timestamp, record.id) >= before:
+                continue
+            if any_tags and any_tags.isdisjoint(record.tag_ids):
+                continue
+            if not all_tags <= set(record.tag_ids):
+                continue
+            yield {
+                "id": record.id,
+                "metric_id": metric_id,
+                "metric_name": metric_name,
+                "value": record.value,
+                "timestamp": record.timestamp,
+                "tag_ids": list(record.tag_ids),
+            }
+
+
+def _row_key(row: dict) -> tuple[int, int]:
+    return row["timestamp"], row["id"]
+
+
+def merge_rows(
+    hot: Iterable[dict], archived: Iterable[dict], descending: bool = False
+) -> Iterator[dict]:
+    """Сливает упорядоченные строки таблицы и архива по (timestamp, id)."""
+    return heapq.merge(hot, archived, key=_row_key, reverse=descending)
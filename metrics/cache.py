@@ -0,0 +1,302 @@
+import logging
+import time
+from functools import lru_cache
+from hashlib import md5
+from typing import Callable, NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import LockNotOwnedError
+from redis.lock import Lock
+
+from metrics.local_cache import (
+    local_epoch,
+    local_get,
+    local_set,
+    publish_invalidation,
+)
+from metrics.redis_client import get_redis
+from metrics.telemetry import record_cache_write
+
+logger = logging.getLogger(__name__)
+
+METRIC_RECORDS_CACHE_TIMEOUT = 60 * 5
+TAGS_PREFIX = "tags:"
+TAGS_CACHE_KEY = f"{TAGS_PREFIX}list"
+TAGS_VERSION_KEY = f"{TAGS_PREFIX}version"
+TAGS_CACHE_TIMEOUT = 60 * 60
+# Интервал опроса кеша, пока страницу строит другой воркер
+LOCK_POLL_INTERVAL = 0.05
+# max(версия + 1, ARGV[1]) одной командой; целое в Redis читается кешем Django как int
+BUMP_VERSION_SCRIPT = """
+local version = math.max(tonumber(redis.call('GET', KEYS[1]) or '0') + 1, tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], version)
+return version
+"""
+
+
+def _metric_prefix(metric_id: int) -> str:
+    return f"metric:{metric_id}:"
+
+
+def _generation_key(metric_id: int) -> str:
+    return f"{_metric_prefix(metric_id)}generation"
+
+
+def get_two_tier(key: str):
+    """Читает ключ из памяти процесса, при промахе - из Redis с сохранением в память."""
+    value = local_get(key)
+    if value is None:
+        epoch = local_epoch()
+        value = cache.get(key)
+        if value is not None:
+            local_set(key, value, epoch)
+    return value
+
+
+def set_two_tier(key: str, value, timeout: int | None) -> None:
+    cache.set(key, value, timeout=timeout)
+    local_set(key, value)
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def get_version(key: str) -> int:
+    """
+    Версия данных - время их последнего изменения в мс. Служит и поколением
+    ключей кеша, и валидатором для условных запросов (ETag/Last-Modified).
+    После вытеснения версия начинается с текущего времени, поэтому не
+    совпадает с версиями, ключи которых ещё живут в кеше.
+    """
+    version = get_two_tier(key)
+    if version is None:
+        epoch = local_epoch()
+        cache.add(key, _now_ms(), timeout=None)
+        version = cache.get(key)
+        local_set(key, version, epoch)
+    return version
+
+
+@lru_cache(maxsize=1)
+def _bump_version_script():
+    return get_redis().register_script(BUMP_VERSION_SCRIPT)
+
+
+def bump_version(key: str) -> int:
+    """
+    Новая версия - текущее время в мс, но всегда больше предыдущей.
+    Чтение и запись выполняются в Redis атомарно, поэтому параллельные
+    изменения получают разные версии.
+    """
+    record_cache_write(key, "bump")
+    return _bump_version_script()(
+        keys=[cache.make_and_validate_key(key)], args=[_now_ms()]
+    )
+
+
+def metric_cache_generation(metric_id: int) -> int:
+    """Текущее поколение кеша метрики. Входит во все ключи её записей."""
+    return get_version(_generation_key(metric_id))
+
+
+def metric_owner_cache_key(metric_id: int) -> str:
+    """Ключ id автора активной метрики (0 - метрики нет)."""
+    return f"{_metric_prefix(metric_id)}owner"
+
+
+def _user_metrics_prefix(user_id: int) -> str:
+    return f"user:{user_id}:metrics:"
+
+
+def user_metrics_version(user_id: int) -> int:
+    """Версия списка метрик пользователя."""
+    return get_version(f"{_user_metrics_prefix(user_id)}version")
+
+
+def tags_version() -> int:
+    """Версия списка тегов."""
+    return get_version(TAGS_VERSION_KEY)
+
+
+def metric_records_cache_key(
+    metric_id: int, user_id: int, generation: int | None = None
+) -> str:
+    """Базовый ключ записей метрики в поколении generation (по умолчанию текущем)."""
+    if generation is None:
+        generation = metric_cache_generation(metric_id)
+    return f"metric:{metric_id}:{generation}:{user_id}:records"
+
+
+def _parts_digest(parts: tuple) -> str:
+    return md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def metric_records_page_cache_key(
+    metric_id: int, user_id: int, *parts: object, generation: int | None = None
+) -> str:
+    """Ключ одной страницы/выборки записей метрики."""
+    base = metric_records_cache_key(metric_id, user_id, generation)
+    return f"{base}:{_parts_digest(parts)}"
+
+
+def metric_records_stale_cache_key(metric_id: int, user_id: int, *parts: object) -> str:
+    """
+    Ключ последней построенной копии страницы. Не зависит от поколения,
+    поэтому переживает инвалидацию и отдаётся, пока строится новая.
+    """
+    return f"metric:{metric_id}:{user_id}:records:stale:{_parts_digest(parts)}"
+
+
+class StalePage(NamedTuple):
+    """Устаревающая копия страницы и поколение, в котором она построена."""
+
+    generation: int
+    data: object
+
+
+def store_metric_records_page(
+    key: str, stale_key: str, generation: int, data: object
+) -> object:
+    """Кеширует страницу поколения generation вместе с её устаревающей копией."""
+    set_two_tier(key, data, timeout=METRIC_RECORDS_CACHE_TIMEOUT)
+    cache.set(
+        stale_key,
+        StalePage(generation, data),
+        timeout=settings.METRIC_RECORDS_CACHE_STALE_TIMEOUT,
+    )
+    return data
+
+
+def page_build_lock(lock_key: str, token: str | None = None) -> Lock:
+    """
+    Блокировка построения страницы с токеном владельца: снять её может только
+    взявший, даже если она успела истечь и достаться другому воркеру.
+    token - токен уже взятой блокировки, например переданный в задачу.
+    """
+    lock = get_redis().lock(
+        cache.make_and_validate_key(lock_key),
+        timeout=settings.METRIC_RECORDS_CACHE_LOCK_TIMEOUT,
+        blocking=False,
+    )
+    if token is not None:
+        lock.local.token = token.encode()
+    return lock
+
+
+def release_page_build_lock(lock: Lock) -> None:
+    try:
+        lock.release()
+    except LockNotOwnedError:
+        logger.warning(
+            f"Блокировка {lock.name} истекла до окончания построения страницы."
+        )
+
+
+def get_or_build_metric_records_page(
+    metric_id: int,
+    user_id: int,
+    parts: tuple,
+    build: Callable[[], object],
+    refresh: Callable[[str, str], None] | None = None,
+    generation: int | None = None,
+) -> tuple[int, object]:
+    """
+    Отдаёт страницу из кеша, а при промахе строит её не более чем в одном
+    воркере (single-flight): остальные получают предыдущую копию или ждут
+    до METRIC_RECORDS_CACHE_LOCK_WAIT секунд.
+
+    refresh(lock_key, lock_token) - фоновое обновление (stale-while-revalidate):
+    при наличии предыдущей копии она отдаётся сразу, а страницу строит refresh,
+    который должен снять блокировку по её токену (page_build_lock).
+
+    Возвращает (поколение, страница). Предыдущая копия отдаётся со своим
+    поколением, поэтому валидаторы ответа не опережают его данные.
+    """
+    if generation is None:
+        generation = metric_cache_generation(metric_id)
+    epoch = local_epoch()
+    key = metric_records_page_cache_key(
+        metric_id, user_id, *parts, generation=generation
+    )
+    data = local_get(key)
+    if data is not None:
+        return generation, data
+
+    stale_key = metric_records_stale_cache_key(metric_id, user_id, *parts)
+    cached = cache.get_many([key, stale_key])
+    if key in cached:
+        local_set(key, cached[key], epoch)
+        return generation, cached[key]
+    stale = cached.get(stale_key)
+    # Копии старого формата, без поколения, не отдаются
+    if not isinstance(stale, StalePage):
+        stale = None
+
+    lock_key = f"{key}:lock"
+    lock = page_build_lock(lock_key)
+    if lock.acquire():
+        if refresh is not None and stale is not None:
+            try:
+                refresh(lock_key, lock.local.token.decode())
+                return stale
+            except Exception:
+                logger.exception(
+                    "Не удалось запустить фоновое обновление кеша. Строю страницу синхронно."
+                )
+        try:
+            return generation, store_metric_records_page(
+                key, stale_key, generation, build()
+            )
+        finally:
+            release_page_build_lock(lock)
+
+    if stale is not None:
+        return stale
+
+    deadline = time.monotonic() + settings.METRIC_RECORDS_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        data = cache.get(key)
+        if data is not None:
+            return generation, data
+    logger.warning(f"Не дождался построения страницы {key}, строю сам.")
+    return generation, build()
+
+
+def tag_name_cache_keys(names) -> dict[str, str]:
+    """Ключи кеша имя -> id тега в текущей версии тегов: {ключ: имя}."""
+    version = tags_version()
+    return {
+        f"{TAGS_PREFIX}{version}:name:{_parts_digest((name,))}": name for name in names
+    }
+
+
+def invalidate_metric_cache(metric_id: int) -> None:
+    """
+    Сбрасывает весь кеш метрики (списки, страницы, агрегаты) за O(1):
+    увеличивает поколение, старые ключи истекают сами по таймауту.
+    """
+    bump_version(_generation_key(metric_id))
+    publish_invalidation(_metric_prefix(metric_id))
+
+
+def invalidate_metric_owner(metric_id: int) -> None:
+    """Сбрасывает кешированного автора метрики во всех процессах."""
+    key = metric_owner_cache_key(metric_id)
+    cache.delete(key)
+    publish_invalidation(key)
+
+
+def invalidate_user_metrics(user_id: int) -> None:
+    """Меняет версию списка метрик пользователя."""
+    bump_version(f"{_user_metrics_prefix(user_id)}version")
+    publish_invalidation(_user_metrics_prefix(user_id))
+
+
+def invalidate_tags_cache() -> None:
+    """Сбрасывает кеш списка тегов во всех процессах."""
+    cache.delete(TAGS_CACHE_KEY)
+    bump_version(TAGS_VERSION_KEY)
+    publish_invalidation(TAGS_PREFIX)
@@ -0,0 +1,73 @@
+from typing import Iterable, Iterator
+
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db.models import OuterRef, QuerySet
+
+from metrics.archive import merge_rows
+from metrics.models import Tag, TagsMetricRecord
+
+EXPORT_FIELDS = ("id", "metric_id", "metric_name", "timestamp", "value", "tags")
+EXPORT_CHUNK_SIZE = 2000
+
+
+def iter_export_rows(
+    queryset: QuerySet, archived: Iterable[dict] | None = None
+) -> Iterator[dict]:
+    """
+    Построчно отдаёт записи метрики для выгрузки.
+    Читает через серверный курсор (iterator), теги собираются подзапросом
+    для каждой строки, поэтому память не зависит от размера метрики.
+    archived - строки архивных чанков (iter_archived_rows) по возрастанию,
+    они вставляются в выгрузку по порядку.
+    """
+    rows = _iter_table_rows(queryset)
+    if archived is not None:
+        rows = merge_rows(rows, _iter_archived_export_rows(archived))
+    return rows
+
+
+def _export_row(record_id, metric_id, metric_name, timestamp, value, tags) -> dict:
+    return {
+        "id": record_id,
+        "metric_id": metric_id,
+        "metric_name": metric_name,
+        "timestamp": timestamp,
+        # Как в API: значение отдаётся строкой без потери точности
+        "value": str(value),
+        "tags": tags,
+    }
+
+
+def _iter_archived_export_rows(rows: Iterable[dict]) -> Iterator[dict]:
+    """Строки архива с именами тегов, имена запрашиваются по мере появления id."""
+    names = {}
+    for row in rows:
+        missing = set(row["tag_ids"]) - names.keys()
+        if missing:
+            names.update(Tag.objects.filter(pk__in=missing).values_list("id", "name"))
+        yield _export_row(
+            row["id"],
+            row["metric_id"],
+            row["metric_name"],
+            row["timestamp"],
+            row["value"],
+            sorted(names[tag_id] for tag_id in row["tag_ids"]),
+        )
+
+
+def _iter_table_rows(queryset: QuerySet) -> Iterator[dict]:
+    tag_names = ArraySubquery(
+        TagsMetricRecord.objects.filter(record=OuterRef("pk"))
+        .order_by("tag__name")
+        .values("tag__name")
+    )
+    rows = (
+        queryset.order_by("timestamp", "id")
+        .annotate(tag_names=tag_names)
+        .values_list(
+            "id", "metric_id", "metric_name", "timestamp", "value", "tag_names"
+        )
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    for row in rows:
+        yield _export_row(*row)
@@ -0,0 +1,89 @@
+from django.db.models import Exists, OuterRef, QuerySet
+from rest_framework.filters import BaseFilterBackend
+
+from metrics.models import TagsMetricRecord
+from metrics.serializers import TagFilterQuerySerializer, TimeRangeQuerySerializer
+
+
+def filter_time_range(
+    queryset: QuerySet, from_ts: int | None = None, to_ts: int | None = None
+) -> QuerySet:
+    """Оставляет записи с timestamp в [from_ts, to_ts]."""
+    if from_ts is not None:
+        queryset = queryset.filter(timestamp__gte=from_ts)
+    if to_ts is not None:
+        queryset = queryset.filter(timestamp__lte=to_ts)
+    return queryset
+
+
+def filter_any_tags(queryset: QuerySet, tag_ids: list[int] | None) -> QuerySet:
+    """Оставляет записи, у которых есть хотя бы один из тегов tag_ids."""
+    if not tag_ids:
+        return queryset
+    return queryset.filter(
+        Exists(
+            TagsMetricRecord.objects.filter(
+                record=OuterRef("pk"),
+                tag_id__in=tag_ids,
+            )
+        )
+    )
+
+
+def filter_all_tags(queryset: QuerySet, tag_ids: list[int] | None) -> QuerySet:
+    """Оставляет записи, у которых есть все теги tag_ids."""
+    for tag_id in dict.fromkeys(tag_ids or []):
+        queryset = queryset.filter(
+            Exists(
+                TagsMetricRecord.objects.filter(record=OuterRef("pk"), tag_id=tag_id)
+            )
+        )
+    return queryset
+
+
+def filter_metrics_by_tags(
+    queryset: QuerySet,
+    any_tag_ids: list[int] | None = None,
+    all_tag_ids: list[int] | None = None,
+) -> QuerySet:
+    """Оставляет метрики, у записей которых есть теги (хотя бы один / все)."""
+    if any_tag_ids:
+        queryset = queryset.filter(
+            Exists(
+                TagsMetricRecord.objects.filter(
+                    record__metric=OuterRef("pk"), tag_id__in=any_tag_ids
+                )
+            )
+        )
+    for tag_id in dict.fromkeys(all_tag_ids or []):
+        queryset = queryset.filter(
+            Exists(
+                TagsMetricRecord.objects.filter(
+                    record__metric=OuterRef("pk"), tag_id=tag_id
+                )
+            )
+        )
+    return queryset
+
+
+class TimeRangeFilterBackend(BaseFilterBackend):
+    """Фильтрует записи метрики по диапазону timestamp из параметров from/to."""
+
+    def filter_queryset(self, request, queryset, view):
+        serializer = TimeRangeQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        time_range = serializer.validated_data
+        return filter_time_range(queryset, time_range.get("from"), time_range.get("to"))
+
+
+class TagFilterBackend(BaseFilterBackend):
+    """
+    Оставляет записи, у которых есть хотя бы один из тегов параметра tags
+    и все теги параметра tags_all.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        serializer = TagFilterQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        queryset = filter_any_tags(queryset, serializer.validated_data.get("tags"))
+        return filter_all_tags(queryset, serializer.validated_data.get("tags_all"))
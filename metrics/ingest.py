@@ -0,0 +1,176 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+from metrics.cache import invalidate_metric_cache
+from metrics.models import Metric, Tag
+from metrics.redis_client import get_redis
+from metrics.services import CONFLICT, resolve_record_tags, write_metric_records
+
+logger = logging.getLogger(__name__)
+
+BUFFER_KEY = "metrics:ingest:buffer"
+# Пачка, которую пишет текущий сброс; после падения воркера дописывается первой
+PROCESSING_KEY = "metrics:ingest:processing"
+# Записи групп, которые не удалось записать; разбираются вручную
+DEAD_LETTER_KEY = "metrics:ingest:dead-letter"
+STATS_KEY = "metrics:ingest:stats"
+# Переносит до ARGV[1] элементов из начала KEYS[1] в конец KEYS[2] одной
+# командой. RPUSH частями, чтобы не упереться в размер стека Lua.
+CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for i = 1, #items, 1000 do
+    redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+return items
+"""
+
+
+def enqueue_metric_records(
+    metric_id: int, records_data: list[dict], on_conflict: str
+) -> None:
+    """
+    Кладёт провалидированные записи в буфер Redis одним RPUSH.
+    В БД их переносит задача flush_metric_records_buffer.
+    """
+    resolve_record_tags(records_data)
+    enqueued_at = time.time()
+    get_redis().rpush(
+        BUFFER_KEY,
+        *(
+            json.dumps(
+                {
+                    "metric_id": metric_id,
+                    "timestamp": data["timestamp"],
+                    "value": str(data["value"]),
+                    # None - теги не переданы, при update остаются прежние
+                    "tags": (
+                        [tag.id for tag in data["tags"]] if "tags" in data else None
+                    ),
+                    "on_conflict": on_conflict,
+                    "enqueued_at": enqueued_at,
+                }
+            )
+            for data in records_data
+        ),
+    )
+
+
+@lru_cache(maxsize=1)
+def _claim_script():
+    return get_redis().register_script(CLAIM_SCRIPT)
+
+
+def claim_batch(batch_size: int) -> list[bytes]:
+    """
+    Атомарно переносит пачку из буфера в список обработки и возвращает её.
+    Если там остались элементы прерванного сброса, возвращает их.
+    """
+    raw_items = get_redis().lrange(PROCESSING_KEY, 0, -1)
+    if raw_items:
+        logger.warning(f"Дописываю {len(raw_items)} записей прерванного сброса буфера.")
+        return raw_items
+    return _claim_script()(keys=[BUFFER_KEY, PROCESSING_KEY], args=[batch_size])
+
+
+def flush_buffer(batch_size: int) -> int:
+    """
+    Переносит одну пачку из буфера в БД и возвращает её размер.
+    Пачка удаляется из списка обработки только после записи (at-least-once),
+    повторная запись безопасна благодаря on_conflict. Группа, запись которой
+    упала, переносится в DEAD_LETTER_KEY и не мешает остальным.
+    """
+    raw_items = claim_batch(batch_size)
+    if not raw_items:
+        return 0
+
+    items = [json.loads(raw_item) for raw_item in raw_items]
+    metrics = Metric.objects.active().in_bulk({item["metric_id"] for item in items})
+    tags = Tag.objects.in_bulk(
+        {tag_id for item in items for tag_id in item["tags"] or ()}
+    )
+
+    groups = defaultdict(list)
+    for raw_item, item in zip(raw_items, items):
+        data = {"timestamp": item["timestamp"], "value": item["value"]}
+        if item["tags"] is not None:
+            data["tags"] = [tags[tag_id] for tag_id in item["tags"] if tag_id in tags]
+        groups[(item["metric_id"], item["on_conflict"])].append((raw_item, data))
+
+    written_metric_ids = set()
+    dead_letters = []
+    for (metric_id, on_conflict), group in groups.items():
+        metric = metrics.get(metric_id)
+        if metric is None:
+            logger.warning(
+                f"Метрика ID {metric_id} удалена, пропускаю {len(group)} записей из буфера."
+            )
+            continue
+
+        try:
+            results = write_metric_records(
+                metric, [data for _, data in group], on_conflict
+            )
+        except Exception:
+            logger.exception(
+                f"Метрика ID {metric_id}: не удалось записать {len(group)} записей "
+                f"из буфера, переношу их в {DEAD_LETTER_KEY}."
+            )
+            dead_letters.extend(raw_item for raw_item, _ in group)
+            continue
+
+        conflicts = sum(result == CONFLICT for result, _ in results)
+        if conflicts:
+            logger.warning(
+                f"Метрика ID {metric_id}: {conflicts} записей из буфера уже существуют."
+            )
+        if len(results) > conflicts:
+            written_metric_ids.add(metric_id)
+
+    for metric_id in written_metric_ids:
+        invalidate_metric_cache(metric_id)
+
+    with get_redis().pipeline() as pipe:
+        if dead_letters:
+            pipe.rpush(DEAD_LETTER_KEY, *dead_letters)
+        pipe.delete(PROCESSING_KEY)
+        pipe.hset(
+            STATS_KEY,
+            mapping={
+                "last_flush_at": time.time(),
+                "last_flush_size": len(items),
+                "last_flush_lag": time.time()
+                - min(item["enqueued_at"] for item in items),
+            },
+        )
+        pipe.execute()
+    return len(items)
+
+
+def buffer_status() -> dict:
+    """
+    Глубина буфера, возраст самой старой записи, размеры списков обработки
+    и неудачных записей и данные последнего сброса.
+    """
+    client = get_redis()
+    with client.pipeline(transaction=False) as pipe:
+        pipe.llen(BUFFER_KEY)
+        pipe.lindex(BUFFER_KEY, 0)
+        pipe.llen(PROCESSING_KEY)
+        pipe.llen(DEAD_LETTER_KEY)
+        pipe.hgetall(STATS_KEY)
+        depth, oldest, processing, dead_letters, stats = pipe.execute()
+
+    lag = None
+    if oldest is not None:
+        lag = round(time.time() - json.loads(oldest)["enqueued_at"], 3)
+    return {
+        "depth": depth,
+        "lag_seconds": lag,
+        "processing": processing,
+        "dead_letter": dead_letters,
+        "last_flush": {key.decode(): float(value) for key, value in stats.items()},
+    }
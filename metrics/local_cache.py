@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+
+from metrics.redis_client import get_redis
+from metrics.telemetry import record_cache_read
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "metrics:cache:invalidate"
+RECONNECT_DELAY = 1
+
+
+class LocalLRUCache:
+    """
+    Потокобезопасный LRU-кеш в памяти процесса с ограничением числа
+    элементов и временем жизни.
+
+    epoch растёт при каждой инвалидации. set с epoch, снятым до чтения из
+    Redis, ничего не сохраняет, если за это время пришла инвалидация, -
+    иначе в процессе мог бы остаться уже сброшенный ключ.
+    """
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.epoch = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, epoch: int | None = None) -> None:
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix: str) -> None:
+        with self._lock:
+            self.epoch += 1
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.epoch += 1
+            self._data.clear()
+
+
+@lru_cache(maxsize=1)
+def get_local_cache() -> LocalLRUCache:
+    return LocalLRUCache(
+        max_items=settings.METRIC_LOCAL_CACHE_MAX_ITEMS,
+        ttl=settings.METRIC_LOCAL_CACHE_TTL,
+    )
+
+
+_listener_lock = threading.Lock()
+_listener_pid = None
+_subscribed = threading.Event()
+
+
+def local_cache_enabled() -> bool:
+    """
+    Локальный уровень работает, только пока процесс подписан на канал
+    инвалидации, иначе он мог бы отдавать сброшенные в других процессах данные.
+    """
+    if not settings.METRIC_LOCAL_CACHE_ENABLED:
+        return False
+    _ensure_listener()
+    return _subscribed.is_set()
+
+
+def local_epoch() -> int:
+    return get_local_cache().epoch
+
+
+def local_get(key: str):
+    if not local_cache_enabled():
+        return None
+    value = get_local_cache().get(key)
+    record_cache_read(key, value is not None, "local")
+    return value
+
+
+def local_set(key: str, value, epoch: int | None = None) -> None:
+    if local_cache_enabled():
+        get_local_cache().set(key, value, epoch)
+
+
+def publish_invalidation(prefix: str) -> None:
+    """Сбрасывает ключи с префиксом prefix в этом и во всех остальных процессах."""
+    get_local_cache().delete_prefix(prefix)
+    if not settings.METRIC_LOCAL_CACHE_ENABLED:
+        return
+    try:
+        get_redis().publish(INVALIDATION_CHANNEL, prefix)
+    except Exception:
+        logger.exception(f"Не удалось разослать инвалидацию {prefix}.")
+
+
+def handle_invalidation(prefix: bytes | str) -> None:
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode()
+    get_local_cache().delete_prefix(prefix)
+
+
+def _ensure_listener() -> None:
+    """Запускает поток подписки один раз на процесс, в том числе после fork."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _subscribed.clear()
+        get_local_cache().clear()
+        threading.Thread(
+            target=_listen, name="metrics-cache-invalidation", daemon=True
+        ).start()
+
+
+def _listen() -> None:
+    while True:
+        try:
+            with get_redis().pubsub() as pubsub:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        # Пока подписки не было, сообщения могли потеряться
+                        get_local_cache().clear()
+                        _subscribed.set()
+                    elif message["type"] == "message":
+                        handle_invalidation(message["data"])
+        except Exception:
+            logger.exception("Подписка на инвалидацию кеша прервалась.")
+        finally:
+            _subscribed.clear()
+            get_local_cache().clear()
+        time.sleep(RECONNECT_DELAY)
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.archive import iter_archived_rows
+from metrics.export import EXPORT_FIELDS, iter_export_rows
+from metrics.filters import filter_all_tags, filter_any_tags, filter_time_range
+from metrics.models import Metric, MetricRecord, MetricRecordChunk
+from metrics.renderers import CSVRenderer, NDJSONRenderer
+
+RENDERERS = {
+    CSVRenderer.format: CSVRenderer,
+    NDJSONRenderer.format: NDJSONRenderer,
+}
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка записей метрики в CSV или NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("metric_id", type=int, help="ID метрики")
+        parser.add_argument(
+            "--format",
+            choices=sorted(RENDERERS),
+            default=CSVRenderer.format,
+            help="Формат выгрузки (по умолчанию csv)",
+        )
+        parser.add_argument(
+            "--from", dest="from_ts", type=int, help="Минимальный timestamp"
+        )
+        parser.add_argument(
+            "--to", dest="to_ts", type=int, help="Максимальный timestamp"
+        )
+        parser.add_argument(
+            "--tags",
+            type=lambda value: [int(tag) for tag in value.split(",") if tag],
+            help="ID тегов через запятую, хотя бы один из которых есть у записи",
+        )
+        parser.add_argument(
+            "--tags-all",
+            type=lambda value: [int(tag) for tag in value.split(",") if tag],
+            help="ID тегов через запятую, все из которых есть у записи",
+        )
+        parser.add_argument(
+            "--output",
+            "-o",
+            help="Файл для выгрузки (по умолчанию stdout)",
+        )
+
+    def handle(self, *args, **options):
+        metric_id = options["metric_id"]
+        if not Metric.objects.active().filter(id=metric_id).exists():
+            raise CommandError(f"Метрика ID {metric_id} не найдена")
+
+        records = MetricRecord.objects.filter(metric_id=metric_id)
+        records = filter_time_range(records, options["from_ts"], options["to_ts"])
+        records = filter_any_tags(records, options["tags"])
+        records = filter_all_tags(records, options["tags_all"])
+
+        archived = iter_archived_rows(
+            MetricRecordChunk.objects.filter(metric_id=metric_id),
+            from_ts=options["from_ts"],
+            to_ts=options["to_ts"],
+            tags=options["tags"],
+            tags_all=options["tags_all"],
+        )
+
+        renderer = RENDERERS[options["format"]]()
+        chunks = renderer.stream(
+            iter_export_rows(records, archived), fields=EXPORT_FIELDS
+        )
+
+        if not options["output"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+
+        with open(options["output"], "w", encoding="utf-8", newline="") as output:
+            for chunk in chunks:
+                output.write(chunk)
@@ -0,0 +1,347 @@
+import csv
+import io
+import json
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+from typing import Iterator
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from metrics.archive import ARCHIVE_LOCK, restore_chunks
+from metrics.cache import invalidate_metric_cache, invalidate_tags_cache
+from metrics.models import (
+    Metric,
+    MetricRecord,
+    MetricRecordChunk,
+    Tag,
+    TagsMetricRecord,
+)
+from metrics.rollups import rebuild_rollups
+from metrics.validators import validate_unix_timestamp
+
+SKIP = "skip"
+OVERWRITE = "overwrite"
+FORMATS = ("csv", "ndjson")
+MAX_REPORTED_ERRORS = 20
+
+STAGING_TABLE = "import_records_staging"
+SOURCE_TABLE = "import_records_source"
+MERGED_TABLE = "import_records_merged"
+
+
+class Command(BaseCommand):
+    help = (
+        "Быстрая загрузка записей метрик из CSV/NDJSON через PostgreSQL COPY. "
+        "Поддерживает формат выгрузки export_records."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files",
+            nargs="*",
+            help="Файлы для загрузки. Без файлов или '-' - чтение из stdin",
+        )
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="Формат входных данных (по умолчанию - по расширению файла, иначе csv)",
+        )
+        parser.add_argument(
+            "--metric",
+            type=int,
+            help="ID метрики для строк без metric_id",
+        )
+        parser.add_argument(
+            "--on-duplicate",
+            choices=(SKIP, OVERWRITE),
+            default=SKIP,
+            help="Что делать с записями, которые уже есть на (metric, timestamp)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=50_000,
+            help="Сколько строк передавать в одном COPY",
+        )
+
+    def handle(self, *args, **options):
+        self.default_metric_id = options["metric"]
+        self.errors = 0
+        started = time.monotonic()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.create_staging_table(cursor)
+            loaded = self.copy_rows(cursor, options, started)
+            summary = self.merge(cursor, options["on_duplicate"])
+            affected = self.finish(cursor)
+
+        for metric_id in affected:
+            invalidate_metric_cache(metric_id)
+        if summary["tags_created"]:
+            invalidate_tags_cache()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Готово за {elapsed:.1f} c: прочитано {loaded + self.errors}, "
+                f"с ошибками {self.errors}, без метрики {summary['unknown_metric']}, "
+                f"добавлено {summary['inserted']}, обновлено {summary['updated']}, "
+                f"пропущено дублей {summary['skipped']} "
+                f"({loaded / max(elapsed, 1e-9):.0f} строк/с)"
+            )
+        )
+
+    def create_staging_table(self, cursor) -> None:
+        cursor.execute(f"""
+            CREATE TEMP TABLE {STAGING_TABLE} (
+                seq bigserial,
+                metric_id bigint NOT NULL,
+                timestamp bigint NOT NULL,
+                value numeric(16, 4) NOT NULL,
+                tags text[] NOT NULL
+            ) ON COMMIT DROP
+            """)
+
+    def copy_rows(self, cursor, options, started: float) -> int:
+        """Загружает строки во временную таблицу порциями через COPY."""
+        loaded = 0
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in self.iter_rows(options):
+            writer.writerow(row)
+            loaded += 1
+            if loaded % options["chunk_size"] == 0:
+                self.copy_buffer(cursor, buffer)
+                self.report_progress(loaded, started)
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+
+        if buffer.tell():
+            self.copy_buffer(cursor, buffer)
+            self.report_progress(loaded, started)
+        return loaded
+
+    @staticmethod
+    def copy_buffer(cursor, buffer: io.StringIO) -> None:
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} (metric_id, timestamp, value, tags) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+    def report_progress(self, loaded: int, started: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stdout.write(f"Загружено {loaded} строк ({loaded / elapsed:.0f} строк/с)")
+
+    def iter_rows(self, options) -> Iterator[tuple]:
+        """Читает и валидирует строки всех источников."""
+        for name in options["files"] or ["-"]:
+            data_format = options["format"] or self.guess_format(name)
+            if name == "-":
+                yield from self.iter_source(sys.stdin, "stdin", data_format)
+                continue
+            try:
+                with open(name, encoding="utf-8", newline="") as source:
+                    yield from self.iter_source(source, name, data_format)
+            except OSError as error:
+                raise CommandError(f"Не удалось прочитать {name}: {error}")
+
+    @staticmethod
+    def guess_format(name: str) -> str:
+        if Path(name).suffix.lower() in (".ndjson", ".jsonl"):
+            return "ndjson"
+        return "csv"
+
+    def iter_source(self, source, name: str, data_format: str) -> Iterator[tuple]:
+        if data_format == "ndjson":
+            items = (
+                (line_number, line)
+                for line_number, line in enumerate(source, start=1)
+                if line.strip()
+            )
+        else:
+            items = enumerate(csv.DictReader(source), start=2)
+
+        for line_number, item in items:
+            try:
+                if data_format == "ndjson":
+                    item = json.loads(item)
+                yield self.parse_row(item)
+            except (
+                LookupError,
+                ValueError,
+                TypeError,
+                AttributeError,
+                ValidationError,
+            ) as error:
+                self.errors += 1
+                if self.errors <= MAX_REPORTED_ERRORS:
+                    self.stderr.write(f"{name}:{line_number}: {error}")
+
+    def parse_row(self, item: dict) -> tuple:
+        metric_id = item.get("metric_id") or self.default_metric_id
+        if metric_id in (None, ""):
+            raise ValueError("не указан metric_id")
+        timestamp = int(item["timestamp"])
+        validate_unix_timestamp(timestamp)
+
+        try:
+            value = Decimal(str(item["value"]))
+        except InvalidOperation:
+            raise ValueError(f"неверное значение {item['value']!r}")
+        field = MetricRecord._meta.get_field("value")
+        field.run_validators(field.to_python(value))
+
+        tags = item.get("tags") or []
+        if isinstance(tags, str):
+            tags = tags.split("|")
+        tags = [str(tag) for tag in tags if str(tag)]
+        max_length = Tag._meta.get_field("name").max_length
+        if any(len(tag) > max_length for tag in tags):
+            raise ValueError(f"имя тега длиннее {max_length} символов")
+
+        return int(metric_id), timestamp, value, self.pg_array(tags)
+
+    @staticmethod
+    def pg_array(values) -> str:
+        """Текстовый литерал массива PostgreSQL для COPY."""
+        escaped = (
+            '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            for value in values
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def merge(self, cursor, on_duplicate: str) -> dict:
+        """Переносит строки из временной таблицы в MetricRecord и теги."""
+        records = MetricRecord._meta.db_table
+        metrics = Metric._meta.db_table
+        tags = Tag._meta.db_table
+        through = TagsMetricRecord._meta.db_table
+
+        # Последняя строка на (metric, timestamp) побеждает
+        cursor.execute(f"""
+            CREATE TEMP TABLE {SOURCE_TABLE} ON COMMIT DROP AS
+            SELECT DISTINCT ON (s.metric_id, s.timestamp)
+                   s.metric_id, s.timestamp, s.value, s.tags, m.name AS metric_name
+            FROM {STAGING_TABLE} s
+            JOIN {metrics} m ON m.id = s.metric_id AND m.deleted_at IS NULL
+            ORDER BY s.metric_id, s.timestamp, s.seq DESC
+            """)
+        cursor.execute(f"""
+            SELECT count(*) FROM {STAGING_TABLE} s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {metrics} m
+                WHERE m.id = s.metric_id AND m.deleted_at IS NULL
+            )
+            """)
+        unknown_metric = cursor.fetchone()[0]
+        cursor.execute(f"SELECT count(*) FROM {SOURCE_TABLE}")
+        source_count = cursor.fetchone()[0]
+
+        # Архивные окна, в которые попадают загружаемые записи, распаковываются
+        # обратно в таблицу, чтобы дубликаты нашёл ON CONFLICT
+        cursor.execute(
+            f"""
+            SELECT pg_advisory_xact_lock_shared(%s, metric_id::integer)
+            FROM (SELECT DISTINCT metric_id FROM {SOURCE_TABLE} ORDER BY metric_id) m
+            """,
+            [ARCHIVE_LOCK],
+        )
+        cursor.execute(f"""
+            SELECT c.id FROM {MetricRecordChunk._meta.db_table} c
+            WHERE EXISTS (
+                SELECT 1 FROM {SOURCE_TABLE} s
+                WHERE s.metric_id = c.metric_id
+                  AND s.timestamp >= c.start AND s.timestamp < c."end"
+            )
+            """)
+        restore_chunks(
+            MetricRecordChunk.objects.filter(
+                pk__in=[row[0] for row in cursor.fetchall()]
+            )
+        )
+
+        if on_duplicate == OVERWRITE:
+            conflict = "DO UPDATE SET value = EXCLUDED.value"
+        else:
+            conflict = "DO NOTHING"
+        cursor.execute(f"""
+            CREATE TEMP TABLE {MERGED_TABLE} (
+                record_id bigint,
+                metric_id bigint,
+                timestamp bigint,
+                inserted boolean
+            ) ON COMMIT DROP
+            """)
+        # Новые записи - те, которых не было в снимке данных до INSERT
+        cursor.execute(f"""
+            WITH old AS (
+                SELECT r.metric_id, r.timestamp
+                FROM {records} r JOIN {SOURCE_TABLE} s USING (metric_id, timestamp)
+            ), merged AS (
+                INSERT INTO {records} (metric_id, timestamp, value, metric_name)
+                SELECT metric_id, timestamp, value, metric_name FROM {SOURCE_TABLE}
+                ON CONFLICT (metric_id, timestamp) {conflict}
+                RETURNING id, metric_id, timestamp
+            )
+            INSERT INTO {MERGED_TABLE}
+            SELECT merged.id, merged.metric_id, merged.timestamp, old.timestamp IS NULL
+            FROM merged LEFT JOIN old USING (metric_id, timestamp)
+            """)
+
+        # У перезаписанных записей теги заменяются загруженными
+        cursor.execute(f"""
+            DELETE FROM {through} WHERE record_id IN (
+                SELECT record_id FROM {MERGED_TABLE} WHERE NOT inserted
+            )
+            """)
+        cursor.execute(f"""
+            INSERT INTO {tags} (name)
+            SELECT DISTINCT unnest(s.tags)
+            FROM {SOURCE_TABLE} s
+            JOIN {MERGED_TABLE} r USING (metric_id, timestamp)
+            ON CONFLICT (name) DO NOTHING
+            """)
+        tags_created = cursor.rowcount
+        cursor.execute(f"""
+            INSERT INTO {through} (record_id, tag_id)
+            SELECT DISTINCT r.record_id, t.id
+            FROM {MERGED_TABLE} r
+            JOIN {SOURCE_TABLE} s USING (metric_id, timestamp)
+            CROSS JOIN LATERAL unnest(s.tags) AS tag_name
+            JOIN {tags} t ON t.name = tag_name
+            ON CONFLICT (record_id, tag_id) DO NOTHING
+            """)
+
+        cursor.execute(
+            f"SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) "
+            f"FROM {MERGED_TABLE}"
+        )
+        inserted, updated = cursor.fetchone()
+        return {
+            "unknown_metric": unknown_metric,
+            "inserted": inserted,
+            "updated": updated,
+            "skipped": source_count - inserted - updated,
+            "tags_created": tags_created,
+        }
+
+    def finish(self, cursor) -> list[int]:
+        """Пересчитывает агрегаты затронутых диапазонов, возвращает ID метрик."""
+        cursor.execute(f"""
+            SELECT metric_id, min(timestamp), max(timestamp)
+            FROM {MERGED_TABLE}
+            GROUP BY metric_id
+            """)
+        affected = cursor.fetchall()
+        for metric_id, from_ts, to_ts in affected:
+            rebuild_rollups(metric_id, from_ts, to_ts)
+
+        cursor.execute(f"DROP TABLE {STAGING_TABLE}, {SOURCE_TABLE}, {MERGED_TABLE}")
+        return [metric_id for metric_id, _, _ in affected]
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from metrics.partitions import ensure_partitions, partition_metric_records
+
+
+class Command(BaseCommand):
+    help = (
+        "Переводит таблицу записей метрик в секционированную по timestamp "
+        "и создаёт секции на будущие периоды."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            help="Сколько периодов вперёд создать (по умолчанию "
+            "METRIC_RECORDS_PARTITIONS_AHEAD)",
+        )
+
+    def handle(self, *args, **options):
+        if partition_metric_records(ahead=options["ahead"]):
+            self.stdout.write(self.style.SUCCESS("Таблица секционирована."))
+        else:
+            self.stdout.write("Таблица уже секционирована.")
+        created = ensure_partitions(ahead=options["ahead"])
+        self.stdout.write(f"Создано секций: {len(created)}")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from metrics.archive import restore_chunks
+from metrics.models import MetricRecordChunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Возвращает записи из архивных чанков в таблицу записей. "
+        "Нужна перед выключением архива (METRIC_ARCHIVE_AFTER_DAYS=0)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "metric_ids",
+            nargs="*",
+            type=int,
+            help="ID метрик (по умолчанию все)",
+        )
+
+    def handle(self, *args, **options):
+        chunks = MetricRecordChunk.objects.all()
+        if options["metric_ids"]:
+            chunks = chunks.filter(metric_id__in=options["metric_ids"])
+
+        restored = 0
+        # По чанку в транзакции, чтобы не держать блокировки на весь архив
+        for chunk_id in chunks.values_list("id", flat=True).iterator():
+            restored += restore_chunks(MetricRecordChunk.objects.filter(pk=chunk_id))
+        self.stdout.write(self.style.SUCCESS(f"Восстановлено записей: {restored}"))
@@ -0,0 +1,197 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from metrics.cache import (
+    invalidate_metric_cache,
+    invalidate_tags_cache,
+    invalidate_user_metrics,
+)
+from metrics.models import Metric, MetricRecord, Tag, TagsMetricRecord
+from metrics.rollups import rebuild_rollups
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Генерирует синтетические данные для нагрузочных замеров: пользователей, "
+        "метрики, теги и записи. Одни и те же параметры дают одни и те же данные, "
+        "повторный запуск ничего не дублирует."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1, help="Число пользователей")
+        parser.add_argument(
+            "--metrics", type=int, default=10, help="Метрик на пользователя"
+        )
+        parser.add_argument("--tags", type=int, default=20, help="Число тегов")
+        parser.add_argument(
+            "--records", type=int, default=100_000, help="Записей на метрику"
+        )
+        parser.add_argument(
+            "--tags-per-record",
+            type=int,
+            default=2,
+            help="Тегов у каждой записи (0 - без тегов)",
+        )
+        parser.add_argument(
+            "--start",
+            type=int,
+            default=1700000000,
+            help="timestamp первой записи",
+        )
+        parser.add_argument(
+            "--step", type=int, default=60, help="Шаг между записями, секунд"
+        )
+        parser.add_argument(
+            "--prefix",
+            default="seed",
+            help="Префикс имён пользователей, метрик и тегов",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100_000,
+            help="Записей в одном INSERT (каждый - отдельная транзакция)",
+        )
+        parser.add_argument(
+            "--no-rollups",
+            action="store_true",
+            help="Не пересчитывать агрегаты MetricRollup после генерации",
+        )
+
+    def handle(self, *args, **options):
+        for option in ("users", "metrics", "records", "step", "batch_size"):
+            if options[option] <= 0:
+                raise CommandError(f"--{option.replace('_', '-')} должен быть > 0")
+        if options["tags_per_record"] > options["tags"]:
+            raise CommandError("--tags-per-record не может быть больше --tags")
+
+        started = time.monotonic()
+        prefix = options["prefix"]
+        users = self.seed_users(prefix, options["users"])
+        metrics = self.seed_metrics(prefix, users, options["metrics"])
+        tag_ids = self.seed_tags(prefix, options["tags"])
+
+        inserted = 0
+        for index, metric in enumerate(metrics):
+            inserted += self.seed_records(metric, index, tag_ids, options)
+            if not options["no_rollups"]:
+                rebuild_rollups(metric.id)
+            invalidate_metric_cache(metric.id)
+            self.stdout.write(
+                f"Метрика {metric.name}: {index + 1}/{len(metrics)}, "
+                f"добавлено записей {inserted}"
+            )
+
+        with connection.cursor() as cursor:
+            for model in (MetricRecord, TagsMetricRecord):
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+        for user in users:
+            invalidate_user_metrics(user.id)
+        invalidate_tags_cache()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Готово за {elapsed:.1f} c: пользователей {len(users)}, "
+                f"метрик {len(metrics)}, тегов {len(tag_ids)}, "
+                f"добавлено записей {inserted} ({inserted / max(elapsed, 1e-9):.0f} строк/с)"
+            )
+        )
+
+    @staticmethod
+    def seed_users(prefix: str, count: int) -> list:
+        usernames = [f"{prefix}-user-{i}" for i in range(count)]
+        existing = set(
+            User.objects.filter(username__in=usernames).values_list(
+                "username", flat=True
+            )
+        )
+        new_users = []
+        for username in usernames:
+            if username not in existing:
+                user = User(username=username)
+                user.set_unusable_password()
+                new_users.append(user)
+        User.objects.bulk_create(new_users)
+        return list(User.objects.filter(username__in=usernames).order_by("username"))
+
+    @staticmethod
+    def seed_metrics(prefix: str, users: list, count: int) -> list[Metric]:
+        Metric.objects.bulk_create(
+            (
+                Metric(name=f"{prefix}-metric-{i}", author=user)
+                for user in users
+                for i in range(count)
+            ),
+            ignore_conflicts=True,
+        )
+        return list(
+            Metric.objects.active()
+            .filter(author__in=users, name__startswith=f"{prefix}-metric-")
+            .order_by("author__username", "id")
+        )
+
+    @staticmethod
+    def seed_tags(prefix: str, count: int) -> list[int]:
+        names = [f"{prefix}-tag-{i}" for i in range(count)]
+        Tag.objects.bulk_create(
+            (Tag(name=name) for name in names), ignore_conflicts=True
+        )
+        tags = Tag.objects.in_bulk(names, field_name="name")
+        return [tags[name].id for name in names]
+
+    @staticmethod
+    def seed_records(metric: Metric, index: int, tag_ids: list[int], options) -> int:
+        """
+        Записи метрики пачками по batch_size. Значение - синусоида с
+        детерминированным шумом, теги выбираются по номеру записи.
+        """
+        records = MetricRecord._meta.db_table
+        through = TagsMetricRecord._meta.db_table
+        start, step = options["start"], options["step"]
+        inserted = 0
+        for first in range(0, options["records"], options["batch_size"]):
+            last = min(first + options["batch_size"], options["records"])
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {records} (metric_id, metric_name, timestamp, value)
+                    SELECT %s, %s, %s + n * %s,
+                           round((100 + 50 * sin(n / 60.0)
+                                  + (n * 7919 + %s * 104729) %% 1000 / 100.0)::numeric, 4)
+                    FROM generate_series(%s, %s - 1) AS n
+                    ON CONFLICT DO NOTHING
+                    """,
+                    [metric.id, metric.name, start, step, index, first, last],
+                )
+                inserted += cursor.rowcount
+                if options["tags_per_record"]:
+                    cursor.execute(
+                        f"""
+                        INSERT INTO {through} (record_id, tag_id)
+                        SELECT DISTINCT r.id, (%s::bigint[])[
+                            1 + ((r.timestamp - %s) / %s * 31 + k * 17) %% %s
+                        ]
+                        FROM {records} r
+                        CROSS JOIN generate_series(0, %s - 1) AS k
+                        WHERE r.metric_id = %s
+                          AND r.timestamp >= %s AND r.timestamp < %s
+                        ON CONFLICT DO NOTHING
+                        """,
+                        [
+                            tag_ids,
+                            start,
+                            step,
+                            len(tag_ids),
+                            options["tags_per_record"],
+                            metric.id,
+                            start + first * step,
+                            start + last * step,
+                        ],
+                    )
+        return inserted
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.10 on 2026-10-18 11:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BACKFILL_SQL = """
+INSERT INTO metrics_metricrollup (metric_id, resolution, bucket, count, sum, min, max)
+SELECT metric_id, {resolution}, timestamp - timestamp % {resolution},
+       count(*), sum(value), min(value), max(value)
+FROM metrics_metricrecord
+GROUP BY metric_id, timestamp - timestamp % {resolution}
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0002_alter_metricrecord_timestamp"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "resolution",
+                    models.PositiveIntegerField(
+                        choices=[(60, "Минута"), (3600, "Час"), (86400, "Сутки")],
+                        verbose_name="Интервал",
+                    ),
+                ),
+                ("bucket", models.BigIntegerField(verbose_name="Начало интервала")),
+                ("count", models.BigIntegerField(verbose_name="Количество")),
+                (
+                    "sum",
+                    models.DecimalField(
+                        decimal_places=4, max_digits=32, verbose_name="Сумма"
+                    ),
+                ),
+                (
+                    "min",
+                    models.DecimalField(
+                        decimal_places=4, max_digits=16, verbose_name="Минимум"
+                    ),
+                ),
+                (
+                    "max",
+                    models.DecimalField(
+                        decimal_places=4, max_digits=16, verbose_name="Максимум"
+                    ),
+                ),
+                (
+                    "metric",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rollups",
+                        to="metrics.metric",
+                        verbose_name="Метрика",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Агрегат метрики",
+                "verbose_name_plural": "Агрегаты метрик",
+                "unique_together": {("metric", "resolution", "bucket")},
+            },
+        ),
+        migrations.RunSQL(
+            [
+                BACKFILL_SQL.format(resolution=resolution)
+                for resolution in (60, 3600, 86400)
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.10 on 2026-10-18 11:55
+
+import django.db.models.deletion
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Индекс строится без блокировки записи в таблицу связей
+    atomic = False
+
+    dependencies = [
+        ("metrics", "0003_metricrollup"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="tagsmetricrecord",
+            index=models.Index(fields=["tag", "record"], name="metrics_tag_record_idx"),
+        ),
+        # Старый индекс по tag удаляется, когда новый уже готов
+        migrations.AlterField(
+            model_name="tagsmetricrecord",
+            name="tag",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="metrics.tag",
+            ),
+        ),
+    ]
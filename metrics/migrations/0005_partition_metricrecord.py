@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 12:40
+
+from django.conf import settings
+from django.db import migrations
+
+from metrics.partitions import partition_metric_records
+
+
+def partition(apps, schema_editor):
+    """Секционирование включается настройкой METRIC_RECORDS_PARTITIONING."""
+    if settings.METRIC_RECORDS_PARTITIONING:
+        partition_metric_records()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0004_tagsmetricrecord_tag_record_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, migrations.RunPython.noop),
+    ]
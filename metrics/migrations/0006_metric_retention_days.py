@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0005_partition_metricrecord"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="metric",
+            name="retention_days",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Пусто - общий срок METRIC_RECORDS_RETENTION_DAYS, 0 - хранить всегда",
+                null=True,
+                verbose_name="Срок хранения записей, дней",
+            ),
+        ),
+    ]
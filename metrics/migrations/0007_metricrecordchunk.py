@@ -0,0 +1,59 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:40
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0006_metric_retention_days"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricRecordChunk",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start", models.BigIntegerField(verbose_name="Начало окна")),
+                ("end", models.BigIntegerField(verbose_name="Конец окна")),
+                (
+                    "count",
+                    models.PositiveIntegerField(verbose_name="Количество записей"),
+                ),
+                (
+                    "tags",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.BigIntegerField(),
+                        default=list,
+                        size=None,
+                        verbose_name="Теги",
+                    ),
+                ),
+                ("data", models.BinaryField(verbose_name="Данные")),
+                (
+                    "metric",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="record_chunks",
+                        to="metrics.metric",
+                        verbose_name="Метрика",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Архив записей метрики",
+                "verbose_name_plural": "Архив записей метрик",
+                "unique_together": {("metric", "start")},
+            },
+        ),
+    ]
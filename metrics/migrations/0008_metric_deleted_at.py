@@ -0,0 +1,37 @@
+# Generated by Django 5.2.10 on 2026-10-18 14:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("metrics", "0007_metricrecordchunk"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="metric",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="metric",
+            name="deleted_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Метрика скрыта из API, её записи удаляются в фоне",
+                null=True,
+                verbose_name="Удалено",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="metric",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("deleted_at__isnull", True)),
+                fields=("author", "name"),
+                name="metrics_metric_author_name_uniq",
+            ),
+        ),
+    ]
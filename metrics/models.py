@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import models, transaction
 
 from metrics.validators import validate_unix_timestamp
 
@@ -26,6 +27,12 @@ class Tag(models.Model):
         return self.name
 
 
+class MetricQuerySet(models.QuerySet):
+    def active(self) -> "MetricQuerySet":
+        """Метрики без пометки об удалении."""
+        return self.filter(deleted_at__isnull=True)
+
+
 class Metric(models.Model):
     name = models.CharField(
         verbose_name="Имя",
@@ -43,11 +50,32 @@ class Metric(models.Model):
     author = models.ForeignKey(
         User, verbose_name="Автор", on_delete=models.DO_NOTHING, related_name="metrics"
     )
+    retention_days = models.PositiveIntegerField(
+        verbose_name="Срок хранения записей, дней",
+        blank=True,
+        null=True,
+        help_text="Пусто - общий срок METRIC_RECORDS_RETENTION_DAYS, 0 - хранить всегда",
+    )
+    deleted_at = models.DateTimeField(
+        verbose_name="Удалено",
+        blank=True,
+        null=True,
+        help_text="Метрика скрыта из API, её записи удаляются в фоне",
+    )
+
+    objects = MetricQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Метрика"
         verbose_name_plural = "Метрики"
-        unique_together = ("author", "name")
+        constraints = [
+            # Имя удалённой метрики свободно, пока удаляются её записи
+            models.UniqueConstraint(
+                fields=("author", "name"),
+                condition=models.Q(deleted_at__isnull=True),
+                name="metrics_metric_author_name_uniq",
+            ),
+        ]
 
     def __str__(self) -> str:
         return f"{self.name}"
@@ -99,7 +127,11 @@ class MetricRecord(models.Model):
     def save(self, *args, **kwargs):
         if self.pk is None:
             self.metric_name = self.metric.name
-        super().save(*args, **kwargs)
+        # pre_save распаковывает архивное окно под блокировкой метрики до конца
+        # транзакции: в autocommit она снималась бы до записи, и архивация
+        # успела бы упаковать окно с этой записью повторно
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
 
 class TagsMetricRecord(models.Model):
@@ -107,8 +139,89 @@ class TagsMetricRecord(models.Model):
     Связь Tag и MetricRecord.
     """
 
-    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    # Отдельный индекс по tag не нужен: его покрывает индекс (tag, record)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, db_index=False)
     record = models.ForeignKey(MetricRecord, on_delete=models.CASCADE)
 
     class Meta:
         unique_together = ("record", "tag")
+        indexes = [
+            # Поиск записей по тегу: фильтры tags/tags_all и метрики с тегом
+            models.Index(fields=("tag", "record"), name="metrics_tag_record_idx"),
+        ]
+
+
+class MetricRecordChunk(models.Model):
+    """
+    Сжатые записи метрики за закрытое окно времени [start, end).
+    Упаковываются и читаются в ./archive.py
+    """
+
+    metric = models.ForeignKey(
+        Metric,
+        verbose_name="Метрика",
+        on_delete=models.CASCADE,
+        related_name="record_chunks",
+    )
+    start = models.BigIntegerField(verbose_name="Начало окна")
+    end = models.BigIntegerField(verbose_name="Конец окна")
+    count = models.PositiveIntegerField(verbose_name="Количество записей")
+    # Все теги записей чанка: фильтр по тегам пропускает чанк без распаковки
+    tags = ArrayField(models.BigIntegerField(), verbose_name="Теги", default=list)
+    data = models.BinaryField(verbose_name="Данные")
+
+    class Meta:
+        verbose_name = "Архив записей метрики"
+        verbose_name_plural = "Архив записей метрик"
+        unique_together = ("metric", "start")
+
+    def __str__(self) -> str:
+        return f"{self.metric_id}: {self.count} @ [{self.start}, {self.end})"
+
+
+class MetricRollup(models.Model):
+    """
+    Предагрегированные записи метрики за минуту/час/сутки.
+    Обновляются инкрементально при создании записей, см. ./rollups.py
+    """
+
+    class Resolution(models.IntegerChoices):
+        MINUTE = 60, "Минута"
+        HOUR = 60 * 60, "Час"
+        DAY = 24 * 60 * 60, "Сутки"
+
+    metric = models.ForeignKey(
+        Metric,
+        verbose_name="Метрика",
+        on_delete=models.CASCADE,
+        related_name="rollups",
+    )
+    resolution = models.PositiveIntegerField(
+        verbose_name="Интервал",
+        choices=Resolution.choices,
+    )
+    bucket = models.BigIntegerField(verbose_name="Начало интервала")
+    count = models.BigIntegerField(verbose_name="Количество")
+    sum = models.DecimalField(
+        verbose_name="Сумма",
+        max_digits=32,
+        decimal_places=4,
+    )
+    min = models.DecimalField(
+        verbose_name="Минимум",
+        max_digits=16,
+        decimal_places=4,
+    )
+    max = models.DecimalField(
+        verbose_name="Максимум",
+        max_digits=16,
+        decimal_places=4,
+    )
+
+    class Meta:
+        verbose_name = "Агрегат метрики"
+        verbose_name_plural = "Агрегаты метрик"
+        unique_together = ("metric", "resolution", "bucket")
+
+    def __str__(self) -> str:
+        return f"{self.metric_id}/{self.resolution}s @ {self.bucket}"
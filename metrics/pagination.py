@@ -0,0 +1,104 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import islice
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from metrics.archive import merge_rows
+
+
+class MetricRecordCursorPagination(BasePagination):
+    """
+    Keyset-пагинация записей метрики по (timestamp, id) от новых к старым.
+    Курсор хранит позицию последней записи страницы, поэтому стоимость
+    запроса не зависит от глубины страницы.
+
+    Если у view есть get_archived_rows(descending, before), страница
+    собирается из записей таблицы и архивных чанков.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    invalid_cursor_message = "Неверный курсор."
+    ordering = ("-timestamp", "-id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            timestamp, record_id = position
+            queryset = queryset.filter(timestamp__lte=timestamp).exclude(
+                timestamp=timestamp, id__gte=record_id
+            )
+
+        rows = queryset.order_by(*self.ordering)[: self.page_size + 1]
+        get_archived_rows = getattr(view, "get_archived_rows", None)
+        archived = (
+            get_archived_rows(descending=True, before=position)
+            if get_archived_rows
+            else None
+        )
+        if archived is not None:
+            rows = merge_rows(rows, archived, descending=True)
+        page = list(islice(rows, self.page_size + 1))
+        self.has_next = len(page) > self.page_size
+        page = page[: self.page_size]
+        self.next_position = self.get_position(page[-1]) if self.has_next else None
+        return page
+
+    @staticmethod
+    def get_position(row) -> tuple[int, int]:
+        """(timestamp, id) записи - модели или словаря из values()."""
+        if isinstance(row, dict):
+            return row["timestamp"], row["id"]
+        return row.timestamp, row.id
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request) -> int:
+        max_page_size = settings.METRIC_RECORDS_MAX_PAGE_SIZE
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return min(settings.METRIC_RECORDS_PAGE_SIZE, max_page_size)
+        if page_size <= 0:
+            return min(settings.METRIC_RECORDS_PAGE_SIZE, max_page_size)
+        return min(page_size, max_page_size)
+
+    def get_next_link(self) -> str | None:
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(*self.next_position)
+        )
+
+    @staticmethod
+    def encode_cursor(timestamp: int, record_id: int) -> str:
+        return urlsafe_b64encode(f"{timestamp}:{record_id}".encode()).decode()
+
+    def decode_cursor(self, request) -> tuple[int, int] | None:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            timestamp, record_id = urlsafe_b64decode(encoded.encode()).split(b":")
+            return int(timestamp), int(record_id)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
@@ -0,0 +1,268 @@
+"""
+Декларативное секционирование таблицы MetricRecord по timestamp.
+
+Таблица делится на секции по диапазонам timestamp (сутки/неделя/месяц по UTC,
+METRIC_RECORDS_PARTITION_INTERVAL), записи вне созданных секций попадают в
+секцию по умолчанию. Запросы с границами по времени читают только нужные
+секции (partition pruning).
+
+Ограничения PostgreSQL для секционированной таблицы:
+ - первичный ключ - (id, timestamp), id по-прежнему уникален за счёт sequence;
+ - внешний ключ TagsMetricRecord.record на такую таблицу невозможен и
+   удаляется, связи удаляются ORM (on_delete=CASCADE) или явно в SQL.
+"""
+
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Имена таблиц заданы строками: модуль используется в миграциях
+RECORDS_TABLE = "metrics_metricrecord"
+THROUGH_TABLE = "metrics_tagsmetricrecord"
+UNPARTITIONED_TABLE = f"{RECORDS_TABLE}_unpartitioned"
+DEFAULT_PARTITION = f"{RECORDS_TABLE}_default"
+ID_SEQUENCE = f"{RECORDS_TABLE}_id_seq"
+# Имена ограничений совпадают с созданными Django для несекционированной таблицы
+PRIMARY_KEY = f"{RECORDS_TABLE}_pkey"
+UNIQUE_METRIC_TIMESTAMP = f"{RECORDS_TABLE}_metric_id_timestamp_fd21a80d_uniq"
+METRIC_FOREIGN_KEY = f"{RECORDS_TABLE}_metric_id_7c98ae26_fk_metrics_metric_id"
+
+INTERVALS = ("day", "week", "month")
+PARTITION_BOUND_RE = re.compile(
+    r"FROM \('?(?P<start>-?\d+)'?\) TO \('?(?P<end>-?\d+)'?\)"
+)
+
+
+def _period_start(moment: datetime, interval: str) -> datetime:
+    """Начало периода секции, как date_trunc в PostgreSQL (неделя - с понедельника)."""
+    start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "week":
+        start -= timedelta(days=start.weekday())
+    elif interval == "month":
+        start = start.replace(day=1)
+    return start
+
+
+def _next_period(start: datetime, interval: str) -> datetime:
+    if interval == "month":
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + timedelta(days=7 if interval == "week" else 1)
+
+
+def _interval() -> str:
+    interval = settings.METRIC_RECORDS_PARTITION_INTERVAL
+    if interval not in INTERVALS:
+        raise ValueError(
+            f"METRIC_RECORDS_PARTITION_INTERVAL должен быть одним из {INTERVALS}, "
+            f"получено {interval!r}."
+        )
+    return interval
+
+
+def partition_bounds(timestamp: int) -> tuple[int, int]:
+    """Границы [начало, конец) секции, в которую попадает timestamp."""
+    interval = _interval()
+    start = _period_start(datetime.fromtimestamp(timestamp, timezone.utc), interval)
+    return int(start.timestamp()), int(_next_period(start, interval).timestamp())
+
+
+def partition_name(start: int) -> str:
+    day = datetime.fromtimestamp(start, timezone.utc)
+    return f"{RECORDS_TABLE}_p{day:%Y%m%d}"
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+            "WHERE partrelid = to_regclass(%s))",
+            [RECORDS_TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def existing_partitions() -> set[str]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = to_regclass(%s)",
+            [RECORDS_TABLE],
+        )
+        return {name for (name,) in cursor.fetchall()}
+
+
+def partition_ranges() -> dict[str, tuple[int, int]]:
+    """Секции с их границами [начало, конец), без секции по умолчанию."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            """,
+            [RECORDS_TABLE],
+        )
+        rows = cursor.fetchall()
+    ranges = {}
+    for name, bound in rows:
+        match = PARTITION_BOUND_RE.search(bound)
+        if match:
+            ranges[name] = (int(match["start"]), int(match["end"]))
+    return ranges
+
+
+def _create_partition(cursor, start: int, end: int) -> str:
+    """
+    Создаёт секцию [start, end). Записи этого диапазона, уже попавшие в
+    секцию по умолчанию, переносятся в неё - иначе PostgreSQL не даст
+    подключить секцию.
+    """
+    name = partition_name(start)
+    cursor.execute(
+        f"CREATE TABLE {name} (LIKE {RECORDS_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+    )
+    cursor.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE timestamp >= %s AND timestamp < %s
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """,
+        [start, end],
+    )
+    cursor.execute(
+        f"ALTER TABLE {RECORDS_TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM (%s) TO (%s)",
+        [start, end],
+    )
+    return name
+
+
+def _future_periods(ahead: int, now: int | None = None) -> list[tuple[int, int]]:
+    """Текущий период и ahead следующих."""
+    start, end = partition_bounds(int(time.time()) if now is None else now)
+    periods = [(start, end)]
+    for _ in range(ahead):
+        periods.append(partition_bounds(periods[-1][1]))
+    return periods
+
+
+def ensure_partitions(ahead: int | None = None, now: int | None = None) -> list[str]:
+    """
+    Заранее создаёт секции на текущий и ahead следующих периодов
+    (METRIC_RECORDS_PARTITIONS_AHEAD). Возвращает имена созданных секций.
+    Ничего не делает, если таблица не секционирована.
+    """
+    if not is_partitioned():
+        return []
+    if ahead is None:
+        ahead = settings.METRIC_RECORDS_PARTITIONS_AHEAD
+
+    existing = existing_partitions()
+    created = []
+    for start, end in _future_periods(ahead, now):
+        if partition_name(start) in existing:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            created.append(_create_partition(cursor, start, end))
+    if created:
+        logger.info(f"Созданы секции записей метрик: {', '.join(created)}")
+    return created
+
+
+def partition_metric_records(ahead: int | None = None) -> bool:
+    """
+    Переводит MetricRecord в секционированную таблицу с переносом данных.
+    Секции создаются на периоды, где есть записи, и на ahead периодов вперёд.
+    Таблица блокируется на всё время переноса. Возвращает False, если
+    таблица уже секционирована или БД не PostgreSQL.
+    """
+    if connection.vendor != "postgresql" or is_partitioned():
+        return False
+    if ahead is None:
+        ahead = settings.METRIC_RECORDS_PARTITIONS_AHEAD
+    interval = _interval()
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Отложенные проверки внешних ключей не дают менять таблицы
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(f"LOCK TABLE {RECORDS_TABLE} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {RECORDS_TABLE} RENAME TO {UNPARTITIONED_TABLE}")
+        cursor.execute(
+            f"CREATE TABLE {RECORDS_TABLE} "
+            f"(LIKE {UNPARTITIONED_TABLE} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE (timestamp)"
+        )
+        cursor.execute(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {RECORDS_TABLE} DEFAULT"
+        )
+
+        cursor.execute(
+            f"""
+            SELECT DISTINCT extract(epoch FROM
+                date_trunc(%s, to_timestamp(timestamp) AT TIME ZONE 'UTC')
+                AT TIME ZONE 'UTC')::bigint
+            FROM {UNPARTITIONED_TABLE}
+            """,
+            [interval],
+        )
+        starts = {start for (start,) in cursor.fetchall()}
+        periods = {partition_bounds(start) for start in starts}
+        periods.update(_future_periods(ahead))
+        for start, end in sorted(periods):
+            _create_partition(cursor, start, end)
+
+        cursor.execute(
+            f"INSERT INTO {RECORDS_TABLE} SELECT * FROM {UNPARTITIONED_TABLE}"
+        )
+
+        # Внешний ключ связей с тегами ссылается на старую таблицу
+        cursor.execute(
+            """
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = to_regclass(%s) AND confrelid = to_regclass(%s)
+            """,
+            [THROUGH_TABLE, UNPARTITIONED_TABLE],
+        )
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {THROUGH_TABLE} DROP CONSTRAINT {name}")
+        cursor.execute(f"DROP TABLE {UNPARTITIONED_TABLE}")
+
+        cursor.execute(
+            f"ALTER TABLE {RECORDS_TABLE} "
+            f"ADD CONSTRAINT {PRIMARY_KEY} PRIMARY KEY (id, timestamp)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {RECORDS_TABLE} ADD CONSTRAINT {UNIQUE_METRIC_TIMESTAMP} "
+            f"UNIQUE (metric_id, timestamp)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {RECORDS_TABLE} ADD CONSTRAINT {METRIC_FOREIGN_KEY} "
+            f"FOREIGN KEY (metric_id) REFERENCES metrics_metric (id) "
+            f"DEFERRABLE INITIALLY DEFERRED"
+        )
+        cursor.execute(f"CREATE SEQUENCE {ID_SEQUENCE} OWNED BY {RECORDS_TABLE}.id")
+        cursor.execute(
+            f"SELECT setval(%s, coalesce(max(id), 0) + 1, false) FROM {RECORDS_TABLE}",
+            [ID_SEQUENCE],
+        )
+        cursor.execute(
+            f"ALTER TABLE {RECORDS_TABLE} "
+            f"ALTER COLUMN id SET DEFAULT nextval('{ID_SEQUENCE}')"
+        )
+        cursor.execute(f"ANALYZE {RECORDS_TABLE}")
+
+    logger.info("Таблица записей метрик секционирована")
+    return True
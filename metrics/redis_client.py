@@ -0,0 +1,19 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> redis.Redis:
+    """
+    Клиент Redis для структур, которых нет в API кеша Django (списки, хеши).
+    Один пул соединений на процесс.
+    """
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+@lru_cache(maxsize=1)
+def get_broker_redis() -> redis.Redis:
+    """Клиент Redis брокера Celery: очереди - списки с именами очередей."""
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL)
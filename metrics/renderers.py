@@ -0,0 +1,64 @@
+import csv
+import json
+from typing import Iterable, Iterator
+
+from rest_framework.renderers import BaseRenderer
+
+
+class _Echo:
+    """Псевдо-буфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+class StreamingRenderer(BaseRenderer):
+    """
+    Рендерер, который умеет отдавать строки по одной (stream) для
+    StreamingHttpResponse. render нужен для обычных ответов, например ошибок.
+    """
+
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data if isinstance(data, list) else [data]
+        return "".join(self.stream(rows)).encode(self.charset)
+
+    def stream(
+        self, rows: Iterable[dict], fields: Iterable[str] | None = None
+    ) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class CSVRenderer(StreamingRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+    def stream(
+        self, rows: Iterable[dict], fields: Iterable[str] | None = None
+    ) -> Iterator[str]:
+        writer = csv.writer(_Echo())
+        header_written = fields is not None
+        if header_written:
+            yield writer.writerow(fields)
+        for row in rows:
+            if not header_written:
+                yield writer.writerow(row.keys())
+                header_written = True
+            yield writer.writerow(
+                [
+                    "|".join(map(str, value)) if isinstance(value, list) else value
+                    for value in row.values()
+                ]
+            )
+
+
+class NDJSONRenderer(StreamingRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def stream(
+        self, rows: Iterable[dict], fields: Iterable[str] | None = None
+    ) -> Iterator[str]:
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
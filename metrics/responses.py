@@ -0,0 +1,87 @@
+import gzip
+import re
+from hashlib import md5
+from typing import NamedTuple
+
+from django.http import HttpResponse
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
+
+GZIP_COMPRESS_LEVEL = 6
+ACCEPTS_GZIP_RE = re.compile(r"\bgzip\b")
+
+
+class RenderedJSON(NamedTuple):
+    """Готовое тело JSON-ответа в gzip и его ETag. Так ответ лежит в кеше."""
+
+    etag: str
+    body: bytes
+
+
+def render_json(data) -> RenderedJSON:
+    """Рендерит данные так же, как JSONRenderer в Response, и сжимает их."""
+    content = JSONRenderer().render(data)
+    return RenderedJSON(
+        etag=f'"{md5(content, usedforsecurity=False).hexdigest()}"',
+        # mtime=0 - одинаковые данные дают одинаковые байты
+        body=gzip.compress(content, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0),
+    )
+
+
+class Validators(NamedTuple):
+    """Валидаторы условного GET, посчитанные по версии данных без их чтения."""
+
+    etag: str
+    last_modified: int
+    version: int
+
+    @classmethod
+    def for_version(cls, version: int, *scope: object) -> "Validators":
+        """version - время изменения в мс (см. metrics.cache.get_version)."""
+        tag = "-".join(str(part) for part in (*scope, version))
+        return cls(etag=f'W/"{tag}"', last_modified=version // 1000, version=version)
+
+    def not_modified(self, request) -> HttpResponse | None:
+        """
+        304, если у клиента актуальная версия, иначе None. If-Modified-Since
+        точен до секунды и учитывается, только если версия - целая секунда:
+        иначе изменение в ту же секунду, что и прошлая версия, осталось бы
+        незамеченным. ETag сравнивается всегда.
+        """
+        exact = self.version % 1000 == 0
+        response = get_conditional_response(
+            request,
+            etag=self.etag,
+            last_modified=self.last_modified if exact else None,
+        )
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def apply(self, response) -> None:
+        response["ETag"] = self.etag
+        response["Last-Modified"] = http_date(self.last_modified)
+        # Ответ у каждого пользователя свой, браузер должен проверять его заново
+        patch_cache_control(response, private=True, no_cache=True)
+
+
+def rendered_json_response(request, rendered: RenderedJSON) -> HttpResponse:
+    """
+    Отдаёт закешированное тело без повторного рендеринга. Клиентам без
+    поддержки gzip тело распаковывается.
+    """
+    if ACCEPTS_GZIP_RE.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        response = HttpResponse(rendered.body, content_type="application/json")
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(
+            gzip.decompress(rendered.body), content_type="application/json"
+        )
+    response["ETag"] = rendered.etag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
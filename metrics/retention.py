@@ -0,0 +1,279 @@
+"""
+Удаление записей метрик старше срока хранения.
+
+Срок - Metric.retention_days, а если он не задан - METRIC_RECORDS_RETENTION_DAYS,
+0 - хранить всегда. Записи удаляются пачками по METRIC_RETENTION_BATCH_SIZE,
+каждая пачка - отдельная короткая транзакция, между пачками пауза
+METRIC_RETENTION_BATCH_PAUSE. Секции секционированной таблицы, которые целиком
+старше срока всех метрик, отсоединяются (DETACH PARTITION) и удаляются
+DROP TABLE. Просроченные записи удаляются и из архивных чанков. Агрегаты
+MetricRollup остаются.
+
+Метрики, помеченные удалёнными (Metric.deleted_at), удаляются целиком теми
+же пачками (purge_deleted_metric).
+"""
+
+import logging
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+
+from metrics.archive import purge_archived_records
+from metrics.cache import invalidate_metric_cache
+from metrics.models import (
+    Metric,
+    MetricRecord,
+    MetricRecordChunk,
+    MetricRollup,
+    TagsMetricRecord,
+)
+from metrics.partitions import RECORDS_TABLE, is_partitioned, partition_ranges
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+# Сколько DETACH PARTITION без CONCURRENTLY ждёт блокировку таблицы записей:
+# в очереди за долгим запросом он остановил бы все чтения и записи
+DETACH_LOCK_TIMEOUT = "5s"
+
+
+def retention_cutoffs(now: int) -> dict[int, int | None]:
+    """{id метрики: timestamp, раньше которого записи удаляются}; None - хранить всегда."""
+    metrics = Metric.objects.annotate(
+        days=Coalesce("retention_days", Value(settings.METRIC_RECORDS_RETENTION_DAYS))
+    ).values_list("id", "days")
+    return {
+        metric_id: now - days * DAY if days else None for metric_id, days in metrics
+    }
+
+
+def _delete_batch(metric_id: int, cutoff: int | None, batch_size: int) -> int:
+    """
+    Удаляет до batch_size самых старых записей раньше cutoff
+    (None - любых) вместе со связями.
+    """
+    records = MetricRecord._meta.db_table
+    through = TagsMetricRecord._meta.db_table
+    condition, params = "metric_id = %s", [metric_id]
+    if cutoff is not None:
+        condition, params = f"{condition} AND timestamp < %s", [metric_id, cutoff]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH batch AS (
+                SELECT id FROM {records}
+                WHERE {condition}
+                ORDER BY timestamp
+                LIMIT %s
+            ), links AS (
+                DELETE FROM {through} WHERE record_id IN (SELECT id FROM batch)
+            )
+            DELETE FROM {records}
+            WHERE {condition} AND id IN (SELECT id FROM batch)
+            """,
+            [*params, batch_size, *params],
+        )
+        return cursor.rowcount
+
+
+def _delete_rollups_batch(metric_id: int, batch_size: int) -> int:
+    rollups = MetricRollup._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            DELETE FROM {rollups} WHERE id IN (
+                SELECT id FROM {rollups} WHERE metric_id = %s LIMIT %s
+            )
+            """,
+            [metric_id, batch_size],
+        )
+        return cursor.rowcount
+
+
+def _detach_partition(cursor, name: str) -> bool:
+    """
+    Отсоединяет секцию от таблицы записей. DETACH CONCURRENTLY не блокирует
+    чтение и запись, но PostgreSQL не разрешает его внутри транзакции и при
+    секции по умолчанию; тогда обычный DETACH ждёт блокировку не дольше
+    DETACH_LOCK_TIMEOUT. False - блокировку не дождались.
+    """
+    cursor.execute(
+        """
+        SELECT i.inhdetachpending, p.partdefid <> 0
+        FROM pg_inherits i JOIN pg_partitioned_table p ON p.partrelid = i.inhparent
+        WHERE i.inhrelid = to_regclass(%s)
+        """,
+        [name],
+    )
+    row = cursor.fetchone()
+    if row is None:
+        # Уже отсоединена
+        return True
+    pending, has_default = row
+    if pending:
+        # Прошлый DETACH CONCURRENTLY прервался
+        cursor.execute(f"ALTER TABLE {RECORDS_TABLE} DETACH PARTITION {name} FINALIZE")
+        return True
+    if not has_default and not connection.in_atomic_block:
+        cursor.execute(
+            f"ALTER TABLE {RECORDS_TABLE} DETACH PARTITION {name} CONCURRENTLY"
+        )
+        return True
+    try:
+        with transaction.atomic():
+            cursor.execute(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'")
+            cursor.execute(f"ALTER TABLE {RECORDS_TABLE} DETACH PARTITION {name}")
+    except OperationalError:
+        logger.warning(f"Не дождался блокировки для отсоединения секции {name}.")
+        return False
+    return True
+
+
+def _drop_partition(
+    name: str, batch_size: int, pause: float, deadline: float
+) -> Counter | None:
+    """
+    Удаляет секцию целиком. Связи с тегами её записей сначала удаляются
+    пачками, затем секция отсоединяется и удаляется. Возвращает число
+    удалённых записей по метрикам, None - если время вышло или секцию не
+    удалось отсоединить (её удалит следующий запуск).
+    """
+    through = TagsMetricRecord._meta.db_table
+    links_sql = f"""
+        DELETE FROM {through} WHERE id IN (
+            SELECT t.id FROM {through} t JOIN {name} r ON r.id = t.record_id
+            LIMIT %s
+        )
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT metric_id, count(*) FROM {name} GROUP BY metric_id")
+        deleted = Counter(dict(cursor.fetchall()))
+        while True:
+            cursor.execute(links_sql, [batch_size])
+            if cursor.rowcount < batch_size:
+                break
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(pause)
+        if not _detach_partition(cursor, name):
+            return None
+        with transaction.atomic():
+            # Связи, созданные после очистки, удаляются вместе с секцией
+            cursor.execute(links_sql, [None])
+            cursor.execute(f"DROP TABLE {name}")
+    return deleted
+
+
+def purge_deleted_metric(
+    metric_id: int, batch_size: int | None = None, pause: float | None = None
+) -> int:
+    """
+    Удаляет метрику, помеченную удалённой: записи со связями и агрегаты -
+    пачками по METRIC_RETENTION_BATCH_SIZE с паузой METRIC_RETENTION_BATCH_PAUSE,
+    затем архив и саму метрику. Возвращает число удалённых записей.
+    """
+    batch_size = batch_size or settings.METRIC_RETENTION_BATCH_SIZE
+    pause = settings.METRIC_RETENTION_BATCH_PAUSE if pause is None else pause
+    if not Metric.objects.filter(pk=metric_id, deleted_at__isnull=False).exists():
+        return 0
+
+    deleted = 0
+    while True:
+        count = _delete_batch(metric_id, None, batch_size)
+        deleted += count
+        if count < batch_size:
+            break
+        time.sleep(pause)
+    while _delete_rollups_batch(metric_id, batch_size) == batch_size:
+        time.sleep(pause)
+
+    with transaction.atomic():
+        deleted += sum(
+            MetricRecordChunk.objects.filter(metric_id=metric_id).values_list(
+                "count", flat=True
+            )
+        )
+        MetricRecordChunk.objects.filter(metric_id=metric_id).delete()
+        # Записи, добавленные после пометки, удаляются каскадом: их немного
+        Metric.objects.filter(pk=metric_id).delete()
+
+    logger.info(f"Удалена метрика ID {metric_id}, записей: {deleted}")
+    return deleted
+
+
+def purge_expired_records(
+    now: int | None = None,
+    batch_size: int | None = None,
+    pause: float | None = None,
+    max_seconds: float | None = None,
+) -> dict:
+    """
+    Удаляет просроченные записи не дольше max_seconds
+    (METRIC_RETENTION_MAX_SECONDS), остаток удалит следующий запуск.
+
+    Возвращает {"deleted": всего, "metrics": {id метрики: удалено},
+    "partitions": [удалённые секции], "finished": успел ли удалить всё}.
+    """
+    now = int(time.time()) if now is None else now
+    batch_size = batch_size or settings.METRIC_RETENTION_BATCH_SIZE
+    pause = settings.METRIC_RETENTION_BATCH_PAUSE if pause is None else pause
+    max_seconds = max_seconds or settings.METRIC_RETENTION_MAX_SECONDS
+    deadline = time.monotonic() + max_seconds
+
+    cutoffs = retention_cutoffs(now)
+    deleted = Counter()
+    partitions = []
+    finished = True
+
+    expiring = [cutoff for cutoff in cutoffs.values() if cutoff is not None]
+    if expiring and len(expiring) == len(cutoffs) and is_partitioned():
+        drop_before = min(expiring)
+        for name, (_, end) in sorted(
+            partition_ranges().items(), key=lambda item: item[1]
+        ):
+            if end > drop_before:
+                break
+            if time.monotonic() >= deadline:
+                finished = False
+                break
+            dropped = _drop_partition(name, batch_size, pause, deadline)
+            if dropped is None:
+                finished = False
+                break
+            deleted += dropped
+            partitions.append(name)
+
+    for metric_id, cutoff in cutoffs.items():
+        if finished and cutoff is not None:
+            deleted[metric_id] += purge_archived_records(metric_id, cutoff)
+        while finished and cutoff is not None:
+            if time.monotonic() >= deadline:
+                finished = False
+                break
+            count = _delete_batch(metric_id, cutoff, batch_size)
+            deleted[metric_id] += count
+            if count < batch_size:
+                break
+            time.sleep(pause)
+
+    # Удаление в обход ORM не вызывает сигналы
+    for metric_id, count in deleted.items():
+        if count:
+            invalidate_metric_cache(metric_id)
+
+    report = {
+        "deleted": sum(deleted.values()),
+        "metrics": {metric_id: count for metric_id, count in deleted.items() if count},
+        "partitions": partitions,
+        "finished": finished,
+    }
+    logger.info(
+        f"Удалено просроченных записей: {report['deleted']}, "
+        f"секций: {len(partitions)}, метрик: {len(report['metrics'])}"
+        + ("" if finished else ". Время вышло, остаток удалит следующий запуск")
+    )
+    return report
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from decimal import Decimal
+from typing import Iterable
+
+from django.db import connection, transaction
+
+from metrics.archive import iter_archived_rows
+from metrics.models import MetricRecord, MetricRecordChunk, MetricRollup
+
+RESOLUTIONS = tuple(MetricRollup.Resolution.values)
+
+
+def bucket_start(timestamp: int, resolution: int) -> int:
+    return timestamp - timestamp % resolution
+
+
+def apply_records_to_rollups(
+    metric_id: int,
+    records: Iterable[tuple[int, Decimal]],
+    resolutions: Iterable[int] = RESOLUTIONS,
+) -> None:
+    """
+    Инкрементально добавляет новые записи (timestamp, value) в агрегаты метрики.
+    Один upsert на все затронутые интервалы всех разрешений.
+    """
+    resolutions = tuple(resolutions)
+    buckets = defaultdict(lambda: [0, Decimal(0), None, None])
+    for timestamp, value in records:
+        value = Decimal(value)
+        for resolution in resolutions:
+            bucket = buckets[(resolution, bucket_start(timestamp, resolution))]
+            bucket[0] += 1
+            bucket[1] += value
+            bucket[2] = value if bucket[2] is None else min(bucket[2], value)
+            bucket[3] = value if bucket[3] is None else max(bucket[3], value)
+
+    if not buckets:
+        return
+
+    table = MetricRollup._meta.db_table
+    # Сортировка задаёт одинаковый порядок блокировок строк между транзакциями
+    rows = sorted(buckets.items())
+    values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+    params = [
+        param
+        for (resolution, bucket), (count, total, minimum, maximum) in rows
+        for param in (metric_id, resolution, bucket, count, total, minimum, maximum)
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (metric_id, resolution, bucket, count, sum, min, max)
+            VALUES {values_sql}
+            ON CONFLICT (metric_id, resolution, bucket) DO UPDATE SET
+                count = {table}.count + EXCLUDED.count,
+                sum = {table}.sum + EXCLUDED.sum,
+                min = LEAST({table}.min, EXCLUDED.min),
+                max = GREATEST({table}.max, EXCLUDED.max)
+            """,
+            params,
+        )
+
+
+def rebuild_rollups(
+    metric_id: int, from_ts: int | None = None, to_ts: int | None = None
+) -> None:
+    """
+    Пересчитывает агрегаты метрики из сырых записей и архивных чанков.
+    Границы расширяются до целых интервалов каждого разрешения.
+    """
+    table = MetricRollup._meta.db_table
+    records_table = MetricRecord._meta.db_table
+    widest = max(RESOLUTIONS)
+    archived = [
+        (row["timestamp"], row["value"])
+        for row in iter_archived_rows(
+            MetricRecordChunk.objects.filter(metric_id=metric_id),
+            from_ts=None if from_ts is None else bucket_start(from_ts, widest),
+            to_ts=None if to_ts is None else bucket_start(to_ts, widest) + widest - 1,
+        )
+    ]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for resolution in RESOLUTIONS:
+            conditions, params = ["metric_id = %s"], [metric_id]
+            if from_ts is not None:
+                conditions.append("{column} >= %s")
+                params.append(bucket_start(from_ts, resolution))
+            if to_ts is not None:
+                conditions.append("{column} < %s")
+                params.append(bucket_start(to_ts, resolution) + resolution)
+
+            cursor.execute(
+                f"DELETE FROM {table} WHERE resolution = %s AND "
+                + " AND ".join(conditions).format(column="bucket"),
+                [resolution, *params],
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (metric_id, resolution, bucket, count, sum, min, max)
+                SELECT metric_id, %s, timestamp - timestamp %% %s,
+                       count(*), sum(value), min(value), max(value)
+                FROM {records_table}
+                WHERE {" AND ".join(conditions).format(column="timestamp")}
+                GROUP BY metric_id, timestamp - timestamp %% %s
+                """,
+                [resolution, resolution, *params, resolution],
+            )
+
+            low = None if from_ts is None else bucket_start(from_ts, resolution)
+            high = (
+                None if to_ts is None else bucket_start(to_ts, resolution) + resolution
+            )
+            apply_records_to_rollups(
+                metric_id,
+                (
+                    (timestamp, value)
+                    for timestamp, value in archived
+                    if (low is None or timestamp >= low)
+                    and (high is None or timestamp < high)
+                ),
+                resolutions=(resolution,),
+            )
+
+
+def refresh_rollup_buckets(metric_id: int, timestamps: Iterable[int]) -> None:
+    """
+    Пересчитывает интервалы, в которые попадают timestamps.
+    Нужен при изменении и удалении записей, когда инкремент невозможен.
+    """
+    days = {
+        bucket_start(timestamp, MetricRollup.Resolution.DAY) for timestamp in timestamps
+    }
+    for day in sorted(days):
+        rebuild_rollups(metric_id, day, day + MetricRollup.Resolution.DAY - 1)
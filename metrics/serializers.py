@@ -1,7 +1,9 @@
-from django.db import IntegrityError
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db.models import OuterRef, QuerySet
 from rest_framework import serializers
 
-from metrics.models import Metric, MetricRecord, Tag
+from metrics.models import Metric, MetricRecord, Tag, TagsMetricRecord
+from metrics.services import ON_CONFLICT_CHOICES, ON_CONFLICT_ERROR
 
 
 class MetricSerializer(serializers.ModelSerializer):
@@ -11,6 +13,7 @@ class MetricSerializer(serializers.ModelSerializer):
             "id",
             "name",
             "description",
+            "retention_days",
             "created_at",
         )
         read_only_fields = ("id", "created_at")
@@ -26,8 +29,52 @@ class TagSerializer(serializers.ModelSerializer):
         read_only_fields = ("id",)
 
 
+class TagRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Тег по id или по имени. Для имени возвращается несохранённый Tag:
+    id всех имён запроса разрешаются одним запросом при записи
+    (см. services.resolve_record_tags), отсутствующие теги создаются.
+    Строка из одних цифр считается id.
+
+    Если в контексте передан словарь тегов (context["tags"]),
+    теги ищутся в нём без отдельного запроса к БД на каждый id.
+    """
+
+    default_error_messages = {
+        **serializers.PrimaryKeyRelatedField.default_error_messages,
+        "blank_name": "Имя тега не может быть пустым.",
+        "name_too_long": "Имя тега длиннее {max_length} символов.",
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and not data.isdigit():
+            return self.tag_by_name(data)
+
+        tags = self.context.get("tags")
+        if tags is None:
+            return super().to_internal_value(data)
+
+        if isinstance(data, bool):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        try:
+            tag = tags.get(int(data))
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if tag is None:
+            self.fail("does_not_exist", pk_value=data)
+        return tag
+
+    def tag_by_name(self, name: str) -> Tag:
+        max_length = Tag._meta.get_field("name").max_length
+        if not name:
+            self.fail("blank_name")
+        if len(name) > max_length:
+            self.fail("name_too_long", max_length=max_length)
+        return Tag(name=name)
+
+
 class MetricRecordSerializer(serializers.ModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = TagRelatedField(
         queryset=Tag.objects.all(),
         many=True,
         required=False,
@@ -49,10 +96,141 @@ class MetricRecordSerializer(serializers.ModelSerializer):
             "metric_name",
         )
 
-    def create(self, validated_data):
+
+def metric_record_rows(queryset: QuerySet) -> QuerySet:
+    """
+    Быстрый путь чтения для списков: словари с тем же JSON, что даёт
+    MetricRecordSerializer, одним запросом без ModelSerializer на каждую строку.
+    id тегов собираются подзапросом в порядке добавления связей.
+    """
+    tag_ids = ArraySubquery(
+        TagsMetricRecord.objects.filter(record=OuterRef("pk"))
+        .order_by("id")
+        .values("tag_id")
+    )
+    return queryset.annotate(tag_ids=tag_ids).values(
+        "id", "metric_id", "metric_name", "value", "timestamp", "tag_ids"
+    )
+
+
+def metric_record_row_data(row: dict) -> dict:
+    """Строка metric_record_rows в представлении MetricRecordSerializer."""
+    return {
+        "id": row["id"],
+        "metric": row["metric_id"],
+        "metric_name": row["metric_name"],
+        # Как DecimalField в DRF: строка без экспоненты
+        "value": format(row["value"], "f"),
+        "timestamp": row["timestamp"],
+        "tags": row["tag_ids"],
+    }
+
+
+class CommaSeparatedListField(serializers.ListField):
+    """Список из query-параметра вида ?fn=avg,max (или ?fn=avg&fn=max)."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [data]
+        data = [
+            item.strip()
+            for chunk in data
+            for item in str(chunk).split(",")
+            if item.strip()
+        ]
+        return super().to_internal_value(data)
+
+
+class TimeRangeQuerySerializer(serializers.Serializer):
+    """Параметры from/to (Unix timestamp, включительно)."""
+
+    to = serializers.IntegerField(required=False, min_value=0)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # from - зарезервированное слово, поэтому поле объявлено здесь
+        fields["from"] = serializers.IntegerField(required=False, min_value=0)
+        return fields
+
+    def validate(self, attrs):
+        if "from" in attrs and "to" in attrs and attrs["from"] > attrs["to"]:
+            raise serializers.ValidationError({"from": "from не может быть больше to."})
+        return attrs
+
+
+class OnConflictQuerySerializer(serializers.Serializer):
+    """Параметр on_conflict: что делать с записью на занятый timestamp."""
+
+    on_conflict = serializers.ChoiceField(
+        choices=ON_CONFLICT_CHOICES,
+        default=ON_CONFLICT_ERROR,
+    )
+
+
+class TagFilterQuerySerializer(serializers.Serializer):
+    """
+    Фильтры по id тегов через запятую:
+     - tags - есть хотя бы один из тегов
+     - tags_all - есть все теги
+    """
+
+    tags = CommaSeparatedListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+    )
+    tags_all = CommaSeparatedListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+    )
+
+
+class MetricRecordAggregateQuerySerializer(
+    TimeRangeQuerySerializer, TagFilterQuerySerializer
+):
+    """Параметры агрегации: размер корзины, список функций и фильтры."""
+
+    BUCKET_UNITS = {
+        "s": 1,
+        "m": 60,
+        "h": 60 * 60,
+        "d": 24 * 60 * 60,
+        "w": 7 * 24 * 60 * 60,
+    }
+    FUNCTIONS = ("avg", "min", "max", "count", "sum")
+
+    bucket = serializers.CharField()
+    fn = CommaSeparatedListField(
+        child=serializers.ChoiceField(choices=FUNCTIONS),
+        required=False,
+        allow_empty=False,
+        default=["avg"],
+    )
+
+    def validate_bucket(self, value: str) -> int:
+        """Переводит 30s/5m/1h/1d/1w (или число секунд) в секунды."""
+        value = value.strip().lower()
+        multiplier = self.BUCKET_UNITS.get(value[-1:])
+        number = value[:-1] if multiplier else value
         try:
-            return super().create(validated_data)
-        except IntegrityError:
+            seconds = int(number) * (multiplier or 1)
+        except ValueError:
             raise serializers.ValidationError(
-                {"timestamp": "Запись на этот момент времени уже существует"}
+                "Ожидается число секунд или значение вида 30s, 5m, 1h, 1d, 1w."
             )
+        if seconds <= 0:
+            raise serializers.ValidationError("Размер корзины должен быть больше нуля.")
+        return seconds
+
+    def validate_fn(self, value: list[str]) -> list[str]:
+        return list(dict.fromkeys(value))
+
+
+class MetricRecordAggregateSerializer(serializers.Serializer):
+    """Одна корзина агрегации. Отдаются только запрошенные функции."""
+
+    bucket = serializers.IntegerField()
+    avg = serializers.DecimalField(max_digits=None, decimal_places=4, required=False)
+    min = serializers.DecimalField(max_digits=None, decimal_places=4, required=False)
+    max = serializers.DecimalField(max_digits=None, decimal_places=4, required=False)
+    count = serializers.IntegerField(required=False)
+    sum = serializers.DecimalField(max_digits=None, decimal_places=4, required=False)
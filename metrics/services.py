@@ -0,0 +1,241 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from metrics import cache as metrics_cache
+from metrics.archive import restore_archived_records
+from metrics.models import Metric, MetricRecord, Tag, TagsMetricRecord
+from metrics.rollups import apply_records_to_rollups, refresh_rollup_buckets
+
+ON_CONFLICT_ERROR = "error"
+ON_CONFLICT_IGNORE = "ignore"
+ON_CONFLICT_UPDATE = "update"
+ON_CONFLICT_CHOICES = (ON_CONFLICT_ERROR, ON_CONFLICT_IGNORE, ON_CONFLICT_UPDATE)
+
+# Результаты записи элемента
+CREATED = "created"
+UPDATED = "updated"
+SKIPPED = "skipped"
+CONFLICT = "conflict"
+
+
+def write_metric_records(
+    metric: Metric,
+    records_data: list[dict],
+    on_conflict: str = ON_CONFLICT_ERROR,
+) -> list[tuple[str, int | None]]:
+    """
+    Пишет записи метрики пачкой через INSERT ... ON CONFLICT (metric, timestamp).
+    records_data - провалидированные данные MetricRecordSerializer.
+
+    on_conflict:
+     - error - существующие записи не трогаются, элемент получает CONFLICT
+     - ignore - существующие записи не трогаются, элемент получает SKIPPED
+     - update - значение существующей записи заменяется, теги - только
+       если ключ tags есть в данных элемента
+
+    Возвращает (результат, id записи) для каждого элемента records_data.
+    bulk-запись не вызывает сигналы, поэтому агрегаты обновляются здесь.
+    """
+    results: list[tuple[str, int | None]] = [None] * len(records_data)
+
+    # Одна строка INSERT не может обновить запись дважды, поэтому дубли
+    # внутри пачки разбираются заранее: при update побеждает последний.
+    latest = {}
+    for index, data in enumerate(records_data):
+        timestamp = data["timestamp"]
+        if timestamp in latest:
+            if on_conflict == ON_CONFLICT_UPDATE:
+                results[latest[timestamp]] = (SKIPPED, None)
+            else:
+                results[index] = (
+                    CONFLICT if on_conflict == ON_CONFLICT_ERROR else SKIPPED,
+                    None,
+                )
+                continue
+        latest[timestamp] = index
+    rows = [(index, records_data[index]) for index in sorted(latest.values())]
+
+    resolve_record_tags([data for _, data in rows])
+    with transaction.atomic():
+        restore_archived_records(metric.id, [data["timestamp"] for _, data in rows])
+        written = _upsert_records(metric, [data for _, data in rows], on_conflict)
+        _write_tags(rows, written)
+
+        apply_records_to_rollups(
+            metric.id,
+            [
+                (timestamp, value)
+                for timestamp, (_, inserted, value, _) in written.items()
+                if inserted
+            ],
+        )
+        changed = [
+            timestamp
+            for timestamp, (_, inserted, value, old_value) in written.items()
+            if not inserted and value != old_value
+        ]
+        if changed:
+            refresh_rollup_buckets(metric.id, changed)
+
+    missing = CONFLICT if on_conflict == ON_CONFLICT_ERROR else SKIPPED
+    for index, data in rows:
+        record = written.get(data["timestamp"])
+        if record is None:
+            results[index] = (missing, None)
+        else:
+            results[index] = (CREATED if record[1] else UPDATED, record[0])
+    return results
+
+
+def resolve_record_tags(records_data: list[dict]) -> None:
+    """
+    Проставляет id тегам, переданным по имени (несохранённые Tag из
+    TagRelatedField). Вызывается до транзакции записи: созданные теги
+    остаются, даже если запись не удалась.
+    """
+    unsaved = [
+        tag for data in records_data for tag in data.get("tags", []) if tag.pk is None
+    ]
+    if not unsaved:
+        return
+    tag_ids = get_or_create_tag_ids({tag.name for tag in unsaved})
+    for tag in unsaved:
+        tag.pk = tag_ids[tag.name]
+
+
+def get_or_create_tag_ids(names: set[str]) -> dict[str, int]:
+    """
+    Возвращает {имя: id} тегов через кеш имя -> id. Промахи разрешаются
+    одним запросом INSERT ... ON CONFLICT DO NOTHING + SELECT существующих.
+    """
+    keys = metrics_cache.tag_name_cache_keys(names)
+    tag_ids = {keys[key]: tag_id for key, tag_id in cache.get_many(keys).items()}
+    missing = sorted(names - tag_ids.keys())
+    if not missing:
+        return tag_ids
+
+    table = Tag._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH created AS (
+                INSERT INTO {table} (name) SELECT unnest(%s::text[])
+                ON CONFLICT (name) DO NOTHING
+                RETURNING id, name
+            )
+            SELECT id, name, true FROM created
+            UNION ALL
+            SELECT id, name, false FROM {table} WHERE name = ANY(%s)
+            """,
+            [missing, missing],
+        )
+        rows = cursor.fetchall()
+
+    found = {name: tag_id for tag_id, name, _ in rows}
+    # Тег, созданный параллельной транзакцией во время запроса, не виден
+    # ни в INSERT, ни в SELECT этого запроса
+    late = [name for name in missing if name not in found]
+    if late:
+        found.update(Tag.objects.filter(name__in=late).values_list("name", "id"))
+    tag_ids.update(found)
+
+    # Кешируются только уже закоммиченные теги: созданные в этой транзакции
+    # могут откатиться вместе с ней
+    existing = {name for _, name, created in rows if not created}
+    cache.set_many(
+        {key: found[name] for key, name in keys.items() if name in existing},
+        timeout=metrics_cache.TAGS_CACHE_TIMEOUT,
+    )
+    if len(existing) < len(rows):
+        transaction.on_commit(metrics_cache.invalidate_tags_cache)
+    return tag_ids
+
+
+def _upsert_records(
+    metric: Metric, records_data: list[dict], on_conflict: str
+) -> dict[int, tuple[int, bool, Decimal, Decimal | None]]:
+    """
+    Возвращает {timestamp: (id, inserted, value, old_value)} для записанных строк.
+    old_value читается в том же снимке данных, что и INSERT. Новая запись -
+    та, что получила id, выданный этим же запросом из sequence: при конфликте
+    RETURNING отдаёт id существующей строки, даже если её вставила
+    параллельная транзакция после снимка. xmax, по которому это обычно
+    определяют, в RETURNING секционированной таблицы недоступен.
+    """
+    if not records_data:
+        return {}
+
+    table = MetricRecord._meta.db_table
+    values_sql = ", ".join(["(%s::bigint, %s::numeric)"] * len(records_data))
+    params = [
+        param for data in records_data for param in (data["timestamp"], data["value"])
+    ]
+
+    if on_conflict == ON_CONFLICT_UPDATE:
+        conflict_sql = "DO UPDATE SET value = EXCLUDED.value"
+    else:
+        conflict_sql = "DO NOTHING"
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH input (id, timestamp, value) AS (
+                SELECT nextval(pg_get_serial_sequence(%s, 'id')), timestamp, value
+                FROM (VALUES {values_sql}) AS v (timestamp, value)
+            ), old AS (
+                SELECT timestamp, value FROM {table}
+                WHERE metric_id = %s AND timestamp = ANY(%s)
+            ), written AS (
+                INSERT INTO {table} (id, metric_id, timestamp, value, metric_name)
+                SELECT id, %s, timestamp, value, %s FROM input
+                ON CONFLICT (metric_id, timestamp) {conflict_sql}
+                RETURNING id, timestamp, value
+            )
+            SELECT written.id, written.timestamp, written.id = input.id,
+                   written.value, old.value
+            FROM written
+            JOIN input USING (timestamp)
+            LEFT JOIN old USING (timestamp)
+            """,
+            [
+                table,
+                *params,
+                metric.id,
+                [data["timestamp"] for data in records_data],
+                metric.id,
+                metric.name,
+            ],
+        )
+        return {
+            timestamp: (record_id, inserted, value, old_value)
+            for record_id, timestamp, inserted, value, old_value in cursor.fetchall()
+        }
+
+
+def _write_tags(rows: list[tuple[int, dict]], written: dict) -> None:
+    """
+    Создаёт связи с тегами. У обновлённых записей теги заменяются, только
+    если ключ tags передан: запись без него оставляет прежние теги.
+    """
+    tagged = []
+    for _, data in rows:
+        record = written.get(data["timestamp"])
+        if record is None:
+            continue
+        record_id, inserted, _, _ = record
+        if inserted or "tags" in data:
+            tagged.append((record_id, inserted, data.get("tags", [])))
+
+    updated_ids = [record_id for record_id, inserted, _ in tagged if not inserted]
+    if updated_ids:
+        TagsMetricRecord.objects.filter(record_id__in=updated_ids).delete()
+
+    TagsMetricRecord.objects.bulk_create(
+        [
+            TagsMetricRecord(record_id=record_id, tag=tag)
+            for record_id, _, tags in tagged
+            for tag in dict.fromkeys(tags)
+        ]
+    )
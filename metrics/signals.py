@@ -1,22 +1,41 @@
 import logging
+from functools import partial
 
 from django.db import transaction
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
-from metrics.models import Metric
+from metrics.archive import restore_archived_records
+from metrics.cache import (
+    invalidate_metric_cache,
+    invalidate_metric_owner,
+    invalidate_tags_cache,
+    invalidate_user_metrics,
+)
+from metrics.models import Metric, MetricRecord, Tag
+from metrics.rollups import apply_records_to_rollups, refresh_rollup_buckets
 from metrics.tasks import sync_metric_records_name, update_metric_records_name
 
 logger = logging.getLogger(__name__)
 
 
+def on_commit_invalidate(invalidate, *args) -> None:
+    """
+    Сбрасывает кеш после фиксации транзакции: до неё другой воркер мог бы
+    построить страницу нового поколения по ещё старым данным.
+    """
+    transaction.on_commit(partial(invalidate, *args))
+
+
 @receiver(pre_save, sender=Metric)
 def cache_old_metric_name(sender, instance, **kwargs):
-    """Времено кешируем старое значение поля name"""
+    """Времено кешируем старые значения полей name и author"""
     if instance.pk:
-        instance._old_name = (
-            sender.objects.filter(pk=instance.pk).values_list("name", flat=True).first()
-        )
+        instance._old_name, instance._old_author_id = (
+            sender.objects.filter(pk=instance.pk)
+            .values_list("name", "author_id")
+            .first()
+        ) or (None, None)
 
 
 @receiver(post_save, sender=Metric)
@@ -41,3 +60,87 @@ def update_metric_name_metric_records(sender, instance, created, **kwargs):
                 sync_metric_records_name(metric_id=instance.pk, new_name=instance.name)
 
         transaction.on_commit(enqueue_task)
+
+
+@receiver(post_save, sender=Metric)
+def invalidate_user_metrics_on_save(sender, instance, created, **kwargs):
+    """
+    Меняет версию списка метрик автора (ETag GET /api/metrics/). При создании
+    и смене автора сбрасывает кешированного автора метрики, а при смене - и
+    её кеш: страницы прежнего автора больше не должны отдаваться.
+    """
+    on_commit_invalidate(invalidate_user_metrics, instance.author_id)
+    old_author_id = getattr(instance, "_old_author_id", None)
+    if old_author_id is not None and old_author_id != instance.author_id:
+        on_commit_invalidate(invalidate_user_metrics, old_author_id)
+    if created or old_author_id != instance.author_id:
+        on_commit_invalidate(invalidate_metric_owner, instance.pk)
+    if not created and old_author_id != instance.author_id:
+        on_commit_invalidate(invalidate_metric_cache, instance.pk)
+
+
+@receiver(post_delete, sender=Metric)
+def invalidate_deleted_metric_cache(sender, instance, **kwargs):
+    """Сбрасывает кеш записей удалённой метрики и версию списка метрик автора"""
+    on_commit_invalidate(invalidate_metric_cache, instance.pk)
+    on_commit_invalidate(invalidate_metric_owner, instance.pk)
+    on_commit_invalidate(invalidate_user_metrics, instance.author_id)
+
+
+@receiver(pre_save, sender=MetricRecord)
+def cache_old_record_timestamp(sender, instance, **kwargs):
+    """Времено кешируем старое значение timestamp для пересчёта агрегатов"""
+    if instance.pk:
+        instance._old_timestamp = (
+            sender.objects.filter(pk=instance.pk)
+            .values_list("timestamp", flat=True)
+            .first()
+        )
+
+
+@receiver(pre_save, sender=MetricRecord)
+def restore_archived_record_window(sender, instance, **kwargs):
+    """
+    Распаковывает архивное окно, в которое попадает сохраняемая запись.
+    MetricRecord.save открывает транзакцию, поэтому блокировка метрики
+    держится до записи. Вне save (например, raw-сохранение) сигнал нужно
+    отправлять внутри transaction.atomic().
+    """
+    restore_archived_records(instance.metric_id, [instance.timestamp])
+
+
+@receiver(post_save, sender=MetricRecord)
+def update_rollups_on_record_save(sender, instance, created, **kwargs):
+    """Обновляет агрегаты метрики (MetricRollup) и сбрасывает кеш при сохранении записи"""
+    if created:
+        apply_records_to_rollups(
+            instance.metric_id, [(instance.timestamp, instance.value)]
+        )
+        on_commit_invalidate(invalidate_metric_cache, instance.metric_id)
+        return
+
+    timestamps = {instance.timestamp}
+    old_timestamp = getattr(instance, "_old_timestamp", None)
+    if old_timestamp is not None:
+        timestamps.add(old_timestamp)
+    refresh_rollup_buckets(instance.metric_id, timestamps)
+    on_commit_invalidate(invalidate_metric_cache, instance.metric_id)
+
+
+@receiver(post_delete, sender=MetricRecord)
+def update_rollups_on_record_delete(sender, instance, origin=None, **kwargs):
+    """
+    Пересчитывает агрегаты и сбрасывает кеш при удалении записи.
+    При каскадном удалении метрики агрегаты удаляются вместе с ней.
+    """
+    if isinstance(origin, Metric):
+        return
+    refresh_rollup_buckets(instance.metric_id, [instance.timestamp])
+    on_commit_invalidate(invalidate_metric_cache, instance.metric_id)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tags_list_cache(sender, **kwargs):
+    """Сбрасывает кеш списка тегов"""
+    on_commit_invalidate(invalidate_tags_cache)
@@ -0,0 +1,163 @@
+"""
+Журнал медленных запросов к БД. Включается METRIC_SLOW_QUERY_THRESHOLD_MS > 0.
+
+Обёртка execute_wrapper ставится первой на каждое соединение (HTTP-запросы,
+задачи Celery, команды) и записывает запросы дольше порога: SQL, параметры и место
+вызова в коде проекта. Не чаще раза в METRIC_SLOW_QUERY_EXPLAIN_INTERVAL
+секунд на все процессы снимается план: для SELECT без блокировок и
+функций с побочными эффектами - EXPLAIN (ANALYZE, BUFFERS), запрос
+выполняется ещё раз в транзакции или точке сохранения, которая затем
+откатывается; для остальных запросов - EXPLAIN без выполнения.
+
+Записи хранятся в списке Redis SLOW_QUERIES_KEY (новые в начале), длина
+ограничена METRIC_SLOW_QUERY_BUFFER_SIZE.
+"""
+
+import json
+import logging
+import re
+import time
+import traceback
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from metrics.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERIES_KEY = "slow_queries"
+EXPLAIN_LOCK_KEY = "slow_queries:explain"
+MAX_SQL_LENGTH = 10_000
+MAX_PARAMS = 100
+STACK_DEPTH = 5
+
+EXPLAIN = "EXPLAIN"
+EXPLAIN_ANALYZE = "EXPLAIN (ANALYZE, BUFFERS)"
+EXPLAINABLE_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+# Повторный запуск блокирует строки ещё раз или двигает последовательности
+SIDE_EFFECTS_RE = re.compile(
+    r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b"
+    r"|\b(NEXTVAL|SETVAL|PG_ADVISORY\w*|PG_TRY_ADVISORY\w*)\s*\(",
+    re.IGNORECASE,
+)
+
+_explaining = ContextVar("explaining", default=False)
+
+
+def slow_query_log_enabled() -> bool:
+    return settings.METRIC_SLOW_QUERY_THRESHOLD_MS > 0
+
+
+def call_stack() -> list[str]:
+    """Последние кадры стека из кода проекта, от внешнего к месту вызова."""
+    project = str(settings.BASE_DIR)
+    frames = [
+        f"{frame.filename.removeprefix(project + '/')}:{frame.lineno} in {frame.name}"
+        for frame in traceback.extract_stack()
+        if frame.filename.startswith(project)
+        and "site-packages" not in frame.filename
+        and frame.filename != __file__
+    ]
+    return frames[-STACK_DEPTH:]
+
+
+def explain_command(sql: str) -> str | None:
+    """
+    EXPLAIN_ANALYZE для SELECT без побочных эффектов, EXPLAIN для остальных
+    запросов DML, None - план не снимается (DDL, служебные команды).
+    """
+    statement = sql.lstrip().upper()
+    if not statement.startswith(EXPLAINABLE_STATEMENTS):
+        return None
+    if statement.startswith("SELECT") and not SIDE_EFFECTS_RE.search(statement):
+        return EXPLAIN_ANALYZE
+    return EXPLAIN
+
+
+def explain(connection, sql: str, params, command: str) -> str | None:
+    token = _explaining.set(True)
+    try:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f"{command} {sql}", params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            # ANALYZE выполняет запрос: всё, что он изменил, откатывается
+            transaction.set_rollback(True, using=connection.alias)
+            return plan
+    except Exception:
+        logger.exception("Не удалось снять EXPLAIN медленного запроса.")
+        return None
+    finally:
+        _explaining.reset(token)
+
+
+def _params(params):
+    if isinstance(params, (list, tuple)):
+        return list(params[:MAX_PARAMS])
+    return params
+
+
+def record_slow_query(connection, sql: str, params, many: bool, duration_ms: float):
+    entry = {
+        "captured_at": round(time.time(), 3),
+        "duration_ms": round(duration_ms, 3),
+        "database": connection.alias,
+        "sql": sql[:MAX_SQL_LENGTH],
+        "params": _params(params),
+        "many": many,
+        "stack": call_stack(),
+        "explain_command": None,
+        "explain": None,
+    }
+    interval = settings.METRIC_SLOW_QUERY_EXPLAIN_INTERVAL
+    command = explain_command(sql)
+    if (
+        interval
+        and not many
+        and command
+        and cache.add(EXPLAIN_LOCK_KEY, 1, timeout=interval)
+    ):
+        entry["explain_command"] = command
+        entry["explain"] = explain(connection, sql, params, command)
+
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.lpush(SLOW_QUERIES_KEY, json.dumps(entry, default=str))
+            pipe.ltrim(SLOW_QUERIES_KEY, 0, settings.METRIC_SLOW_QUERY_BUFFER_SIZE - 1)
+            pipe.execute()
+    except Exception:
+        logger.exception("Не удалось сохранить медленный запрос.")
+
+
+def capture_slow_queries(execute, sql, params, many, context):
+    if not slow_query_log_enabled() or _explaining.get():
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration_ms = (time.perf_counter() - started) * 1000
+    if duration_ms >= settings.METRIC_SLOW_QUERY_THRESHOLD_MS:
+        record_slow_query(context["connection"], sql, params, many, duration_ms)
+    return result
+
+
+@receiver(connection_created)
+def install_slow_query_wrapper(sender, connection, **kwargs):
+    """
+    Ставит обёртку в начало списка: соединение может открыться внутри блока
+    connection.execute_wrapper(...), который при выходе снимает последнюю.
+    """
+    if capture_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, capture_slow_queries)
+
+
+def slow_queries() -> list[dict]:
+    """Записи журнала, новые первыми."""
+    return [json.loads(entry) for entry in get_redis().lrange(SLOW_QUERIES_KEY, 0, -1)]
+
+
+def clear_slow_queries() -> None:
+    get_redis().delete(SLOW_QUERIES_KEY)
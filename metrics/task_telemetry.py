@@ -0,0 +1,183 @@
+"""
+Телеметрия задач Celery и состояние очередей.
+
+Обработчики сигналов считают по имени задачи ожидание в очереди, время
+выполнения и завершения по состояниям (RETRY - повторы autoretry_for) и
+запоминают время последнего успешного запуска в хеше Redis LAST_SUCCESS_KEY.
+Счётчики сбрасываются в Redis с тем же интервалом, что и у HTTP-запросов,
+и при завершении процесса воркера.
+Время публикации передаётся в заголовке задачи PUBLISHED_AT_HEADER.
+
+queue_status() отдаёт глубину очередей брокера, возраст самой старой задачи
+и последний успешный запуск задачи каждого расписания celery beat.
+"""
+
+import json
+import time
+from datetime import datetime, timezone
+
+from celery import states
+from celery.schedules import maybe_schedule
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_process_shutdown,
+)
+from django.conf import settings
+
+from metrics.redis_client import get_broker_redis, get_redis
+from metrics.telemetry import (
+    flush,
+    inc,
+    maybe_flush,
+    observe,
+    register_collector,
+    telemetry_enabled,
+)
+from tatneft_metrics.celery import app
+
+PUBLISHED_AT_HEADER = "published_at"
+LAST_SUCCESS_KEY = "telemetry:tasks:last_success"
+TASK_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# {id задачи: perf_counter запуска}
+_started = {}
+
+
+@before_task_publish.connect
+def mark_published(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+def queue_wait(request, now: float) -> float | None:
+    """Ожидание в очереди: от публикации или eta, если она позже, до now."""
+    published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+    if published_at is None:
+        published_at = (request.headers or {}).get(PUBLISHED_AT_HEADER)
+    if published_at is None:
+        return None
+    eta = request.eta
+    if eta:
+        if isinstance(eta, str):
+            eta = datetime.fromisoformat(eta)
+        published_at = max(published_at, eta.timestamp())
+    return max(now - published_at, 0.0)
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.perf_counter()
+    wait = queue_wait(task.request, time.time())
+    if wait is not None:
+        observe(
+            "celery_task_queue_wait_seconds", {"task": task.name}, wait, TASK_BUCKETS
+        )
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    labels = {"task": task.name}
+    started = _started.pop(task_id, None)
+    if started is not None:
+        observe(
+            "celery_task_runtime_seconds",
+            labels,
+            time.perf_counter() - started,
+            TASK_BUCKETS,
+        )
+    inc("celery_tasks_total", {**labels, "state": state})
+    if state == states.SUCCESS and telemetry_enabled():
+        get_redis().hset(LAST_SUCCESS_KEY, task.name, time.time())
+    maybe_flush()
+
+
+@worker_process_shutdown.connect
+def flush_on_shutdown(**kwargs):
+    """
+    Остаток телеметрии дочернего процесса: он завершается через os._exit,
+    и обработчики atexit не вызываются.
+    """
+    flush()
+
+
+def queue_names() -> list[str]:
+    names = {app.conf.task_default_queue}
+    names.update(queue.name for queue in app.conf.task_queues or ())
+    return sorted(names)
+
+
+def broker_queues() -> list[dict]:
+    """
+    Глубина очередей и возраст самой старой задачи (kombu добавляет задачи
+    в начало списка, воркеры забирают с конца).
+    """
+    names = queue_names()
+    with get_broker_redis().pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.llen(name)
+            pipe.lindex(name, -1)
+        replies = pipe.execute()
+
+    now = time.time()
+    queues = []
+    for name, depth, oldest in zip(names, replies[::2], replies[1::2]):
+        age = None
+        if oldest is not None:
+            published_at = json.loads(oldest)["headers"].get(PUBLISHED_AT_HEADER)
+            if published_at is not None:
+                age = round(max(now - published_at, 0.0), 3)
+        queues.append({"name": name, "depth": depth, "oldest_age_seconds": age})
+    return queues
+
+
+def beat_schedules() -> list[dict]:
+    """
+    Последний успешный запуск задачи каждого расписания beat. overdue -
+    следующий запуск опоздал больше чем на METRIC_TASK_OVERDUE_GRACE секунд
+    (None - задача ещё не выполнялась успешно).
+    """
+    last_success = {
+        name.decode(): float(value)
+        for name, value in get_redis().hgetall(LAST_SUCCESS_KEY).items()
+    }
+    now = time.time()
+    schedules = []
+    for name, entry in app.conf.beat_schedule.items():
+        succeeded_at = last_success.get(entry["task"])
+        next_run_at = overdue = None
+        if succeeded_at is not None:
+            schedule = maybe_schedule(entry["schedule"], app=app)
+            remaining = schedule.remaining_estimate(
+                datetime.fromtimestamp(succeeded_at, tz=timezone.utc)
+            ).total_seconds()
+            next_run_at = round(now + remaining, 3)
+            overdue = remaining < -settings.METRIC_TASK_OVERDUE_GRACE
+        schedules.append(
+            {
+                "name": name,
+                "task": entry["task"],
+                "last_success_at": succeeded_at,
+                "next_run_at": next_run_at,
+                "overdue": overdue,
+            }
+        )
+    return schedules
+
+
+def queue_status() -> dict:
+    return {"queues": broker_queues(), "schedules": beat_schedules()}
+
+
+@register_collector
+def queue_gauges():
+    for queue in broker_queues():
+        labels = {"queue": queue["name"]}
+        yield "celery_queue_length", labels, queue["depth"]
+        if queue["oldest_age_seconds"] is not None:
+            yield (
+                "celery_queue_oldest_task_age_seconds",
+                labels,
+                queue["oldest_age_seconds"],
+            )
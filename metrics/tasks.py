@@ -1,10 +1,33 @@
 import logging
+import time
 from pathlib import Path
 
 from celery import shared_task
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
 from django.utils import timezone
+from redis.exceptions import LockNotOwnedError
 
+from metrics.archive import archive_metric_records
+from metrics.cache import (
+    invalidate_metric_cache,
+    invalidate_metric_owner,
+    invalidate_user_metrics,
+    metric_cache_generation,
+    metric_records_page_cache_key,
+    metric_records_stale_cache_key,
+    page_build_lock,
+    release_page_build_lock,
+    store_metric_records_page,
+)
+from metrics.ingest import flush_buffer
 from metrics.models import Metric, MetricRecord
+from metrics.partitions import ensure_partitions
+from metrics.redis_client import get_redis
+from metrics.retention import purge_deleted_metric, purge_expired_records
+from metrics.rollups import rebuild_rollups
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +36,12 @@ REPORT_FILE = REPORT_DIR / "metrics_report.txt"
 
 
 def sync_metric_records_name(metric_id: int, new_name: str) -> int:
-    """Обновляет поле metric_name у записей метрики."""
-    return MetricRecord.objects.filter(metric_id=metric_id).update(metric_name=new_name)
+    """Обновляет поле metric_name у записей метрики и сбрасывает их кеш."""
+    updated = MetricRecord.objects.filter(metric_id=metric_id).update(
+        metric_name=new_name
+    )
+    invalidate_metric_cache(metric_id)
+    return updated
 
 
 @shared_task(
@@ -34,7 +61,7 @@ def generate_report():
     """Генерация отчета по метрикам и записям"""
     REPORT_DIR.mkdir(parents=True, exist_ok=True)
 
-    metrics_count = Metric.objects.count()
+    metrics_count = Metric.objects.active().count()
     records_count = MetricRecord.objects.count()
     timestamp = timezone.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -45,3 +72,257 @@ def generate_report():
     )
 
     REPORT_FILE.write_text(content, encoding="utf-8")
+
+
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_jitter=True,
+    max_retries=5,
+)
+def rebuild_metric_rollups(
+    metric_id: int | None = None,
+    from_ts: int | None = None,
+    to_ts: int | None = None,
+):
+    """Заполняет/чинит агрегаты MetricRollup из сырых записей."""
+    if metric_id is None:
+        metric_ids = Metric.objects.active().values_list("id", flat=True).iterator()
+    else:
+        metric_ids = [metric_id]
+
+    for current_id in metric_ids:
+        rebuild_rollups(current_id, from_ts=from_ts, to_ts=to_ts)
+    logger.info("Агрегаты метрик пересчитаны")
+
+
+@shared_task
+def repair_recent_metric_rollups():
+    """Пересчитывает агрегаты за последние METRIC_ROLLUPS_REPAIR_DAYS суток."""
+    from_ts = int(time.time()) - settings.METRIC_ROLLUPS_REPAIR_DAYS * 24 * 60 * 60
+    rebuild_metric_rollups(from_ts=from_ts)
+
+
+@shared_task
+def create_metric_record_partitions():
+    """
+    Создаёт секции MetricRecord на METRIC_RECORDS_PARTITIONS_AHEAD периодов
+    вперёд, чтобы новые записи не попадали в секцию по умолчанию.
+    """
+    created = ensure_partitions()
+    logger.info(f"Создано секций записей метрик: {len(created)}")
+    return created
+
+
+@shared_task
+def purge_expired_metric_records():
+    """
+    Удаляет записи старше срока хранения метрик. Одновременно работает
+    только одна очистка. Возвращает отчёт purge_expired_records.
+    """
+    # Блокировка с токеном владельца, как у сброса буфера приёма
+    lock = get_redis().lock(
+        "metrics:retention:purge-lock",
+        timeout=settings.METRIC_RETENTION_MAX_SECONDS * 2,
+        blocking=False,
+    )
+    if not lock.acquire():
+        logger.info("Очистка просроченных записей уже выполняется")
+        return None
+    try:
+        return purge_expired_records()
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            logger.warning(
+                "Блокировка очистки просроченных записей истекла до её конца."
+            )
+
+
+@shared_task
+def archive_old_metric_records():
+    """
+    Упаковывает записи старше METRIC_ARCHIVE_AFTER_DAYS суток в сжатые чанки.
+    Одновременно работает только одна архивация.
+    """
+    if not settings.METRIC_ARCHIVE_AFTER_DAYS:
+        return 0
+    lock = get_redis().lock("metrics:archive:lock", timeout=60 * 60, blocking=False)
+    if not lock.acquire():
+        logger.info("Архивация записей уже выполняется")
+        return 0
+
+    before = int(time.time()) - settings.METRIC_ARCHIVE_AFTER_DAYS * 24 * 60 * 60
+    archived = 0
+    owned = True
+    try:
+        for metric_id in (
+            Metric.objects.active().values_list("id", flat=True).iterator()
+        ):
+            archived += archive_metric_records(metric_id, before)
+            try:
+                lock.reacquire()
+            except LockNotOwnedError:
+                owned = False
+                logger.warning("Блокировка архивации истекла, останавливаю архивацию.")
+                break
+    finally:
+        if owned:
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                logger.warning("Блокировка архивации истекла до конца архивации.")
+
+    logger.info(f"В архив перенесено {archived} записей")
+    return archived
+
+
+def delete_metrics(metrics: QuerySet) -> list[int]:
+    """
+    Помечает метрики удалёнными: они сразу пропадают из API, а записи
+    удаляет фоновая задача purge_deleted_metric_records. Возвращает id метрик.
+    """
+    rows = list(metrics.active().values_list("id", "author_id"))
+    metric_ids = [metric_id for metric_id, _ in rows]
+    Metric.objects.filter(pk__in=metric_ids).update(deleted_at=timezone.now())
+
+    def enqueue_tasks() -> None:
+        # update() не вызывает сигналы. Кеш сбрасывается после фиксации,
+        # иначе его успели бы заполнить ещё не удалёнными метриками
+        for metric_id in metric_ids:
+            invalidate_metric_cache(metric_id)
+            invalidate_metric_owner(metric_id)
+        for author_id in {author_id for _, author_id in rows}:
+            invalidate_user_metrics(author_id)
+        for metric_id in metric_ids:
+            try:
+                purge_deleted_metric_records.delay(metric_id=metric_id)
+            except Exception:
+                logger.exception(
+                    f"Не удалось запустить удаление метрики ID {metric_id}. "
+                    f"Её удалит периодическая задача."
+                )
+
+    transaction.on_commit(enqueue_tasks)
+    return metric_ids
+
+
+@shared_task
+def purge_deleted_metric_records(metric_id: int | None = None):
+    """
+    Удаляет записи, агрегаты и строку метрик, помеченных удалёнными
+    (по умолчанию всех). Одна метрика удаляется одним воркером.
+    """
+    if metric_id is None:
+        metric_ids = list(
+            Metric.objects.filter(deleted_at__isnull=False).values_list("id", flat=True)
+        )
+    else:
+        metric_ids = [metric_id]
+
+    deleted = 0
+    for current_id in metric_ids:
+        lock = get_redis().lock(
+            f"metrics:delete:{current_id}:lock", timeout=60 * 60, blocking=False
+        )
+        if not lock.acquire():
+            logger.info(f"Метрика ID {current_id} уже удаляется")
+            continue
+        try:
+            deleted += purge_deleted_metric(current_id)
+        finally:
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                logger.warning(
+                    f"Блокировка удаления метрики ID {current_id} истекла до его конца."
+                )
+    return deleted
+
+
+@shared_task
+def flush_metric_records_buffer():
+    """
+    Переносит записи из буфера асинхронного приёма в БД пачками.
+    Одновременно работает только один сброс.
+    """
+    # Блокировка с токеном владельца: снимается и продлевается, только если
+    # её ещё держит этот воркер, а не тот, кто взял её после истечения
+    lock = get_redis().lock(
+        "metrics:ingest:flush-lock",
+        timeout=settings.METRIC_RECORDS_INGEST_FLUSH_SECONDS * 2,
+        blocking=False,
+    )
+    if not lock.acquire():
+        logger.info("Сброс буфера уже выполняется")
+        return 0
+
+    flushed = 0
+    started = time.monotonic()
+    owned = True
+    try:
+        while time.monotonic() - started < settings.METRIC_RECORDS_INGEST_FLUSH_SECONDS:
+            count = flush_buffer(settings.METRIC_RECORDS_INGEST_BATCH_SIZE)
+            if not count:
+                break
+            flushed += count
+            try:
+                lock.reacquire()
+            except LockNotOwnedError:
+                owned = False
+                logger.warning("Блокировка сброса буфера истекла, останавливаю сброс.")
+                break
+    finally:
+        if owned:
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                logger.warning("Блокировка сброса буфера истекла до конца сброса.")
+
+    logger.info(f"Из буфера записано {flushed} записей")
+    return flushed
+
+
+@shared_task
+def refresh_metric_records_page(
+    metric_id: int,
+    user_id: int,
+    url: str,
+    parts: list,
+    lock_key: str,
+    lock_token: str,
+):
+    """
+    Фоновое обновление страницы записей в режиме stale-while-revalidate.
+    Пока задача работает, запросы получают предыдущую копию страницы.
+    Блокировку взял запрос, поставивший задачу; lock_token - её токен.
+    """
+    from metrics.views import MetricRecordListCreateAPIView
+
+    parts = tuple(parts)
+    lock = page_build_lock(lock_key, lock_token)
+    try:
+        # Задача могла простоять в очереди: блокировка продлевается на время
+        # построения, а если она уже истекла, страницу обновит другой запрос
+        lock.reacquire()
+    except LockNotOwnedError:
+        logger.info(
+            f"Блокировка обновления страницы метрики ID {metric_id} истекла, пропускаю."
+        )
+        return
+    try:
+        # Ключ берётся до чтения из БД, чтобы запись во время построения
+        # сменила поколение, а не оставила в кеше устаревшую страницу
+        generation = metric_cache_generation(metric_id)
+        key = metric_records_page_cache_key(
+            metric_id, user_id, *parts, generation=generation
+        )
+        user = get_user_model().objects.filter(pk=user_id).first()
+        if user is None:
+            return
+        data = MetricRecordListCreateAPIView.build_page_for_url(metric_id, user, url)
+        stale_key = metric_records_stale_cache_key(metric_id, user_id, *parts)
+        store_metric_records_page(key, stale_key, generation, data)
+    finally:
+        release_page_build_lock(lock)
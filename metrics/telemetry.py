@@ -0,0 +1,356 @@
+"""
+Телеметрия в формате Prometheus: задержка, число и время запросов к БД и
+размер ответа по маршрутам, обращения к кешу по семействам ключей.
+
+Значения копятся в памяти процесса и прибавляются к общему хешу Redis
+(TELEMETRY_KEY) одним pipeline не чаще раза в METRIC_TELEMETRY_FLUSH_INTERVAL
+секунд. Поэтому /metrics отдаёт сумму по всем воркерам gunicorn и Celery на
+всех серверах. Простаивающий воркер сбрасывает значения из фонового потока,
+а завершающийся - при выходе из процесса.
+
+Гистограммы хранятся по отдельным корзинам, накопительные значения le
+считаются при выводе: одно наблюдение - три команды Redis.
+"""
+
+import atexit
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+
+from metrics.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_KEY = "telemetry:metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram",
+        "Время обработки запроса по маршруту",
+    ),
+    "http_requests_total": ("counter", "Запросы по маршруту и коду ответа"),
+    "http_response_size_bytes": (
+        "histogram",
+        "Размер тела ответа (без потоковых ответов)",
+    ),
+    "db_queries_per_request": ("histogram", "Запросов к БД на один HTTP-запрос"),
+    "db_query_duration_seconds_total": ("counter", "Суммарное время запросов к БД"),
+    "cache_requests_total": (
+        "counter",
+        "Чтения кеша по семейству ключей, уровню и результату",
+    ),
+    "cache_writes_total": ("counter", "Записи и удаления ключей кеша"),
+    "celery_task_queue_wait_seconds": (
+        "histogram",
+        "Ожидание задачи в очереди от публикации (или eta) до запуска",
+    ),
+    "celery_task_runtime_seconds": ("histogram", "Время выполнения задачи"),
+    "celery_tasks_total": (
+        "counter",
+        "Завершённые запуски задач по состоянию (SUCCESS, FAILURE, RETRY)",
+    ),
+    "celery_queue_length": ("gauge", "Задач в очереди брокера"),
+    "celery_queue_oldest_task_age_seconds": (
+        "gauge",
+        "Возраст самой старой задачи в очереди брокера",
+    ),
+}
+
+UNMATCHED_ROUTE = "<unmatched>"
+HEX_RE = re.compile(r"^[0-9a-f]{16,}$")
+BUCKET_RE = re.compile(r'^(?P<name>\w+)_bucket\{(?P<labels>.*?),?le="(?P<le>[^"]+)"\}$')
+
+# Функции, которые при выводе возвращают текущие значения gauge:
+# [(имя, метки, значение)]
+COLLECTORS = []
+
+_pending = Counter()
+_pending_lock = threading.Lock()
+_last_flush = time.perf_counter()
+_flusher_lock = threading.Lock()
+_flusher_pid = None
+
+
+def telemetry_enabled() -> bool:
+    return settings.METRIC_TELEMETRY_ENABLED
+
+
+def key_family(key: str) -> str:
+    """
+    Семейство ключа кеша: числа и хеши заменяются на *, например
+    metric:5:1700000000123:7:records:<md5> -> metric:*:records.
+    """
+    parts = []
+    for part in key.split(":"):
+        if part.isdigit() or HEX_RE.match(part):
+            part = "*"
+        if part == "*" and parts and parts[-1] == "*":
+            continue
+        parts.append(part)
+    while len(parts) > 1 and parts[-1] == "*":
+        parts.pop()
+    return ":".join(parts)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name: str, labels: dict) -> str:
+    rendered = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return f"{name}{{{rendered}}}"
+
+
+def _format_number(value) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value)).removesuffix(".0")
+
+
+def register_collector(collector):
+    COLLECTORS.append(collector)
+    return collector
+
+
+def inc(name: str, labels: dict, amount: float = 1) -> None:
+    if not telemetry_enabled():
+        return
+    _ensure_flusher()
+    sample = _sample(name, labels)
+    with _pending_lock:
+        _pending[sample] += amount
+    maybe_flush()
+
+
+def observe(name: str, labels: dict, value: float, buckets: tuple) -> None:
+    """Наблюдение гистограммы: корзина, _sum и _count."""
+    bound = next((bound for bound in buckets if value <= bound), float("inf"))
+    inc(f"{name}_bucket", {**labels, "le": _format_number(bound)})
+    inc(f"{name}_sum", labels, value)
+    inc(f"{name}_count", labels)
+
+
+def flush() -> None:
+    """Прибавляет накопленные в процессе значения к общему хешу Redis."""
+    global _last_flush
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.perf_counter()
+    if not pending:
+        return
+    try:
+        with get_redis().pipeline(transaction=False) as pipeline:
+            for sample, amount in pending.items():
+                pipeline.hincrbyfloat(TELEMETRY_KEY, sample, amount)
+            pipeline.execute()
+    except Exception:
+        logger.exception(f"Не удалось записать телеметрию ({len(pending)} значений).")
+
+
+def maybe_flush() -> None:
+    if time.perf_counter() - _last_flush >= settings.METRIC_TELEMETRY_FLUSH_INTERVAL:
+        flush()
+
+
+def _ensure_flusher() -> None:
+    """
+    Запускает поток периодического сброса один раз на процесс, в том числе
+    после fork: без него значения простаивающего воркера не доходят до Redis.
+    """
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        threading.Thread(
+            target=_flush_periodically, name="metrics-telemetry-flush", daemon=True
+        ).start()
+
+
+def _flush_periodically() -> None:
+    while True:
+        time.sleep(settings.METRIC_TELEMETRY_FLUSH_INTERVAL)
+        maybe_flush()
+
+
+# Остаток при штатном выходе процесса, например воркера gunicorn после
+# max_requests. Дочерние процессы Celery сбрасывают его по сигналу
+# worker_process_shutdown (см. metrics.task_telemetry).
+atexit.register(flush)
+
+
+def render() -> str:
+    """Все значения из Redis в текстовом формате Prometheus."""
+    flush()
+    raw = get_redis().hgetall(TELEMETRY_KEY)
+    samples = {field.decode(): float(value) for field, value in raw.items()}
+    for collector in COLLECTORS:
+        try:
+            for name, labels, value in collector():
+                samples[_sample(name, labels)] = value
+        except Exception:
+            logger.exception(f"Ошибка сборщика телеметрии {collector.__name__}.")
+
+    # Корзины гистограмм: {(имя, метки без le): {le: значение}}
+    buckets = {}
+    lines_by_name = {name: [] for name in METRICS}
+    for sample, value in sorted(samples.items()):
+        match = BUCKET_RE.match(sample)
+        if match:
+            key = (match["name"], match["labels"])
+            buckets.setdefault(key, {})[float(match["le"])] = value
+            continue
+        name = sample.split("{", 1)[0]
+        base = name.removesuffix("_sum").removesuffix("_count")
+        lines_by_name.setdefault(base, []).append(f"{sample} {_format_number(value)}")
+
+    for (name, labels), counts in sorted(buckets.items()):
+        total = 0
+        for bound in sorted(counts):
+            total += counts[bound]
+            le = f'le="{_format_number(bound)}"'
+            rendered = f"{labels},{le}" if labels else le
+            lines_by_name[name].append(
+                f"{name}_bucket{{{rendered}}} {_format_number(total)}"
+            )
+        if float("inf") not in counts:
+            rendered = f'{labels},le="+Inf"' if labels else 'le="+Inf"'
+            lines_by_name[name].append(
+                f"{name}_bucket{{{rendered}}} {_format_number(total)}"
+            )
+
+    output = []
+    for name, lines in lines_by_name.items():
+        metric_type, help_text = METRICS.get(name, ("untyped", ""))
+        output.append(f"# HELP {name} {help_text}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+
+class QueryStats:
+    """execute_wrapper: число и время запросов к БД."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+class TelemetryMiddleware:
+    """
+    Телеметрия HTTP-запросов по маршрутам (шаблон URL, а не путь).
+    Запросы к БД при отдаче потокового ответа не учитываются.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not telemetry_enabled():
+            return self.get_response(request)
+
+        queries = QueryStats()
+        started = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        labels = {
+            "route": match.route if match else UNMATCHED_ROUTE,
+            "method": request.method,
+        }
+        observe("http_request_duration_seconds", labels, duration, LATENCY_BUCKETS)
+        inc("http_requests_total", {**labels, "status": response.status_code})
+        observe("db_queries_per_request", labels, queries.count, QUERY_COUNT_BUCKETS)
+        inc("db_query_duration_seconds_total", labels, queries.duration)
+        if not response.streaming:
+            observe(
+                "http_response_size_bytes", labels, len(response.content), SIZE_BUCKETS
+            )
+        maybe_flush()
+        return response
+
+
+def record_cache_read(key: str, hit: bool, tier: str) -> None:
+    inc(
+        "cache_requests_total",
+        {"family": key_family(key), "tier": tier, "result": "hit" if hit else "miss"},
+    )
+
+
+def record_cache_write(key: str, operation: str) -> None:
+    inc("cache_writes_total", {"family": key_family(key), "operation": operation})
+
+
+_MISSING = object()
+
+
+class InstrumentedRedisCache(RedisCache):
+    """RedisCache, который считает попадания, промахи и записи по семействам ключей."""
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        record_cache_read(key, value is not _MISSING, "redis")
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = super().get_many(keys, version)
+        for key in keys:
+            record_cache_read(key, key in found, "redis")
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record_cache_write(key, "set")
+        return super().set(key, value, timeout, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record_cache_write(key, "add")
+        return super().add(key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        record_cache_write(key, "delete")
+        return super().delete(key, version)
+
+
+def telemetry_view(request):
+    """
+    Телеметрия для Prometheus: по заголовку Authorization: Bearer
+    <METRIC_TELEMETRY_TOKEN>, а без токена в настройках - только персоналу.
+    """
+    token = settings.METRIC_TELEMETRY_TOKEN
+    if token:
+        allowed = hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(),
+            f"Bearer {token}".encode(),
+        )
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
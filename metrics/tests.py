@@ -1,13 +1,124 @@
-from unittest.mock import patch
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+from unittest.mock import Mock, patch
 
+import redis
+from celery.signals import worker_process_shutdown
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
 from django.core.cache import cache
-from django.test import TestCase
-from django.urls import reverse
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, Prefetch
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils.http import http_date
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
-from metrics.models import Metric, MetricRecord, Tag
+from metrics import urls as metrics_urls
+from metrics.archive import (
+    ArchivedRecord,
+    archive_metric_records,
+    decode_records,
+    encode_records,
+)
+from metrics.cache import (
+    TAGS_CACHE_KEY,
+    bump_version,
+    invalidate_metric_cache,
+    invalidate_metric_owner,
+    invalidate_tags_cache,
+    invalidate_user_metrics,
+    metric_cache_generation,
+    metric_records_page_cache_key,
+    metric_records_stale_cache_key,
+)
+from metrics.filters import filter_time_range
+from metrics.ingest import (
+    BUFFER_KEY,
+    DEAD_LETTER_KEY,
+    PROCESSING_KEY,
+    STATS_KEY,
+    buffer_status,
+    claim_batch,
+    enqueue_metric_records,
+    flush_buffer,
+)
+from metrics.local_cache import (
+    INVALIDATION_CHANNEL,
+    LocalLRUCache,
+    get_local_cache,
+    handle_invalidation,
+)
+from metrics.models import (
+    Metric,
+    MetricRecord,
+    MetricRecordChunk,
+    MetricRollup,
+    Tag,
+    TagsMetricRecord,
+)
+from metrics.partitions import (
+    DEFAULT_PARTITION,
+    ensure_partitions,
+    is_partitioned,
+    partition_metric_records,
+    partition_name,
+    partition_ranges,
+)
+from metrics.redis_client import get_redis
+from metrics.retention import DAY, purge_deleted_metric, purge_expired_records
+from metrics.responses import Validators
+from metrics.rollups import rebuild_rollups
+from metrics.serializers import MetricRecordSerializer
+from metrics.services import UPDATED, write_metric_records
+from metrics.slow_queries import (
+    EXPLAIN,
+    EXPLAIN_ANALYZE,
+    EXPLAIN_LOCK_KEY,
+    capture_slow_queries,
+    clear_slow_queries,
+    explain,
+    explain_command,
+    slow_queries,
+)
+from metrics.task_telemetry import (
+    LAST_SUCCESS_KEY,
+    PUBLISHED_AT_HEADER,
+    queue_wait,
+)
+from metrics.tasks import (
+    archive_old_metric_records,
+    create_metric_record_partitions,
+    delete_metrics,
+    flush_metric_records_buffer,
+    purge_deleted_metric_records,
+    purge_expired_metric_records,
+    rebuild_metric_rollups,
+    refresh_metric_records_page,
+    repair_recent_metric_rollups,
+    sync_metric_records_name,
+    update_metric_records_name,
+)
+from metrics.telemetry import TELEMETRY_KEY, flush, key_family, observe, render
 from metrics.views import MetricRecordQSMixin
 
 User = get_user_model()
@@ -107,7 +218,11 @@ class MetricRecordCreateAPITestCase(APITestCase):
 
         self.client.post(self.url, self.payload, format="json")
 
-        self.assertIsNone(cache.get(cache_key), "Инвалидация кеша не сработала")
+        self.assertNotEqual(
+            MetricRecordQSMixin.metric_records_cache_key(self.metric.id, self.user.id),
+            cache_key,
+            "Инвалидация кеша не сработала",
+        )
 
     def test_create_metric_record_with_tags_success(self):
         """Создание записи метрики с тегами"""
@@ -153,6 +268,2683 @@ class MetricRecordCreateAPITestCase(APITestCase):
         self.assertIn("tags", response.data)
 
 
+class MetricRecordBatchCreateAPITestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.url = reverse(
+            "metric-record-batch-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_batch_create_with_per_item_errors(self):
+        """Ошибочные элементы не мешают сохранить остальные"""
+        tag = Tag.objects.create(name="critical")
+        MetricRecord.objects.create(
+            metric=self.metric, value="1.0000", timestamp=1700000000
+        )
+        payload = [
+            {"value": "10.5", "timestamp": 1700000001, "tags": [tag.id]},
+            {"value": "11.5", "timestamp": 1700000000},
+            {"value": "12.5", "timestamp": 1700000002, "tags": [999999]},
+            {"value": "13.5", "timestamp": 1700000001},
+            {"value": "14.5", "timestamp": 1700000003},
+        ]
+
+        response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [item["index"] for item in response.data["created"]],
+            [0, 4],
+        )
+        self.assertEqual(
+            [error["index"] for error in response.data["errors"]],
+            [1, 2, 3],
+        )
+        self.assertIn("tags", response.data["errors"][1]["errors"])
+        self.assertEqual(MetricRecord.objects.count(), 3)
+
+        record = MetricRecord.objects.get(timestamp=1700000001)
+        self.assertEqual(record.metric_name, self.metric.name)
+        self.assertEqual(list(record.tags.all()), [tag])
+
+    def test_batch_create_query_count_does_not_depend_on_size(self):
+        """Пакет пишется фиксированным числом запросов"""
+        tags = [Tag.objects.create(name=f"tag-{i}") for i in range(3)]
+        payload = [
+            {
+                "value": str(i),
+                "timestamp": 1700000000 + i,
+                "tags": [tag.id for tag in tags],
+            }
+            for i in range(50)
+        ]
+
+        # metric, tags, upsert records, through rows, rollups + savepoint
+        with self.assertNumQueries(7):
+            response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(MetricRecord.objects.count(), 50)
+
+    def test_batch_cache_invalidated_once(self):
+        cache_key = MetricRecordQSMixin.metric_records_cache_key(
+            self.metric.id, self.user.id
+        )
+        cache.set(cache_key, [{"fake": "data"}], timeout=300)
+
+        payload = [{"value": "1", "timestamp": 1700000000}]
+        self.client.post(self.url, payload, format="json")
+
+        self.assertNotEqual(
+            MetricRecordQSMixin.metric_records_cache_key(self.metric.id, self.user.id),
+            cache_key,
+            "Инвалидация кеша не сработала",
+        )
+
+    def test_batch_too_large_rejected(self):
+        payload = [{"value": "1", "timestamp": 1700000000}] * 3
+
+        with self.settings(METRIC_RECORDS_BATCH_MAX_SIZE=2):
+            response = self.client.post(self.url, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(MetricRecord.objects.count(), 0)
+
+
+class MetricRecordTagNamesTestCase(APITestCase):
+    def setUp(self):
+        # Кеш имя -> id мог остаться от откаченных тегов других тестов
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.batch_url = reverse(
+            "metric-record-batch-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_tags_by_name_are_created(self):
+        existing = Tag.objects.create(name="pump")
+
+        response = self.client.post(
+            self.url,
+            {
+                "value": "1",
+                "timestamp": 1700000000,
+                "tags": ["pump", "well-7", existing.id, "well-7"],
+            },
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = Tag.objects.get(name="well-7")
+        self.assertEqual(response.data["tags"], [existing.id, created.id])
+
+    def test_invalid_tag_names_rejected(self):
+        for name in ("", "x" * 65):
+            response = self.client.post(
+                self.url,
+                {"value": "1", "timestamp": 1700000000, "tags": [name]},
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("tags", response.data)
+        self.assertFalse(Tag.objects.exists())
+
+    def batch_queries(self, items: int, tags: int, offset: int = 0) -> int:
+        payload = [
+            {
+                "value": "1",
+                "timestamp": 1700000000 + offset + index,
+                "tags": [f"tag-{tag}" for tag in range(tags)],
+            }
+            for index in range(items)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.batch_url, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return len(queries)
+
+    def test_tagged_batch_costs_constant_queries(self):
+        Tag.objects.bulk_create(Tag(name=f"tag-{tag}") for tag in range(2))
+
+        first = self.batch_queries(items=2, tags=3)
+        self.assertEqual(self.batch_queries(items=50, tags=20, offset=100), first)
+        self.assertEqual(
+            TagsMetricRecord.objects.filter(record__metric=self.metric).count(),
+            2 * 3 + 50 * 20,
+        )
+
+        # Имена из кеша не требуют запроса к тегам
+        self.assertEqual(self.batch_queries(items=2, tags=2, offset=200), first - 1)
+
+
+class MetricRecordOnConflictTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.tag = Tag.objects.create(name="critical")
+        self.record = MetricRecord.objects.create(
+            metric=self.metric, value="1", timestamp=1700000000
+        )
+        self.url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.batch_url = reverse(
+            "metric-record-batch-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_single_conflict_modes(self):
+        payload = {"value": "5", "timestamp": 1700000000, "tags": [self.tag.id]}
+
+        response = self.client.post(self.url, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("timestamp", response.data)
+
+        response = self.client.post(
+            f"{self.url}?on_conflict=ignore", payload, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["id"], self.record.id)
+        self.assertEqual(response.data["value"], "1.0000")
+
+        response = self.client.post(
+            f"{self.url}?on_conflict=update", payload, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["id"], self.record.id)
+        self.assertEqual(response.data["value"], "5.0000")
+        self.assertEqual(response.data["tags"], [self.tag.id])
+
+        self.assertEqual(MetricRecord.objects.count(), 1)
+        minute = MetricRollup.objects.get(
+            metric=self.metric, resolution=MetricRollup.Resolution.MINUTE
+        )
+        self.assertEqual((minute.count, minute.sum), (1, 5))
+
+    def test_invalid_conflict_mode(self):
+        response = self.client.post(
+            f"{self.url}?on_conflict=merge",
+            {"value": "5", "timestamp": 1700000001},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("on_conflict", response.data)
+
+    def test_batch_ignore_is_idempotent(self):
+        payload = [
+            {"value": "2", "timestamp": 1700000000},
+            {"value": "3", "timestamp": 1700000001},
+        ]
+
+        first = self.client.post(
+            f"{self.batch_url}?on_conflict=ignore", payload, format="json"
+        )
+        second = self.client.post(
+            f"{self.batch_url}?on_conflict=ignore", payload, format="json"
+        )
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(first.data["skipped"], [{"index": 0}])
+        self.assertEqual([item["index"] for item in first.data["created"]], [1])
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data["skipped"], [{"index": 0}, {"index": 1}])
+        self.assertEqual(MetricRecord.objects.count(), 2)
+
+    def test_batch_update_last_duplicate_wins(self):
+        payload = [
+            {"value": "2", "timestamp": 1700000000},
+            {"value": "3", "timestamp": 1700000000},
+        ]
+
+        response = self.client.post(
+            f"{self.batch_url}?on_conflict=update", payload, format="json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["skipped"], [{"index": 0}])
+        self.assertEqual(response.data["updated"], [{"index": 1, "id": self.record.id}])
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.value, 3)
+
+    def test_update_without_tags_keeps_tags(self):
+        self.record.tags.add(self.tag)
+
+        response = self.client.post(
+            f"{self.batch_url}?on_conflict=update",
+            [{"value": "2", "timestamp": 1700000000}],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(self.record.tags.all()), [self.tag])
+
+        response = self.client.post(
+            f"{self.url}?on_conflict=update",
+            {"value": "3", "timestamp": 1700000000, "tags": []},
+            format="json",
+        )
+        self.assertEqual(response.data["tags"], [])
+
+
+class MetricRecordConcurrentUpsertTestCase(TransactionTestCase):
+    def test_save_restores_archive_window_in_its_transaction(self):
+        user = User.objects.create_user(username="testuser", password="password123")
+        metric = Metric.objects.create(name="Test Metric", author=user)
+        in_transaction = []
+
+        def restore(metric_id, timestamps):
+            in_transaction.append(connection.in_atomic_block)
+            return 0
+
+        self.assertFalse(connection.in_atomic_block)
+        with patch("metrics.signals.restore_archived_records", side_effect=restore):
+            MetricRecord.objects.create(metric=metric, value="1", timestamp=1700000000)
+
+        self.assertEqual(in_transaction, [True])
+
+    def test_row_inserted_concurrently_counted_as_updated(self):
+        user = User.objects.create_user(username="testuser", password="password123")
+        metric = Metric.objects.create(name="Test Metric", author=user)
+        inserted, release = threading.Event(), threading.Event()
+        results = {}
+
+        def insert_concurrently():
+            try:
+                with transaction.atomic():
+                    MetricRecord.objects.create(
+                        metric=metric, value="1", timestamp=1700000000
+                    )
+                    inserted.set()
+                    release.wait(timeout=10)
+            finally:
+                connection.close()
+
+        def upsert():
+            try:
+                results["upsert"] = write_metric_records(
+                    metric,
+                    [{"timestamp": 1700000000, "value": Decimal("5")}],
+                    on_conflict="update",
+                )
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=insert_concurrently)]
+        threads[0].start()
+        self.assertTrue(inserted.wait(timeout=10))
+        # Снимок upsert не видит незакоммиченную строку, INSERT ждёт её коммита
+        threads.append(threading.Thread(target=upsert))
+        threads[1].start()
+        deadline = time.monotonic() + 10
+        with connection.cursor() as cursor:
+            while time.monotonic() < deadline:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+                )
+                if cursor.fetchone()[0]:
+                    break
+                time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        [(result, record_id)] = results["upsert"]
+        self.assertEqual(result, UPDATED)
+        self.assertEqual(MetricRecord.objects.get().value, 5)
+        minute = MetricRollup.objects.get(
+            metric=metric, resolution=MetricRollup.Resolution.MINUTE
+        )
+        self.assertEqual((minute.count, minute.sum), (1, 5))
+
+
+class MetricRecordListAPITestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        MetricRecord.objects.bulk_create(
+            MetricRecord(
+                metric=self.metric,
+                metric_name=self.metric.name,
+                value=i,
+                timestamp=1700000000 + i,
+            )
+            for i in range(10)
+        )
+        self.url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_cursor_pagination_walks_all_records(self):
+        """Курсор обходит все записи от новых к старым без пропусков"""
+        timestamps = []
+        url = f"{self.url}?limit=3"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.json()["results"]), 3)
+            timestamps += [item["timestamp"] for item in response.json()["results"]]
+            url = response.json()["next"]
+
+        self.assertEqual(
+            timestamps,
+            [1700000000 + i for i in reversed(range(10))],
+        )
+
+    def test_time_range_filter(self):
+        response = self.client.get(self.url, {"from": 1700000002, "to": 1700000004})
+
+        self.assertEqual(
+            [item["timestamp"] for item in response.json()["results"]],
+            [1700000004, 1700000003, 1700000002],
+        )
+        self.assertIsNone(response.json()["next"])
+
+    def test_invalid_params_return_400(self):
+        response = self.client.get(self.url, {"from": 2, "to": 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(self.url, {"cursor": "broken"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cache_invalidated_on_rename_and_delete(self):
+        self.client.get(self.url, {"limit": 2})
+
+        sync_metric_records_name(metric_id=self.metric.id, new_name="Renamed")
+
+        response = self.client.get(self.url, {"limit": 2})
+        self.assertEqual(response.json()["results"][0]["metric_name"], "Renamed")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MetricRecord.objects.get(timestamp=1700000009).delete()
+
+        response = self.client.get(self.url, {"limit": 2})
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000008)
+
+    def test_cache_invalidated_after_commit(self):
+        generation = metric_cache_generation(self.metric.id)
+        record = MetricRecord.objects.get(timestamp=1700000009)
+
+        for change in (
+            lambda: MetricRecord.objects.create(
+                metric=self.metric, value="1", timestamp=1700000100
+            ),
+            lambda: record.save(),
+            lambda: record.delete(),
+            lambda: delete_metrics(Metric.objects.filter(pk=self.metric.pk)),
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+                # До фиксации другой воркер построил бы страницу по старым данным
+                self.assertEqual(metric_cache_generation(self.metric.id), generation)
+            self.assertGreater(metric_cache_generation(self.metric.id), generation)
+            generation = metric_cache_generation(self.metric.id)
+
+    def page_cache_keys(self, **params) -> tuple[str, str]:
+        parts = (
+            "testserver",
+            *(
+                [params[name]] if name in params else []
+                for name in ("from", "to", "tags", "tags_all", "limit", "cursor")
+            ),
+        )
+        return (
+            metric_records_page_cache_key(self.metric.id, self.user.id, *parts),
+            metric_records_stale_cache_key(self.metric.id, self.user.id, *parts),
+        )
+
+    def test_concurrent_miss_gets_previous_copy_while_page_is_built(self):
+        previous = self.client.get(self.url, {"limit": "2"}).json()
+        self.client.post(
+            self.url, {"value": "1", "timestamp": 1700000100}, format="json"
+        )
+        key, _ = self.page_cache_keys(limit="2")
+        # Страницу нового поколения уже строит другой воркер
+        cache.add(f"{key}:lock", 1)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"limit": "2"})
+        self.assertEqual(response.json(), previous)
+
+        cache.delete(f"{key}:lock")
+        response = self.client.get(self.url, {"limit": "2"})
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000100)
+
+    def test_previous_copy_served_with_its_own_validators(self):
+        previous = self.client.get(self.url, {"limit": "2"})
+        self.client.post(
+            self.url, {"value": "1", "timestamp": 1700000100}, format="json"
+        )
+        key, _ = self.page_cache_keys(limit="2")
+        cache.add(f"{key}:lock", 1)
+
+        response = self.client.get(self.url, {"limit": "2"})
+        self.assertEqual(response.json(), previous.json())
+        self.assertEqual(response["ETag"], previous["ETag"])
+        self.assertEqual(response["Last-Modified"], previous["Last-Modified"])
+
+        cache.delete(f"{key}:lock")
+        response = self.client.get(
+            self.url, {"limit": "2"}, HTTP_IF_NONE_MATCH=previous["ETag"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000100)
+        self.assertNotEqual(response["ETag"], previous["ETag"])
+
+    @override_settings(METRIC_RECORDS_CACHE_LOCK_WAIT=0)
+    def test_concurrent_miss_without_previous_copy_builds_page(self):
+        key, _ = self.page_cache_keys(limit="2")
+        cache.add(f"{key}:lock", 1)
+
+        response = self.client.get(self.url, {"limit": "2"})
+
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000009)
+
+    @override_settings(METRIC_RECORDS_CACHE_SWR=True)
+    def test_stale_while_revalidate_refreshes_in_background(self):
+        previous = self.client.get(self.url, {"limit": "2"}).json()
+        self.client.post(
+            self.url, {"value": "1", "timestamp": 1700000100}, format="json"
+        )
+
+        with patch("metrics.views.refresh_metric_records_page.delay") as delay:
+            with self.assertNumQueries(0):
+                response = self.client.get(self.url, {"limit": "2"})
+            self.assertEqual(response.json(), previous)
+            # Повторный промах не запускает второе обновление
+            self.client.get(self.url, {"limit": "2"})
+        delay.assert_called_once()
+
+        refresh_metric_records_page(**delay.call_args.kwargs)
+
+        key, stale_key = self.page_cache_keys(limit="2")
+        self.assertIsNone(cache.get(f"{key}:lock"))
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"limit": "2"})
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000100)
+        self.assertEqual(
+            response.content, gzip.decompress(cache.get(stale_key).data.body)
+        )
+
+    @override_settings(METRIC_RECORDS_CACHE_SWR=True)
+    def test_background_refresh_keeps_lock_taken_over_by_another_worker(self):
+        self.client.get(self.url, {"limit": "2"})
+        self.client.post(
+            self.url, {"value": "1", "timestamp": 1700000100}, format="json"
+        )
+        with patch("metrics.views.refresh_metric_records_page.delay") as delay:
+            self.client.get(self.url, {"limit": "2"})
+        key, _ = self.page_cache_keys(limit="2")
+        lock_name = cache.make_and_validate_key(f"{key}:lock")
+        # Блокировка истекла, и её взял другой воркер
+        get_redis().set(lock_name, "other")
+
+        refresh_metric_records_page(**delay.call_args.kwargs)
+
+        self.assertEqual(get_redis().get(lock_name), b"other")
+        self.assertIsNone(cache.get(key))
+        get_redis().delete(lock_name)
+
+    def test_fast_read_path_matches_serializer_with_constant_queries(self):
+        first, second = Tag.objects.create(name="b"), Tag.objects.create(name="a")
+        records = list(MetricRecord.objects.order_by("-timestamp", "-id"))
+        for record in records[:5]:
+            record.tags.add(first, second)
+        records[5].tags.add(second)
+        MetricRecord.objects.filter(pk=records[6].pk).update(value="-0.0001")
+        MetricRecord.objects.filter(pk=records[7].pk).update(value="999999999999.9999")
+
+        # Первый запрос кеширует автора метрики
+        self.client.get(self.url, {"limit": "1"})
+        for limit in ("3", "10"):
+            with self.subTest(limit=limit), self.assertNumQueries(1):
+                response = self.client.get(self.url, {"limit": limit})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        expected = MetricRecordSerializer(
+            MetricRecord.objects.order_by("-timestamp", "-id").prefetch_related(
+                Prefetch("tags", Tag.objects.order_by("tagsmetricrecord__id"))
+            ),
+            many=True,
+        ).data
+        self.assertEqual(
+            response.content,
+            JSONRenderer().render({"next": None, "results": expected}),
+        )
+
+    def test_cached_page_served_as_precompressed_json(self):
+        plain = self.client.get(self.url, {"limit": "2"})
+
+        with self.assertNumQueries(0):
+            compressed = self.client.get(
+                self.url, {"limit": "2"}, HTTP_ACCEPT_ENCODING="gzip, deflate"
+            )
+
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertEqual(compressed["ETag"], plain["ETag"])
+        self.assertIn("Accept-Encoding", compressed["Vary"])
+        self.assertEqual(plain.json()["results"][0]["timestamp"], 1700000009)
+
+    def test_pages_cached_separately_and_invalidated_on_create(self):
+        first = self.client.get(self.url, {"limit": 2})
+        second = self.client.get(self.url, {"limit": 2, "from": 1700000005})
+        self.assertNotEqual(first.json(), second.json())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.client.get(self.url, {"limit": 2}).json(), first.json()
+            )
+
+        self.client.post(
+            self.url, {"value": "1", "timestamp": 1700000100}, format="json"
+        )
+
+        response = self.client.get(self.url, {"limit": 2})
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000100)
+        response = self.client.get(self.url, {"limit": 2, "from": 1700000005})
+        self.assertEqual(response.json()["results"][0]["timestamp"], 1700000100)
+
+
+class TagFilterTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.other_metric = Metric.objects.create(name="Other", author=self.user)
+        self.pump, self.well = (
+            Tag.objects.create(name="pump"),
+            Tag.objects.create(name="well"),
+        )
+        records = MetricRecord.objects.bulk_create(
+            MetricRecord(
+                metric=self.metric,
+                metric_name=self.metric.name,
+                value=1,
+                timestamp=1700000000 + i,
+            )
+            for i in range(4)
+        )
+        records[0].tags.add(self.pump)
+        records[1].tags.add(self.pump, self.well)
+        records[2].tags.add(self.well)
+        MetricRecord.objects.create(
+            metric=self.other_metric, value=1, timestamp=1700000000
+        ).tags.add(self.well)
+        self.url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def timestamps(self, **params) -> list[int]:
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item["timestamp"] - 1700000000 for item in response.json()["results"]]
+
+    def test_records_filtered_by_any_and_all_tags(self):
+        both = f"{self.pump.id},{self.well.id}"
+
+        self.assertEqual(self.timestamps(tags=both), [2, 1, 0])
+        self.assertEqual(self.timestamps(tags_all=both), [1])
+        self.assertEqual(
+            self.timestamps(tags=str(self.well.id), **{"from": 1700000002}), [2]
+        )
+        self.assertEqual(
+            self.client.get(self.url, {"tags_all": "pump"}).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    def test_metrics_filtered_by_tags(self):
+        url = reverse("metric-list-create")
+
+        response = self.client.get(url, {"tags": self.well.id})
+        self.assertEqual(
+            sorted(metric["id"] for metric in response.json()),
+            sorted([self.metric.id, self.other_metric.id]),
+        )
+        response = self.client.get(url, {"tags_all": f"{self.pump.id},{self.well.id}"})
+        self.assertEqual([metric["id"] for metric in response.json()], [self.metric.id])
+
+    def test_tag_filter_uses_tag_record_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute(
+                "EXPLAIN SELECT record_id FROM metrics_tagsmetricrecord WHERE tag_id = %s",
+                [self.pump.id],
+            )
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn("metrics_tag_record_idx", plan)
+
+
+class MetricRecordAggregateAPITestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.tag = Tag.objects.create(name="critical")
+        # 1700006400 - начало суток (UTC)
+        records = MetricRecord.objects.bulk_create(
+            MetricRecord(
+                metric=self.metric,
+                metric_name=self.metric.name,
+                value=value,
+                timestamp=1700006400 + offset,
+            )
+            for offset, value in ((0, 1), (1800, 3), (3600, 10), (7300, 4))
+        )
+        records[1].tags.add(self.tag)
+        records[3].tags.add(self.tag)
+        # bulk_create не обновляет агрегаты
+        rebuild_rollups(self.metric.id)
+        self.url = reverse(
+            "metric-record-aggregate",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_aggregate_by_hour(self):
+        response = self.client.get(self.url, {"bucket": "1h", "fn": "avg,max,count"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            [
+                {"bucket": 1700006400, "avg": "2.0000", "max": "3.0000", "count": 2},
+                {"bucket": 1700010000, "avg": "10.0000", "max": "10.0000", "count": 1},
+                {"bucket": 1700013600, "avg": "4.0000", "max": "4.0000", "count": 1},
+            ],
+        )
+
+    def test_aggregate_with_range_and_tags(self):
+        response = self.client.get(
+            self.url,
+            {
+                "bucket": "1d",
+                "fn": "sum,min",
+                "from": 1700006401,
+                "tags": str(self.tag.id),
+            },
+        )
+
+        self.assertEqual(
+            response.json(),
+            [{"bucket": 1700006400, "sum": "7.0000", "min": "3.0000"}],
+        )
+
+    def test_aggregate_with_all_tags(self):
+        other = Tag.objects.create(name="pump")
+        MetricRecord.objects.get(timestamp=1700006400 + 7300).tags.add(other)
+
+        response = self.client.get(
+            self.url,
+            {"bucket": "1d", "fn": "count", "tags_all": f"{self.tag.id},{other.id}"},
+        )
+
+        self.assertEqual(response.json(), [{"bucket": 1700006400, "count": 1}])
+
+    def test_aggregate_invalid_params(self):
+        response = self.client.get(self.url, {"bucket": "1y"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("bucket", response.data)
+
+        response = self.client.get(self.url, {"bucket": "1h", "fn": "median"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("fn", response.data)
+
+    def test_aggregate_cached_and_invalidated_on_create(self):
+        params = {"bucket": "1d", "fn": "count"}
+        self.assertEqual(self.client.get(self.url, params).json()[0]["count"], 4)
+
+        with self.assertNumQueries(0):
+            self.client.get(self.url, params)
+
+        self.client.post(
+            reverse(
+                "metric-record-list-create",
+                kwargs={"metric_id": self.metric.id},
+            ),
+            {"value": "1", "timestamp": 1700006500},
+            format="json",
+        )
+
+        self.assertEqual(self.client.get(self.url, params).json()[0]["count"], 5)
+
+
+class MetricRollupTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.client.force_authenticate(user=self.user)
+        self.aggregate_url = reverse(
+            "metric-record-aggregate",
+            kwargs={"metric_id": self.metric.id},
+        )
+
+    def rollup(self, resolution, bucket):
+        return MetricRollup.objects.get(
+            metric=self.metric, resolution=resolution, bucket=bucket
+        )
+
+    def test_rollups_updated_on_single_and_batch_create(self):
+        self.client.post(
+            reverse("metric-record-list-create", kwargs={"metric_id": self.metric.id}),
+            {"value": "5", "timestamp": 1700006400},
+            format="json",
+        )
+        self.client.post(
+            reverse("metric-record-batch-create", kwargs={"metric_id": self.metric.id}),
+            [
+                {"value": "1", "timestamp": 1700006430},
+                {"value": "9", "timestamp": 1700010000},
+            ],
+            format="json",
+        )
+
+        minute = self.rollup(MetricRollup.Resolution.MINUTE, 1700006400)
+        self.assertEqual((minute.count, minute.sum), (2, 6))
+        self.assertEqual((minute.min, minute.max), (1, 5))
+
+        day = self.rollup(MetricRollup.Resolution.DAY, 1700006400)
+        self.assertEqual((day.count, day.sum, day.min, day.max), (3, 15, 1, 9))
+
+    def test_rollups_refreshed_on_update_and_delete(self):
+        record = MetricRecord.objects.create(
+            metric=self.metric, value="5", timestamp=1700006400
+        )
+        MetricRecord.objects.create(metric=self.metric, value="7", timestamp=1700006401)
+
+        record.value = "1"
+        record.save()
+        minute = self.rollup(MetricRollup.Resolution.MINUTE, 1700006400)
+        self.assertEqual((minute.count, minute.sum, minute.min), (2, 8, 1))
+
+        record.delete()
+        minute = self.rollup(MetricRollup.Resolution.MINUTE, 1700006400)
+        self.assertEqual((minute.count, minute.sum, minute.min), (1, 7, 7))
+
+    def test_rebuild_task_repairs_rollups(self):
+        MetricRecord.objects.bulk_create(
+            MetricRecord(metric=self.metric, value=i, timestamp=1700006400 + i * 100)
+            for i in range(100)
+        )
+        self.assertFalse(MetricRollup.objects.exists())
+
+        rebuild_metric_rollups(metric_id=self.metric.id)
+
+        day = self.rollup(MetricRollup.Resolution.DAY, 1700006400)
+        self.assertEqual((day.count, day.sum), (100, sum(range(100))))
+        self.assertEqual(
+            MetricRollup.objects.filter(
+                resolution=MetricRollup.Resolution.MINUTE
+            ).count(),
+            100,
+        )
+
+    def test_rollup_aggregate_matches_raw_aggregate(self):
+        """Корзины из агрегатов с сырыми краями совпадают с расчётом по записям"""
+        MetricRecord.objects.bulk_create(
+            MetricRecord(
+                metric=self.metric, value=(i * 7) % 13, timestamp=1700006400 + i * 97
+            )
+            for i in range(500)
+        )
+        rebuild_rollups(self.metric.id)
+
+        for params in (
+            {"bucket": "1h"},
+            {"bucket": "2h", "from": 1700010123, "to": 1700040321},
+            {"bucket": "1d", "from": 1700006500},
+            {"bucket": "5m", "to": 1700020000},
+            {"bucket": "90s", "from": 1700007000, "to": 1700009000},
+        ):
+            params["fn"] = "avg,min,max,count,sum"
+            with self.subTest(params=params):
+                cache.clear()
+                with self.settings(METRIC_ROLLUPS_ENABLED=True):
+                    rollup_data = self.client.get(self.aggregate_url, params).json()
+                cache.clear()
+                with self.settings(METRIC_ROLLUPS_ENABLED=False):
+                    raw_data = self.client.get(self.aggregate_url, params).json()
+
+                self.assertTrue(raw_data)
+                self.assertEqual(rollup_data, raw_data)
+
+
+class MetricRecordExportTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.tag_a = Tag.objects.create(name="a")
+        self.tag_b = Tag.objects.create(name="b")
+        for i in range(5):
+            record = MetricRecord.objects.create(
+                metric=self.metric, value=f"{i}.5", timestamp=1700000000 + i
+            )
+            if i % 2:
+                record.tags.add(self.tag_b, self.tag_a)
+        self.url = reverse(
+            "metric-record-export",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    @staticmethod
+    def content(response) -> str:
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_csv(self):
+        response = self.client.get(self.url, {"format": "csv"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/csv"))
+        rows = list(csv.DictReader(io.StringIO(self.content(response))))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(
+            rows[1],
+            {
+                "id": str(MetricRecord.objects.get(timestamp=1700000001).id),
+                "metric_id": str(self.metric.id),
+                "metric_name": "Test Metric",
+                "timestamp": "1700000001",
+                "value": "1.5000",
+                "tags": "a|b",
+            },
+        )
+
+    def test_export_ndjson_with_filters(self):
+        response = self.client.get(
+            self.url,
+            {
+                "format": "ndjson",
+                "from": 1700000001,
+                "tags": str(self.tag_a.id),
+            },
+        )
+
+        rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([row["timestamp"] for row in rows], [1700000001, 1700000003])
+        self.assertEqual(rows[0]["tags"], ["a", "b"])
+        self.assertEqual(rows[0]["value"], "1.5000")
+
+    def test_export_other_user_metric_not_found(self):
+        other = User.objects.create_user(username="other", password="password123")
+        self.client.force_authenticate(user=other)
+
+        response = self.client.get(self.url, {"format": "ndjson"})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_command(self):
+        stdout = io.StringIO()
+
+        call_command(
+            "export_records",
+            self.metric.id,
+            "--format=ndjson",
+            "--to=1700000001",
+            stdout=stdout,
+        )
+
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([row["timestamp"] for row in rows], [1700000000, 1700000001])
+
+
+class ImportRecordsCommandTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.existing = MetricRecord.objects.create(
+            metric=self.metric, value="1", timestamp=1700000000
+        )
+        self.existing.tags.add(Tag.objects.create(name="old"))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def write(self, name: str, content: str) -> str:
+        path = Path(self.tmp_dir.name) / name
+        path.write_text(content, encoding="utf-8")
+        return str(path)
+
+    def import_records(self, *args) -> str:
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command("import_records", *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue() + stderr.getvalue()
+
+    def test_import_csv_skip_duplicates(self):
+        path = self.write(
+            "records.csv",
+            "metric_id,timestamp,value,tags\n"
+            f"{self.metric.id},1700000000,5,new\n"
+            f"{self.metric.id},1700000001,2.5,new|other\n"
+            f"{self.metric.id},1700000002,3,\n"
+            f"{self.metric.id},1700000002,4,\n"
+            f"{self.metric.id},bad,1,\n"
+            "999999,1700000003,1,\n",
+        )
+
+        output = self.import_records(path, "--chunk-size=2")
+
+        self.assertIn("добавлено 2", output)
+        self.assertIn("с ошибками 1", output)
+        self.assertIn("без метрики 1", output)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.value, 1)
+        self.assertEqual(
+            list(self.existing.tags.values_list("name", flat=True)), ["old"]
+        )
+
+        record = MetricRecord.objects.get(timestamp=1700000001)
+        self.assertEqual(record.metric_name, "Test Metric")
+        self.assertEqual(
+            sorted(record.tags.values_list("name", flat=True)), ["new", "other"]
+        )
+        # Из дублей в файле побеждает последняя строка
+        self.assertEqual(MetricRecord.objects.get(timestamp=1700000002).value, 4)
+        day = MetricRollup.objects.get(
+            metric=self.metric, resolution=MetricRollup.Resolution.DAY
+        )
+        self.assertEqual((day.count, day.sum), (3, Decimal("7.5")))
+
+    def test_import_ndjson_overwrite_and_cache_invalidation(self):
+        cache_key = MetricRecordQSMixin.metric_records_cache_key(
+            self.metric.id, self.user.id
+        )
+        cache.set(cache_key, [{"fake": "data"}], timeout=300)
+        path = self.write(
+            "records.ndjson",
+            json.dumps({"timestamp": 1700000000, "value": "7", "tags": ["new"]}),
+        )
+
+        output = self.import_records(
+            path, f"--metric={self.metric.id}", "--on-duplicate=overwrite"
+        )
+
+        self.assertIn("обновлено 1", output)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.value, 7)
+        self.assertEqual(
+            list(self.existing.tags.values_list("name", flat=True)), ["new"]
+        )
+        self.assertNotEqual(
+            MetricRecordQSMixin.metric_records_cache_key(self.metric.id, self.user.id),
+            cache_key,
+            "Инвалидация кеша не сработала",
+        )
+
+    def test_export_import_round_trip(self):
+        stdout = io.StringIO()
+        call_command("export_records", self.metric.id, stdout=stdout)
+        MetricRecord.objects.all().delete()
+
+        self.import_records(self.write("export.csv", stdout.getvalue()))
+
+        record = MetricRecord.objects.get()
+        self.assertEqual((record.timestamp, record.value), (1700000000, 1))
+        self.assertEqual(list(record.tags.values_list("name", flat=True)), ["old"])
+
+
+class SeedMetricsCommandTestCase(TestCase):
+    def seed(self) -> str:
+        stdout = io.StringIO()
+        call_command(
+            "seed_metrics",
+            "--users=2",
+            "--metrics=2",
+            "--tags=3",
+            "--records=50",
+            "--batch-size=20",
+            stdout=stdout,
+        )
+        return stdout.getvalue()
+
+    def test_seed_is_reproducible_and_idempotent(self):
+        self.seed()
+        values = list(
+            MetricRecord.objects.order_by(
+                "metric__author__username", "metric__name", "timestamp"
+            ).values_list(
+                "metric__author__username", "metric__name", "timestamp", "value"
+            )
+        )
+
+        self.assertEqual(len(values), 200)
+        self.assertEqual(TagsMetricRecord.objects.count(), 400)
+        self.assertEqual(Tag.objects.count(), 3)
+        self.assertEqual(
+            MetricRollup.objects.filter(resolution=MetricRollup.Resolution.DAY)
+            .values_list("count", flat=True)
+            .distinct()
+            .get(),
+            50,
+        )
+
+        output = self.seed()
+
+        self.assertIn("добавлено записей 0", output)
+        self.assertEqual(
+            list(
+                MetricRecord.objects.order_by(
+                    "metric__author__username", "metric__name", "timestamp"
+                ).values_list(
+                    "metric__author__username", "metric__name", "timestamp", "value"
+                )
+            ),
+            values,
+        )
+        self.assertEqual(TagsMetricRecord.objects.count(), 400)
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command("seed_metrics", "--tags=1", "--tags-per-record=2")
+
+
+@override_settings(METRIC_RECORDS_ASYNC_INGEST=True)
+class MetricRecordAsyncIngestTestCase(APITestCase):
+    KEYS = (
+        BUFFER_KEY,
+        PROCESSING_KEY,
+        DEAD_LETTER_KEY,
+        STATS_KEY,
+        "metrics:ingest:flush-lock",
+    )
+
+    def setUp(self):
+        get_redis().delete(*self.KEYS)
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        get_redis().delete(*self.KEYS)
+
+    def enqueue(self, metric: Metric, *timestamps: int) -> None:
+        enqueue_metric_records(
+            metric.id,
+            [
+                {"timestamp": timestamp, "value": Decimal("1")}
+                for timestamp in timestamps
+            ],
+            on_conflict="error",
+        )
+
+    def test_post_is_buffered_until_flush(self):
+        tag = Tag.objects.create(name="critical")
+        cache_key = MetricRecordQSMixin.metric_records_cache_key(
+            self.metric.id, self.user.id
+        )
+        cache.set(cache_key, [{"fake": "data"}], timeout=300)
+
+        response = self.client.post(
+            self.url,
+            {"value": "10.5", "timestamp": 1700000000, "tags": [tag.id]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(MetricRecord.objects.exists())
+        self.assertEqual(buffer_status()["depth"], 1)
+
+        self.assertEqual(flush_metric_records_buffer(), 1)
+
+        record = MetricRecord.objects.get()
+        self.assertEqual(
+            (record.timestamp, record.value), (1700000000, Decimal("10.5"))
+        )
+        self.assertEqual(list(record.tags.all()), [tag])
+        self.assertEqual(buffer_status()["depth"], 0)
+        self.assertNotEqual(
+            MetricRecordQSMixin.metric_records_cache_key(self.metric.id, self.user.id),
+            cache_key,
+            "Инвалидация кеша не сработала",
+        )
+
+    def test_batch_queues_only_valid_items(self):
+        url = reverse(
+            "metric-record-batch-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        payload = [
+            {"value": "1", "timestamp": 1700000000},
+            {"value": "2", "timestamp": -1},
+            {"value": "3", "timestamp": 1700000000},
+        ]
+
+        response = self.client.post(url + "?on_conflict=update", payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual([item["index"] for item in response.data["queued"]], [0, 2])
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1])
+
+        flush_metric_records_buffer()
+
+        self.assertEqual(MetricRecord.objects.get().value, 3)
+
+    def test_status_requires_admin(self):
+        url = reverse("metric-ingest-status")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_user(
+            username="admin", password="password123", is_staff=True
+        )
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["depth"], 0)
+        self.assertIsNone(response.data["lag_seconds"])
+
+    def test_update_without_tags_keeps_tags(self):
+        tag = Tag.objects.create(name="critical")
+        record = MetricRecord.objects.create(
+            metric=self.metric, value="1", timestamp=1700000000
+        )
+        record.tags.add(tag)
+
+        enqueue_metric_records(
+            self.metric.id,
+            [{"timestamp": 1700000000, "value": Decimal("2")}],
+            on_conflict="update",
+        )
+        flush_metric_records_buffer()
+
+        record.refresh_from_db()
+        self.assertEqual((record.value, list(record.tags.all())), (2, [tag]))
+
+    def test_interrupted_flush_resumed(self):
+        self.enqueue(self.metric, 1700000000, 1700000001, 1700000002)
+
+        # Воркер забрал пачку и упал до записи
+        self.assertEqual(len(claim_batch(2)), 2)
+        self.assertEqual(
+            (buffer_status()["depth"], buffer_status()["processing"]), (1, 2)
+        )
+
+        self.assertEqual(flush_metric_records_buffer(), 3)
+        self.assertEqual(MetricRecord.objects.count(), 3)
+        self.assertEqual(
+            (buffer_status()["depth"], buffer_status()["processing"]), (0, 0)
+        )
+
+    def test_failing_group_moved_to_dead_letter(self):
+        other = Metric.objects.create(name="Other", author=self.user)
+        self.enqueue(self.metric, 1700000000)
+        self.enqueue(other, 1700000000)
+
+        def write(metric, records_data, on_conflict):
+            if metric == self.metric:
+                raise DatabaseError("broken")
+            return write_metric_records(metric, records_data, on_conflict)
+
+        with patch("metrics.ingest.write_metric_records", side_effect=write):
+            self.assertEqual(flush_metric_records_buffer(), 2)
+
+        self.assertEqual(
+            list(MetricRecord.objects.values_list("metric_id", flat=True)), [other.id]
+        )
+        self.assertEqual(buffer_status()["processing"], 0)
+        self.assertEqual(buffer_status()["dead_letter"], 1)
+        [dead_letter] = get_redis().lrange(DEAD_LETTER_KEY, 0, -1)
+        self.assertEqual(json.loads(dead_letter)["metric_id"], self.metric.id)
+
+    def test_flush_lock_released_only_by_owner(self):
+        lock_key = "metrics:ingest:flush-lock"
+        get_redis().set(lock_key, "other")
+        self.enqueue(self.metric, 1700000000)
+        self.assertEqual(flush_metric_records_buffer(), 0)
+        get_redis().delete(lock_key)
+
+        def expire_lock(batch_size):
+            # Блокировка истекла, и её взял другой воркер
+            get_redis().set(lock_key, "other")
+            return flush_buffer(batch_size)
+
+        with patch("metrics.tasks.flush_buffer", side_effect=expire_lock):
+            self.assertEqual(flush_metric_records_buffer(), 1)
+        self.assertEqual(get_redis().get(lock_key), b"other")
+
+
+class LocalCacheTestCase(APITestCase):
+    def setUp(self):
+        get_local_cache().clear()
+        cache.delete(TAGS_CACHE_KEY)
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_lru_limits_size_and_ttl(self):
+        local = LocalLRUCache(max_items=2, ttl=60)
+        local.set("a", 1)
+        local.set("b", 2)
+        local.get("a")
+        local.set("c", 3)
+
+        self.assertEqual((local.get("a"), local.get("b"), local.get("c")), (1, None, 3))
+
+        expired = LocalLRUCache(max_items=2, ttl=0)
+        expired.set("a", 1)
+        self.assertIsNone(expired.get("a"))
+
+    def test_value_read_before_invalidation_is_not_kept(self):
+        local = LocalLRUCache(max_items=10, ttl=60)
+        epoch = local.epoch
+        local.delete_prefix("metric:1:")
+        local.set("metric:1:generation", 1, epoch)
+
+        self.assertIsNone(local.get("metric:1:generation"))
+
+    def test_metric_invalidation_is_broadcast(self):
+        get_local_cache().set("metric:42:generation", 1)
+        get_local_cache().set("metric:421:generation", 1)
+        with get_redis().pubsub() as pubsub:
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            pubsub.get_message(timeout=1)
+
+            invalidate_metric_cache(42)
+
+            message = pubsub.get_message(timeout=1)
+        self.assertEqual(message["data"], b"metric:42:")
+        self.assertIsNone(get_local_cache().get("metric:42:generation"))
+        self.assertEqual(get_local_cache().get("metric:421:generation"), 1)
+
+        get_local_cache().set(TAGS_CACHE_KEY, "rendered")
+        handle_invalidation(TAGS_CACHE_KEY.encode())
+        self.assertIsNone(get_local_cache().get(TAGS_CACHE_KEY))
+
+    def test_tag_list_cached_and_invalidated_on_change(self):
+        Tag.objects.create(name="b")
+        url = reverse("tag-list")
+        self.assertEqual([tag["name"] for tag in self.client.get(url).json()], ["b"])
+
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name="a")
+
+        self.assertEqual(
+            [tag["name"] for tag in self.client.get(url).json()], ["a", "b"]
+        )
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        # Поколения и авторы метрик с теми же id могли остаться от прошлых запусков
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        MetricRecord.objects.create(
+            metric=self.metric, value="1.0000", timestamp=1700000000
+        )
+        self.records_url = reverse(
+            "metric-record-list-create",
+            kwargs={"metric_id": self.metric.id},
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def assert_revalidated(self, url: str, change) -> None:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        # If-Modified-Since учитывается только для версии на границе секунды
+        version = int(etag.rstrip('"').rsplit("-", 1)[1])
+        self.assertEqual(
+            response.status_code,
+            (
+                status.HTTP_304_NOT_MODIFIED
+                if version % 1000 == 0
+                else status.HTTP_200_OK
+            ),
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_records_not_modified_until_write(self):
+        self.assert_revalidated(
+            self.records_url,
+            lambda: self.client.post(
+                self.records_url,
+                {"value": "2", "timestamp": 1700000001},
+                format="json",
+            ),
+        )
+
+    def test_metrics_not_modified_until_metric_change(self):
+        self.assert_revalidated(
+            reverse("metric-list-create"),
+            lambda: Metric.objects.create(name="Other", author=self.user),
+        )
+
+    def test_tags_not_modified_until_tag_change(self):
+        self.assert_revalidated(
+            reverse("tag-list"), lambda: Tag.objects.create(name="critical")
+        )
+
+    def test_foreign_metric_gets_no_validators(self):
+        aggregate_url = (
+            reverse("metric-record-aggregate", kwargs={"metric_id": self.metric.id})
+            + "?bucket=60"
+        )
+        owner_etags = {
+            url: self.client.get(url)["ETag"]
+            for url in (self.records_url, aggregate_url)
+        }
+        other = User.objects.create_user(username="other", password="password123")
+        self.client.force_authenticate(user=other)
+
+        for url, etag in owner_etags.items():
+            response = self.client.get(
+                url,
+                HTTP_IF_NONE_MATCH=etag,
+                HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 3600),
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn("Last-Modified", response)
+            self.assertNotEqual(response.get("ETag"), etag)
+
+        # После смены автора валидаторы получает только новый автор
+        with self.captureOnCommitCallbacks(execute=True):
+            self.metric.author = other
+            self.metric.save()
+        response = self.client.get(self.records_url)
+        self.assertIn("Last-Modified", response)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.records_url)
+        self.assertNotIn("Last-Modified", response)
+
+    def test_if_modified_since_ignored_within_second(self):
+        request = RequestFactory().get(
+            "/", HTTP_IF_MODIFIED_SINCE=http_date(1700000000)
+        )
+        earlier = Validators.for_version(1700000000100, "scope")
+        later = Validators.for_version(1700000000900, "scope")
+        self.assertEqual(earlier.last_modified, later.last_modified)
+        self.assertNotEqual(earlier.etag, later.etag)
+
+        self.assertIsNone(later.not_modified(request))
+        response = Validators.for_version(1700000000000, "scope").not_modified(request)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        request = RequestFactory().get("/", HTTP_IF_NONE_MATCH=later.etag)
+        self.assertEqual(later.not_modified(request).status_code, 304)
+
+    def test_concurrent_bumps_get_distinct_versions(self):
+        key = f"{self.id()}:version"
+        self.addCleanup(cache.delete, key)
+        cache.set(key, int(time.time() * 1000) + 60_000, timeout=None)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            versions = list(executor.map(lambda _: bump_version(key), range(100)))
+
+        self.assertEqual(len(set(versions)), 100)
+        self.assertEqual(cache.get(key), max(versions))
+
+
+@override_settings(METRIC_RECORDS_PARTITION_INTERVAL="month")
+class MetricRecordPartitioningTestCase(APITestCase):
+    # 2023-10-11 и 2023-11-14 UTC
+    OCTOBER, NOVEMBER = 1697000000, 1700000000
+
+    def setUp(self):
+        if is_partitioned():
+            self.skipTest("Таблица секционирована миграцией")
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.tag = Tag.objects.create(name="pump")
+        self.october = MetricRecord.objects.create(
+            metric=self.metric, value="1", timestamp=self.OCTOBER
+        )
+        self.november = MetricRecord.objects.create(
+            metric=self.metric, value="2", timestamp=self.NOVEMBER
+        )
+        self.november.tags.add(self.tag)
+        self.assertEqual(ensure_partitions(), [])
+        self.assertTrue(partition_metric_records(ahead=1))
+        self.client.force_authenticate(user=self.user)
+
+    def partition_of(self, record_id: int) -> str:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT tableoid::regclass::text FROM metrics_metricrecord WHERE id = %s",
+                [record_id],
+            )
+            return cursor.fetchone()[0]
+
+    def test_records_moved_and_orm_keeps_working(self):
+        self.assertTrue(is_partitioned())
+        self.assertFalse(partition_metric_records())
+        self.assertEqual(self.partition_of(self.october.id), partition_name(1696118400))
+        self.assertEqual(
+            list(self.tag.metric_records.values_list("id", flat=True)),
+            [self.november.id],
+        )
+
+        url = reverse("metric-record-list-create", kwargs={"metric_id": self.metric.id})
+        response = self.client.post(
+            url, {"value": "3", "timestamp": self.NOVEMBER + 1, "tags": [self.tag.id]}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(response.data["id"], self.november.id)
+        response = self.client.get(url, {"from": self.NOVEMBER, "tags": self.tag.id})
+        self.assertEqual(
+            [item["timestamp"] for item in response.json()["results"]],
+            [self.NOVEMBER + 1, self.NOVEMBER],
+        )
+
+        self.november.delete()
+        self.assertFalse(TagsMetricRecord.objects.filter(record_id=self.november.id))
+
+    def test_time_bounded_query_reads_one_partition(self):
+        view = MetricRecordQSMixin()
+        view.kwargs = {"metric_id": self.metric.id}
+        view.request = Mock(user=self.user)
+        queryset = filter_time_range(
+            view.get_queryset(), self.NOVEMBER, self.NOVEMBER + 60
+        )
+        plan = queryset.explain()
+
+        self.assertIn(partition_name(1698796800), plan)
+        self.assertNotIn(partition_name(1696118400), plan)
+        self.assertNotIn(DEFAULT_PARTITION, plan)
+
+    def test_future_partitions_take_rows_from_default(self):
+        # 2030-01-15: секции на этот месяц ещё нет
+        future = MetricRecord.objects.create(
+            metric=self.metric, value="4", timestamp=1894665600
+        )
+        self.assertEqual(self.partition_of(future.id), DEFAULT_PARTITION)
+
+        created = ensure_partitions(ahead=1, now=1894665600)
+
+        self.assertEqual(
+            created, [partition_name(1893456000), partition_name(1896134400)]
+        )
+        self.assertEqual(self.partition_of(future.id), partition_name(1893456000))
+        self.assertEqual(ensure_partitions(ahead=1, now=1894665600), [])
+        self.assertIsInstance(create_metric_record_partitions(), list)
+
+
+class MetricRecordRetentionTestCase(APITestCase):
+    NOW = 1700000000
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.short = Metric.objects.create(
+            name="short", author=self.user, retention_days=90
+        )
+        self.default = Metric.objects.create(name="default", author=self.user)
+        self.forever = Metric.objects.create(
+            name="forever", author=self.user, retention_days=0
+        )
+        self.tag = Tag.objects.create(name="pump")
+        self.expired = MetricRecord.objects.bulk_create(
+            MetricRecord(
+                metric=metric,
+                metric_name=metric.name,
+                value=1,
+                timestamp=self.NOW - 200 * DAY + i,
+            )
+            for i, metric in enumerate(
+                (self.short, self.short, self.default, self.forever)
+            )
+        )
+        for record in self.expired:
+            record.tags.add(self.tag)
+        self.recent = MetricRecord.objects.create(
+            metric=self.short, value=1, timestamp=self.NOW - 10 * DAY
+        )
+
+    def remaining(self) -> dict[str, int]:
+        return dict(
+            MetricRecord.objects.values_list("metric__name").annotate(count=Count("id"))
+        )
+
+    def test_global_default_keeps_records(self):
+        report = purge_expired_records(now=self.NOW, batch_size=1, pause=0)
+
+        self.assertEqual(report["metrics"], {self.short.id: 2})
+        self.assertTrue(report["finished"])
+        self.assertEqual(self.remaining(), {"short": 1, "default": 1, "forever": 1})
+
+    @override_settings(METRIC_RECORDS_RETENTION_DAYS=30)
+    def test_expired_records_purged_in_batches(self):
+        generation = metric_records_page_cache_key(self.short.id, self.user.id)
+
+        report = purge_expired_records(now=self.NOW, batch_size=1, pause=0)
+
+        self.assertEqual(report["deleted"], 3)
+        self.assertEqual(report["metrics"], {self.short.id: 2, self.default.id: 1})
+        self.assertEqual(self.remaining(), {"short": 1, "forever": 1})
+        self.assertEqual(
+            list(TagsMetricRecord.objects.values_list("record__metric", flat=True)),
+            [self.forever.id],
+        )
+        self.assertNotEqual(
+            metric_records_page_cache_key(self.short.id, self.user.id), generation
+        )
+        self.assertEqual(purge_expired_records(now=self.NOW)["deleted"], 0)
+
+    def test_time_budget_stops_purge(self):
+        with patch("metrics.retention.time.monotonic", side_effect=[0, 0, 1000]):
+            report = purge_expired_records(
+                now=self.NOW, batch_size=1, pause=0, max_seconds=10
+            )
+
+        self.assertEqual(report["deleted"], 1)
+        self.assertFalse(report["finished"])
+
+    @override_settings(
+        METRIC_RECORDS_PARTITION_INTERVAL="month", METRIC_RECORDS_RETENTION_DAYS=30
+    )
+    def test_expired_partitions_dropped(self):
+        if is_partitioned():
+            self.skipTest("Таблица секционирована миграцией")
+        partition_metric_records()
+        Metric.objects.filter(pk=self.forever.pk).update(retention_days=120)
+        # 2023-04-28: апрельская секция старше срока всех метрик
+        april = partition_name(1680307200)
+        self.assertIn(april, partition_ranges())
+
+        report = purge_expired_records(now=self.NOW, pause=0)
+
+        self.assertEqual(report["partitions"], [april])
+        self.assertNotIn(april, partition_ranges())
+        self.assertEqual(report["deleted"], 4)
+        self.assertEqual(self.remaining(), {"short": 1})
+        self.assertFalse(TagsMetricRecord.objects.exists())
+
+    @override_settings(
+        METRIC_RECORDS_PARTITION_INTERVAL="month", METRIC_RECORDS_RETENTION_DAYS=30
+    )
+    def test_time_budget_checked_while_partition_links_deleted(self):
+        if is_partitioned():
+            self.skipTest("Таблица секционирована миграцией")
+        partition_metric_records()
+        Metric.objects.filter(pk=self.forever.pk).update(retention_days=120)
+        april = partition_name(1680307200)
+
+        with patch("metrics.retention.time.monotonic", side_effect=[0, 0, 1000]):
+            report = purge_expired_records(
+                now=self.NOW, batch_size=1, pause=0, max_seconds=10
+            )
+
+        self.assertEqual(report["partitions"], [])
+        self.assertFalse(report["finished"])
+        self.assertIn(april, partition_ranges())
+        self.assertEqual(TagsMetricRecord.objects.count(), 3)
+
+    def test_task_lock_released_only_by_owner(self):
+        lock_key = "metrics:retention:purge-lock"
+        self.addCleanup(get_redis().delete, lock_key)
+        get_redis().set(lock_key, "other")
+        self.assertIsNone(purge_expired_metric_records())
+        get_redis().delete(lock_key)
+
+        def expire_lock():
+            # Блокировка истекла, и её взял другой воркер
+            get_redis().set(lock_key, "other")
+            return purge_expired_records()
+
+        with patch("metrics.tasks.purge_expired_records", side_effect=expire_lock):
+            self.assertEqual(purge_expired_metric_records()["deleted"], 3)
+        self.assertEqual(get_redis().get(lock_key), b"other")
+
+    def test_task_reports_and_api_exposes_retention(self):
+        self.assertEqual(purge_expired_metric_records()["deleted"], 3)
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(
+            reverse("metric-list-create"),
+            {"name": "new", "retention_days": 30},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["retention_days"], 30)
+
+
+@override_settings(METRIC_ARCHIVE_AFTER_DAYS=30, METRIC_ARCHIVE_WINDOW=3600)
+class MetricRecordArchiveTestCase(APITestCase):
+    # 2023-11-14 22:00 UTC, начало часового окна
+    START = 1699999200
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.tag_a = Tag.objects.create(name="a")
+        self.tag_b = Tag.objects.create(name="b")
+        # Три часовых окна по 12 записей с шагом 5 минут, последнее - свежее
+        for i in range(36):
+            record = MetricRecord.objects.create(
+                metric=self.metric, value=f"{i - 10}.25", timestamp=self.START + i * 300
+            )
+            if i % 3 == 0:
+                record.tags.add(self.tag_b, self.tag_a)
+            elif i % 3 == 1:
+                record.tags.add(self.tag_a)
+        self.client.force_authenticate(user=self.user)
+
+    def archive(self) -> int:
+        archived = archive_metric_records(self.metric.id, before=self.START + 2 * 3600)
+        cache.clear()
+        return archived
+
+    def url(self, name: str) -> str:
+        return reverse(name, kwargs={"metric_id": self.metric.id})
+
+    def get_all_pages(self, params: dict) -> list[dict]:
+        results = []
+        response = self.client.get(self.url("metric-record-list-create"), params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            page = response.json()
+            results.extend(page["results"])
+            if page["next"] is None:
+                return results
+            response = self.client.get(page["next"])
+
+    def test_archive_task_lock_released_only_by_owner(self):
+        lock_key = "metrics:archive:lock"
+        self.addCleanup(get_redis().delete, lock_key)
+        get_redis().set(lock_key, "other")
+        self.assertEqual(archive_old_metric_records(), 0)
+        get_redis().delete(lock_key)
+        Metric.objects.create(name="Other", author=self.user)
+
+        def expire_lock(metric_id, before):
+            # Блокировка истекла, и её взял другой воркер
+            get_redis().set(lock_key, "other")
+            return 1
+
+        with patch(
+            "metrics.tasks.archive_metric_records", side_effect=expire_lock
+        ) as archive:
+            self.assertEqual(archive_old_metric_records(), 1)
+        archive.assert_called_once()
+        self.assertEqual(get_redis().get(lock_key), b"other")
+
+    def test_codec_roundtrip(self):
+        records = [
+            ArchivedRecord(10, 1700000000, Decimal("-12.5000"), (3, 1)),
+            ArchivedRecord(11, 1700000060, Decimal("0.0001"), ()),
+            ArchivedRecord(15, 1700000121, Decimal("999999999999.9999"), (2,)),
+            ArchivedRecord(12, 1700005000, Decimal("-0.0001"), (1, 2, 3)),
+        ]
+        self.assertEqual(decode_records(encode_records(records)), records)
+        self.assertEqual(decode_records(encode_records([])), [])
+
+    def test_regular_series_compressed(self):
+        records = [
+            ArchivedRecord(1000 + i, 1700000000 + i * 60, Decimal(i % 50) / 4, ())
+            for i in range(1440)
+        ]
+        # id, timestamp и value в таблице занимают не меньше 24 байт на запись
+        self.assertLess(len(encode_records(records)), 1440)
+
+    def test_archive_moves_closed_windows_to_chunks(self):
+        self.assertEqual(self.archive(), 24)
+
+        self.assertEqual(MetricRecord.objects.count(), 12)
+        self.assertEqual(
+            list(
+                MetricRecordChunk.objects.order_by("start").values_list(
+                    "start", "end", "count"
+                )
+            ),
+            [
+                (self.START, self.START + 3600, 12),
+                (self.START + 3600, self.START + 7200, 12),
+            ],
+        )
+        # Связи остались только у свежих записей
+        self.assertEqual(TagsMetricRecord.objects.count(), 12)
+        self.assertEqual(self.archive(), 0)
+
+    def test_reads_identical_after_archive(self):
+        queries = (
+            {"limit": 5},
+            {"limit": 7, "from": self.START + 1500, "to": self.START + 9000},
+            {"limit": 4, "tags": self.tag_b.id},
+            {"limit": 50, "tags_all": f"{self.tag_a.id},{self.tag_b.id}"},
+        )
+        aggregates = (
+            {"bucket": "1h", "fn": "avg,min,max,count,sum"},
+            {"bucket": "15m", "fn": "count,sum", "from": self.START + 100},
+            {
+                "bucket": "1h",
+                "fn": "count",
+                "from": self.START + 60,
+                "to": self.START + 8000,
+            },
+            {"bucket": "7m", "fn": "avg", "tags": self.tag_a.id},
+        )
+
+        def snapshot():
+            return (
+                [self.get_all_pages(params) for params in queries],
+                [
+                    self.client.get(self.url("metric-record-aggregate"), params).json()
+                    for params in aggregates
+                ],
+                b"".join(
+                    self.client.get(
+                        self.url("metric-record-export"), {"format": "ndjson"}
+                    ).streaming_content
+                ),
+            )
+
+        before = snapshot()
+        self.archive()
+        after = snapshot()
+
+        self.assertEqual(len(before[0][0]), 36)
+        self.assertEqual(after, before)
+
+    def test_export_command_reads_archive(self):
+        expected = io.StringIO()
+        call_command(
+            "export_records", self.metric.id, "--format=ndjson", stdout=expected
+        )
+        self.archive()
+        output = io.StringIO()
+        call_command("export_records", self.metric.id, "--format=ndjson", stdout=output)
+
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_write_into_archived_window_restores_chunk(self):
+        self.archive()
+        url = self.url("metric-record-list-create")
+
+        response = self.client.post(url, {"timestamp": self.START, "value": "1"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            list(MetricRecordChunk.objects.values_list("start", flat=True)),
+            [self.START + 3600],
+        )
+        self.assertEqual(MetricRecord.objects.count(), 24)
+        self.assertEqual(MetricRecord.objects.get(timestamp=self.START).tags.count(), 2)
+
+        response = self.client.post(url, {"timestamp": self.START + 3601, "value": "1"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(MetricRecordChunk.objects.exists())
+        self.assertEqual(MetricRecord.objects.count(), 37)
+
+    @override_settings(METRIC_RECORDS_RETENTION_DAYS=1)
+    def test_retention_trims_chunks(self):
+        self.archive()
+
+        report = purge_expired_records(now=self.START + DAY + 1800, pause=0)
+
+        self.assertEqual(report["deleted"], 6)
+        self.assertEqual(
+            list(
+                MetricRecordChunk.objects.order_by("start").values_list(
+                    "count", flat=True
+                )
+            ),
+            [6, 12],
+        )
+
+    def test_rollup_rebuild_keeps_archived_records(self):
+        expected = list(
+            MetricRollup.objects.order_by("resolution", "bucket").values_list(
+                "resolution", "bucket", "count", "sum", "min", "max"
+            )
+        )
+        self.archive()
+
+        rebuild_metric_rollups(self.metric.id)
+
+        self.assertEqual(
+            list(
+                MetricRollup.objects.order_by("resolution", "bucket").values_list(
+                    "resolution", "bucket", "count", "sum", "min", "max"
+                )
+            ),
+            expected,
+        )
+
+    def test_restore_command_returns_records(self):
+        self.archive()
+
+        call_command("restore_metric_archive", stdout=io.StringIO())
+
+        self.assertFalse(MetricRecordChunk.objects.exists())
+        self.assertEqual(MetricRecord.objects.count(), 36)
+        self.assertEqual(TagsMetricRecord.objects.count(), 36)
+
+
+@override_settings(METRIC_RETENTION_BATCH_SIZE=2, METRIC_RETENTION_BATCH_PAUSE=0)
+class MetricDeletionTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.metric = Metric.objects.create(name="Test Metric", author=self.user)
+        self.other = Metric.objects.create(name="Other", author=self.user)
+        self.tag = Tag.objects.create(name="pump")
+        for metric in (self.metric, self.other):
+            for i in range(5):
+                record = MetricRecord.objects.create(
+                    metric=metric, value=i, timestamp=1700000000 + i
+                )
+                record.tags.add(self.tag)
+        self.url = reverse("metric-detail", kwargs={"metric_id": self.metric.id})
+        self.client.force_authenticate(user=self.user)
+
+    def test_delete_hides_metric_and_enqueues_purge(self):
+        records_url = reverse(
+            "metric-record-list-create", kwargs={"metric_id": self.metric.id}
+        )
+        self.assertEqual(len(self.client.get(records_url).json()["results"]), 5)
+
+        with patch(
+            "metrics.tasks.purge_deleted_metric_records.delay"
+        ) as delay, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        delay.assert_called_once_with(metric_id=self.metric.id)
+        # Записи удаляются в фоне, но из API метрика пропадает сразу
+        self.assertEqual(MetricRecord.objects.filter(metric=self.metric).count(), 5)
+        self.assertEqual(
+            [
+                item["id"]
+                for item in self.client.get(reverse("metric-list-create")).data
+            ],
+            [self.other.id],
+        )
+        self.assertEqual(self.client.get(records_url).json()["results"], [])
+        response = self.client.post(records_url, {"timestamp": 1700001000, "value": 1})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            self.client.delete(self.url).status_code, status.HTTP_404_NOT_FOUND
+        )
+
+        response = self.client.post(
+            reverse("metric-list-create"), {"name": "Test Metric"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_task_purges_marked_metrics_in_batches(self):
+        self.client.delete(self.url)
+        self.assertTrue(MetricRollup.objects.filter(metric=self.metric).exists())
+
+        self.assertEqual(purge_deleted_metric_records(), 5)
+
+        self.assertFalse(Metric.objects.filter(pk=self.metric.pk).exists())
+        self.assertFalse(MetricRollup.objects.filter(metric_id=self.metric.id).exists())
+        self.assertEqual(MetricRecord.objects.count(), 5)
+        self.assertEqual(TagsMetricRecord.objects.count(), 5)
+        # Неудалённые метрики задача не трогает
+        self.assertEqual(purge_deleted_metric_records(metric_id=self.other.id), 0)
+        self.assertTrue(Metric.objects.filter(pk=self.other.pk).exists())
+
+    def test_task_lock_released_only_by_owner(self):
+        self.client.delete(self.url)
+        lock_key = f"metrics:delete:{self.metric.id}:lock"
+        self.addCleanup(get_redis().delete, lock_key)
+        get_redis().set(lock_key, "other")
+        self.assertEqual(purge_deleted_metric_records(metric_id=self.metric.id), 0)
+        self.assertTrue(Metric.objects.filter(pk=self.metric.pk).exists())
+        get_redis().delete(lock_key)
+
+        def expire_lock(metric_id):
+            # Блокировка истекла, и её взял другой воркер
+            get_redis().set(lock_key, "other")
+            return purge_deleted_metric(metric_id)
+
+        with patch("metrics.tasks.purge_deleted_metric", side_effect=expire_lock):
+            self.assertEqual(purge_deleted_metric_records(metric_id=self.metric.id), 5)
+        self.assertEqual(get_redis().get(lock_key), b"other")
+
+    def test_admin_delete_marks_metric(self):
+        admin = User.objects.create_superuser(username="admin", password="password")
+        self.client.force_login(admin)
+        url = reverse("admin:metrics_metric_delete", args=[self.metric.id])
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        response = self.client.post(url, {"post": "yes"})
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.metric.refresh_from_db()
+        self.assertIsNotNone(self.metric.deleted_at)
+        self.assertEqual(MetricRecord.objects.filter(metric=self.metric).count(), 5)
+
+        self.client.post(
+            reverse("admin:metrics_metric_changelist"),
+            {
+                "action": "delete_selected",
+                "_selected_action": [self.other.id],
+                "post": "yes",
+            },
+        )
+        self.assertFalse(Metric.objects.active().exists())
+
+
+class TelemetryTestCase(APITestCase):
+    def setUp(self):
+        get_local_cache().clear()
+        self.user = User.objects.create_user(
+            username="testuser",
+            password="password123",
+        )
+        self.client.force_authenticate(user=self.user)
+        self.metric = Metric.objects.create(name="Metric", author=self.user)
+        invalidate_metric_cache(self.metric.id)
+        flush()
+        get_redis().delete(TELEMETRY_KEY)
+
+    def samples(self) -> dict:
+        flush()
+        raw = get_redis().hgetall(TELEMETRY_KEY)
+        return {field.decode(): float(value) for field, value in raw.items()}
+
+    def test_key_family(self):
+        self.assertEqual(
+            key_family(f"metric:5:1700000000123:7:records:{'a' * 32}"),
+            "metric:*:records",
+        )
+        self.assertEqual(key_family("metric:5:generation"), "metric:*:generation")
+        self.assertEqual(key_family("tags:list"), "tags:list")
+
+    def test_request_recorded_by_route(self):
+        url = reverse("metric-record-list-create", kwargs={"metric_id": self.metric.id})
+        self.client.get(url)
+        self.client.get(url)
+
+        samples = self.samples()
+        labels = 'route="api/metrics/<int:metric_id>/records/",method="GET"'
+        self.assertEqual(samples[f'http_requests_total{{{labels},status="200"}}'], 2)
+        self.assertEqual(samples[f"http_request_duration_seconds_count{{{labels}}}"], 2)
+        self.assertEqual(samples[f"db_queries_per_request_count{{{labels}}}"], 2)
+        self.assertEqual(samples[f"http_response_size_bytes_count{{{labels}}}"], 2)
+        # Первый запрос строит страницу, второй отдаётся из кеша процесса
+        cache_reads = (
+            'cache_requests_total{family="metric:*:records",tier="%s",result="%s"}'
+        )
+        self.assertEqual(samples[cache_reads % ("local", "miss")], 1)
+        self.assertEqual(samples[cache_reads % ("redis", "miss")], 1)
+        self.assertEqual(samples[cache_reads % ("local", "hit")], 1)
+
+        self.client.get("/missing/")
+        self.assertIn(
+            'http_requests_total{route="<unmatched>",method="GET",status="404"}',
+            self.samples(),
+        )
+
+    def test_render_cumulative_buckets(self):
+        for value in (0.003, 0.02, 0.02, 20):
+            observe(
+                "http_request_duration_seconds", {"route": "r"}, value, (0.01, 0.05)
+            )
+
+        lines = render().splitlines()
+
+        self.assertIn("# TYPE http_request_duration_seconds histogram", lines)
+        self.assertIn("# TYPE cache_requests_total counter", lines)
+        buckets = [
+            line
+            for line in lines
+            if line.startswith("http_request_duration_seconds_bucket")
+        ]
+        self.assertEqual(
+            buckets,
+            [
+                'http_request_duration_seconds_bucket{route="r",le="0.01"} 1',
+                'http_request_duration_seconds_bucket{route="r",le="0.05"} 3',
+                'http_request_duration_seconds_bucket{route="r",le="+Inf"} 4',
+            ],
+        )
+        self.assertIn('http_request_duration_seconds_count{route="r"} 4', lines)
+
+    @override_settings(METRIC_TELEMETRY_TOKEN="secret")
+    def test_endpoint_token(self):
+        url = reverse("telemetry")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        for header in ("Bearer secre", "Bearer secret2", "secret"):
+            response = self.client.get(url, HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION="Bearer secret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(b"# TYPE http_requests_total counter", response.content)
+
+    def test_endpoint_staff_only_without_token(self):
+        url = reverse("telemetry")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(
+            User.objects.create_user(username="staff", is_staff=True)
+        )
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(METRIC_TELEMETRY_FLUSH_INTERVAL=3600)
+    def test_request_flush_throttled(self):
+        flush()
+        self.client.get(reverse("tag-list"))
+
+        sample = 'http_requests_total{route="api/tags/",method="GET",status="200"}'
+        self.assertNotIn(sample.encode(), get_redis().hgetall(TELEMETRY_KEY))
+        self.assertEqual(self.samples()[sample], 1)
+
+    def test_idle_process_flushed_in_background(self):
+        self.client.get(reverse("tag-list"))
+
+        self.assertIn(
+            "metrics-telemetry-flush",
+            [thread.name for thread in threading.enumerate()],
+        )
+
+    @override_settings(METRIC_TELEMETRY_ENABLED=False)
+    def test_disabled(self):
+        self.client.get(reverse("tag-list"))
+
+        self.assertEqual(self.samples(), {})
+
+
+class TaskTelemetryTestCase(APITestCase):
+    QUEUE = "telemetry-test"
+
+    def setUp(self):
+        flush()
+        get_redis().delete(TELEMETRY_KEY, LAST_SUCCESS_KEY)
+        self.addCleanup(get_redis().delete, self.QUEUE)
+
+    def samples(self) -> dict:
+        flush()
+        raw = get_redis().hgetall(TELEMETRY_KEY)
+        return {field.decode(): float(value) for field, value in raw.items()}
+
+    def test_queue_wait_counts_from_eta(self):
+        request = Mock(
+            eta=None, headers={PUBLISHED_AT_HEADER: 100.0}, spec=["eta", "headers"]
+        )
+        self.assertEqual(queue_wait(request, 130.0), 30.0)
+
+        request.eta = "1970-01-01T00:02:00+00:00"
+        self.assertEqual(queue_wait(request, 130.0), 10.0)
+
+        request.headers = {}
+        self.assertIsNone(queue_wait(request, 130.0))
+
+    def test_task_runs_recorded(self):
+        repair_recent_metric_rollups.apply()
+        with patch(
+            "metrics.tasks.sync_metric_records_name", side_effect=RuntimeError("db")
+        ), self.assertLogs("celery.app.trace", level="ERROR"):
+            update_metric_records_name.apply(args=(1, "name"))
+
+        samples = self.samples()
+        task = 'celery_tasks_total{task="metrics.tasks.%s",state="%s"}'
+        self.assertEqual(samples[task % ("repair_recent_metric_rollups", "SUCCESS")], 1)
+        self.assertEqual(samples[task % ("update_metric_records_name", "RETRY")], 5)
+        self.assertEqual(samples[task % ("update_metric_records_name", "FAILURE")], 1)
+        self.assertEqual(
+            samples[
+                'celery_task_runtime_seconds_count{task="metrics.tasks.repair_recent_metric_rollups"}'
+            ],
+            1,
+        )
+        self.assertEqual(
+            set(get_redis().hgetall(LAST_SUCCESS_KEY)),
+            {b"metrics.tasks.repair_recent_metric_rollups"},
+        )
+
+    @override_settings(METRIC_TELEMETRY_FLUSH_INTERVAL=3600)
+    def test_task_flush_throttled_until_process_shutdown(self):
+        flush()
+        repair_recent_metric_rollups.apply()
+        self.assertEqual(get_redis().hgetall(TELEMETRY_KEY), {})
+
+        worker_process_shutdown.send(sender=None, pid=os.getpid(), exitcode=0)
+
+        sample = 'celery_tasks_total{task="metrics.tasks.repair_recent_metric_rollups",state="SUCCESS"}'
+        self.assertEqual(
+            float(get_redis().hget(TELEMETRY_KEY, sample)),
+            1,
+        )
+
+    def test_status_view(self):
+        url = reverse("task-queue-status")
+        user = User.objects.create_user(username="user", password="password123")
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        now = time.time()
+        for age in (30, 10):
+            message = {"headers": {PUBLISHED_AT_HEADER: now - age}, "body": ""}
+            get_redis().lpush(self.QUEUE, json.dumps(message))
+        get_redis().hset(
+            LAST_SUCCESS_KEY,
+            mapping={
+                "metrics.tasks.generate_report": now - 3600,
+                "metrics.tasks.purge_deleted_metric_records": now,
+            },
+        )
+        admin = User.objects.create_superuser(username="admin", password="password")
+        self.client.force_authenticate(user=admin)
+
+        with patch("metrics.task_telemetry.queue_names", return_value=[self.QUEUE]):
+            data = self.client.get(url).json()
+
+        [queue] = data["queues"]
+        self.assertEqual((queue["name"], queue["depth"]), (self.QUEUE, 2))
+        self.assertAlmostEqual(queue["oldest_age_seconds"], 30, delta=5)
+        schedules = {schedule["name"]: schedule for schedule in data["schedules"]}
+        self.assertTrue(schedules["generate-report"]["overdue"])
+        self.assertFalse(schedules["purge-deleted-metric-records"]["overdue"])
+        self.assertIsNone(schedules["repair-metric-rollups"]["last_success_at"])
+        self.assertIsNone(schedules["repair-metric-rollups"]["overdue"])
+
+
+@override_settings(METRIC_SLOW_QUERY_THRESHOLD_MS=5)
+class SlowQueryLogTestCase(TestCase):
+    SLOW_SQL = (
+        "SELECT pg_sleep(0.01), count(*) FROM metrics_metricrecord WHERE metric_id = %s"
+    )
+
+    def setUp(self):
+        clear_slow_queries()
+        cache.delete(EXPLAIN_LOCK_KEY)
+
+    def run_slow_query(self, metric_id: int = 1) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(self.SLOW_SQL, [metric_id])
+
+    def test_slow_query_captured_with_explain_sample(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.run_slow_query(7)
+        self.run_slow_query(8)
+
+        second, first = slow_queries()
+        self.assertEqual(first["sql"], self.SLOW_SQL)
+        self.assertEqual(first["params"], [7])
+        self.assertGreaterEqual(first["duration_ms"], 5)
+        self.assertIn("run_slow_query", first["stack"][-1])
+        self.assertIn("actual time", first["explain"])
+        # EXPLAIN снимается не чаще раза в METRIC_SLOW_QUERY_EXPLAIN_INTERVAL
+        self.assertEqual(second["params"], [8])
+        self.assertIsNone(second["explain"])
+
+    def test_connection_opened_inside_request(self):
+        """Обёртка не подменяет обёртку телеметрии, открытой раньше соединения."""
+        client = APIClient()
+        client.force_authenticate(user=User(id=1, username="thread-user"))
+        url = reverse("metric-list-create")
+        wrappers = []
+
+        def run():
+            try:
+                for _ in range(3):
+                    client.get(url, {"tags": 1})
+                    wrappers.append(list(connection.execute_wrappers))
+                    connection.close()
+            finally:
+                connection.close()
+
+        perf_counter = Mock(side_effect=itertools.count(0, 1))
+        with patch(
+            "metrics.slow_queries.time", Mock(perf_counter=perf_counter, time=time.time)
+        ):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(wrappers, [[capture_slow_queries]] * 3)
+        self.assertEqual(
+            [entry["stack"][-1].split(":")[0] for entry in slow_queries()],
+            ["metrics/views.py"] * 3,
+        )
+
+    def test_analyze_only_for_select_without_side_effects(self):
+        cases = {
+            " select * from metrics_metric": EXPLAIN_ANALYZE,
+            "DELETE FROM metrics_metric": EXPLAIN,
+            "WITH batch AS (SELECT 1) DELETE FROM t": EXPLAIN,
+            "SELECT pg_advisory_xact_lock(1)": EXPLAIN,
+            "SELECT setval('seq', 5)": EXPLAIN,
+            "SELECT nextval('seq')": EXPLAIN,
+            'SELECT * FROM "metrics_metricrecordchunk" FOR UPDATE': EXPLAIN,
+            "SELECT * FROM t FOR NO KEY UPDATE": EXPLAIN,
+            "SELECT * FROM t FOR SHARE": EXPLAIN,
+            "CREATE TABLE t (id int)": None,
+            "SAVEPOINT s1": None,
+        }
+        for sql, command in cases.items():
+            with self.subTest(sql):
+                self.assertEqual(explain_command(sql), command)
+
+    def test_explain_changes_rolled_back(self):
+        Tag.objects.create(name="kept")
+
+        plan = explain(connection, "DELETE FROM metrics_tag", [], EXPLAIN_ANALYZE)
+
+        self.assertIn("actual time", plan)
+        self.assertTrue(Tag.objects.filter(name="kept").exists())
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY SEQUENCE explain_seq")
+            plan = explain(connection, "SELECT nextval('explain_seq')", [], EXPLAIN)
+            cursor.execute("SELECT nextval('explain_seq')")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertNotIn("actual time", plan)
+
+    @override_settings(METRIC_SLOW_QUERY_THRESHOLD_MS=0)
+    def test_disabled_by_default(self):
+        self.run_slow_query()
+
+        self.assertEqual(slow_queries(), [])
+
+    def test_admin_browse_export_and_clear(self):
+        self.run_slow_query()
+        admin = User.objects.create_superuser(username="admin", password="password")
+        self.client.force_login(admin)
+
+        response = self.client.get(reverse("admin:metrics_metricrecord_slow_queries"))
+        self.assertContains(response, "pg_sleep(0.01)")
+        self.assertContains(response, "EXPLAIN (ANALYZE, BUFFERS)")
+
+        response = self.client.get(
+            reverse("admin:metrics_metricrecord_slow_queries_export")
+        )
+        exported = [json.loads(line) for line in response.content.splitlines()]
+        self.assertIn(self.SLOW_SQL, [entry["sql"] for entry in exported])
+
+        self.client.post(reverse("admin:metrics_metricrecord_slow_queries_clear"))
+        self.assertEqual(slow_queries(), [])
+
+    def test_admin_views_superuser_only(self):
+        self.run_slow_query()
+        staff = User.objects.create_user(
+            username="staff", password="password", is_staff=True
+        )
+        staff.user_permissions.add(
+            *Permission.objects.filter(content_type__app_label="metrics")
+        )
+        self.client.force_login(staff)
+
+        response = self.client.get(reverse("admin:metrics_metricrecord_changelist"))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(
+            response, reverse("admin:metrics_metricrecord_slow_queries")
+        )
+        for name in ("slow_queries", "slow_queries_export"):
+            response = self.client.get(reverse(f"admin:metrics_metricrecord_{name}"))
+            self.assertEqual(response.status_code, 403)
+        response = self.client.post(
+            reverse("admin:metrics_metricrecord_slow_queries_clear")
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertNotEqual(slow_queries(), [])
+
+
+class RedisCallCounter:
+    """Обращения к Redis: отдельная команда или pipeline целиком."""
+
+    def __enter__(self):
+        self.count = 0
+        self._patches = [
+            patch.object(cls, name, self._counted(getattr(cls, name)))
+            for cls, name in (
+                (redis.Redis, "execute_command"),
+                (redis.client.Pipeline, "execute"),
+            )
+        ]
+        for patcher in self._patches:
+            patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in self._patches:
+            patcher.stop()
+
+    def _counted(self, method):
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return method(*args, **kwargs)
+
+        return wrapper
+
+
+class QueryBudgetMixin:
+    """
+    Число запросов к БД и обращений к Redis на каждый маршрут при холодном
+    кеше не должно превышать бюджет. Бюджеты админки включают запросы сессии
+    и прав пользователя. Сброс телеметрии выполняется до замера, чтобы
+    периодический flush не попадал в счёт.
+    """
+
+    # Маршрут: (запросов к БД, обращений к Redis)
+    BUDGETS = {
+        "metric-list": (1, 1),
+        "metric-list-tags": (1, 0),
+        "metric-create": (1, 4),
+        "metric-rename": (2, 3),
+        "metric-delete": (3, 7),
+        "ingest-status": (0, 1),
+        "task-queue-status": (0, 2),
+        "tag-list": (1, 3),
+        "record-detail": (2, 0),
+        "record-list": (2, 8),
+        "record-list-tags": (2, 8),
+        "record-create": (9, 5),
+        "record-batch-create": (7, 5),
+        "record-export": (2, 0),
+        "aggregate": (2, 8),
+        "aggregate-tags": (2, 8),
+        "admin-metric-changelist": (6, 0),
+        "admin-record-changelist": (7, 0),
+        "admin-tag-changelist": (5, 0),
+    }
+
+    def seed(self, records: int) -> Metric:
+        call_command(
+            "seed_metrics",
+            prefix="budget",
+            metrics=3,
+            tags=10,
+            records=records,
+            stdout=io.StringIO(),
+        )
+        return Metric.objects.active().get(
+            name="budget-metric-0", author__username="budget-user-0"
+        )
+
+    def routes(self, metric: Metric) -> dict:
+        user = metric.author
+        record_id = MetricRecord.objects.filter(metric=metric).values_list(
+            "id", flat=True
+        )[0]
+        kwargs = {"metric_id": metric.id}
+        tag_id = Tag.objects.get(name="budget-tag-1").id
+        records_url = reverse("metric-record-list-create", kwargs=kwargs)
+        next_ts = (
+            MetricRecord.objects.filter(metric=metric)
+            .order_by("-timestamp")
+            .values_list("timestamp", flat=True)[0]
+        )
+        new_records = [
+            {"timestamp": next_ts + i + 1, "value": "1.5", "tags": ["budget-tag-0"]}
+            for i in range(10)
+        ]
+
+        def api(method, url, data=None, as_user=user):
+            self.covered_routes.add(resolve(url).route)
+
+            def request():
+                self.client.force_authenticate(user=as_user)
+                return getattr(self.client, method)(url, data, format="json")
+
+            return request
+
+        def admin(url_name):
+            # Админка работает по сессии из force_login
+            return lambda: self.client.get(reverse(url_name))
+
+        def rename():
+            metric.name = "budget-renamed"
+            metric.save()
+
+        return {
+            "metric-list": api("get", reverse("metric-list-create")),
+            "metric-list-tags": api(
+                "get", reverse("metric-list-create"), {"tags": tag_id}
+            ),
+            "metric-create": api(
+                "post", reverse("metric-list-create"), {"name": "budget-new"}
+            ),
+            "metric-rename": rename,
+            "metric-delete": api("delete", reverse("metric-detail", kwargs=kwargs)),
+            "ingest-status": api(
+                "get", reverse("metric-ingest-status"), as_user=self.admin
+            ),
+            "task-queue-status": api(
+                "get", reverse("task-queue-status"), as_user=self.admin
+            ),
+            "tag-list": api("get", reverse("tag-list")),
+            "record-detail": api("get", f"{records_url}{record_id}/"),
+            "record-list": api("get", records_url),
+            "record-list-tags": api("get", records_url, {"tags": tag_id}),
+            "record-create": api("post", records_url, new_records[0]),
+            "record-batch-create": api(
+                "post",
+                reverse("metric-record-batch-create", kwargs=kwargs),
+                new_records,
+            ),
+            "record-export": api(
+                "get",
+                reverse("metric-record-export", kwargs=kwargs),
+                {"format": "ndjson"},
+            ),
+            "aggregate": api(
+                "get",
+                reverse("metric-record-aggregate", kwargs=kwargs),
+                {"bucket": "1h", "fn": "avg,count"},
+            ),
+            "aggregate-tags": api(
+                "get",
+                reverse("metric-record-aggregate", kwargs=kwargs),
+                {"bucket": "1h", "tags": tag_id},
+            ),
+            "admin-metric-changelist": admin("admin:metrics_metric_changelist"),
+            "admin-record-changelist": admin("admin:metrics_metricrecord_changelist"),
+            "admin-tag-changelist": admin("admin:metrics_tag_changelist"),
+        }
+
+    def reset_caches(self, metric: Metric) -> None:
+        get_local_cache().clear()
+        invalidate_metric_cache(metric.id)
+        invalidate_metric_owner(metric.id)
+        invalidate_user_metrics(metric.author_id)
+        invalidate_tags_cache()
+
+    def call(self, request) -> None:
+        response = request()
+        if response is not None:
+            self.assertIn(response.status_code, (200, 201, 204))
+            if response.streaming:
+                b"".join(response.streaming_content)
+
+    def measure(self, request) -> tuple[int, int]:
+        """Запросы к БД и Redis за один вызов; изменения данных откатываются."""
+        flush()
+        with transaction.atomic():
+            with CaptureQueriesContext(
+                connection
+            ) as queries, RedisCallCounter() as calls:
+                # Сброс кеша откладывается до фиксации и тоже входит в бюджет
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.call(request)
+            transaction.set_rollback(True)
+        return len(queries), calls.count
+
+
+@override_settings(METRIC_TELEMETRY_FLUSH_INTERVAL=3600)
+class QueryBudgetTestCase(QueryBudgetMixin, APITestCase):
+    """Счётчики не должны зависеть от числа записей."""
+
+    SIZES = (1, 100, 10_000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username="admin", password="admin")
+
+    def test_query_budgets(self):
+        self.covered_routes = set()
+        counts = {}
+        for size in self.SIZES:
+            with transaction.atomic():
+                metric = self.seed(size)
+                self.client.force_login(self.admin)
+                for name, request in self.routes(metric).items():
+                    # Первый вызов прогревает кеши процесса (ContentType, права)
+                    for _ in range(2):
+                        self.reset_caches(metric)
+                        counts.setdefault(name, {})[size] = self.measure(request)
+                transaction.set_rollback(True)
+
+        self.assertEqual(set(counts), set(self.BUDGETS))
+        self.assertEqual(
+            self.covered_routes,
+            {f"api/{pattern.pattern}" for pattern in metrics_urls.urlpatterns},
+        )
+        for name, by_size in counts.items():
+            with self.subTest(name, counts=by_size):
+                self.assertEqual(
+                    len(set(by_size.values())), 1, "растёт с числом записей"
+                )
+                queries, redis_calls = by_size[self.SIZES[-1]]
+                budget_queries, budget_redis = self.BUDGETS[name]
+                self.assertLessEqual(queries, budget_queries, "запросов к БД")
+                self.assertLessEqual(redis_calls, budget_redis, "обращений к Redis")
+
+
+@override_settings(METRIC_TELEMETRY_FLUSH_INTERVAL=3600)
+class FreshConnectionQueryBudgetTestCase(QueryBudgetMixin, APITransactionTestCase):
+    """
+    Каждый запрос выполняется в новом потоке, и соединение с БД открывается
+    уже внутри middleware, как у свежего воркера. Счётчики повторных вызовов
+    не должны расти, а обёртки execute_wrapper - оставаться на соединении.
+    """
+
+    READ_ROUTES = (
+        "metric-list",
+        "metric-list-tags",
+        "tag-list",
+        "record-detail",
+        "record-list",
+        "record-list-tags",
+        "record-export",
+        "aggregate",
+        "aggregate-tags",
+        "admin-metric-changelist",
+        "admin-record-changelist",
+        "admin-tag-changelist",
+    )
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="admin")
+        self.covered_routes = set()
+
+    def measure_fresh(self, request) -> tuple[int, int]:
+        flush()
+
+        def run():
+            # Без ensure_connection: соединение потока открывает сам запрос
+            connection.force_debug_cursor = True
+            try:
+                with RedisCallCounter() as calls:
+                    self.call(request)
+                self.assertEqual(connection.execute_wrappers, [capture_slow_queries])
+                return len(connection.queries_log), calls.count
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(run).result()
+
+    def test_query_budgets(self):
+        metric = self.seed(100)
+        self.client.force_login(self.admin)
+        routes = self.routes(metric)
+        for name in self.READ_ROUTES:
+            counts = []
+            for _ in range(3):
+                self.reset_caches(metric)
+                counts.append(self.measure_fresh(routes[name]))
+            with self.subTest(name, counts=counts):
+                # Первый вызов прогревает кеши процесса (ContentType, права)
+                self.assertEqual(len(set(counts[1:])), 1, "растёт от вызова к вызову")
+                queries, redis_calls = counts[-1]
+                budget_queries, budget_redis = self.BUDGETS[name]
+                self.assertLessEqual(queries, budget_queries, "запросов к БД")
+                self.assertLessEqual(redis_calls, budget_redis, "обращений к Redis")
+
+
 class MetricNameSyncSignalsTestCase(TestCase):
     def test_sync_fallback_used_if_celery_enqueue_failed(self):
         user = User.objects.create_user(username="sync-user", password="password123")
@@ -167,12 +2959,13 @@ class MetricNameSyncSignalsTestCase(TestCase):
             "metrics.signals.update_metric_records_name.delay",
             side_effect=RuntimeError("broker down"),
         ):
-            with self.captureOnCommitCallbacks(execute=True) as callbacks :
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
                 metric.name = "New Name"
                 metric.save()
 
         record.refresh_from_db()
-        assert len(callbacks) == 1
+        # Запуск задачи и сброс версии списка метрик автора
+        assert len(callbacks) == 2
         self.assertEqual(
             record.metric_name,
             "New Name",
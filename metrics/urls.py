@@ -1,25 +1,63 @@
 from django.urls import path
 
 from metrics.views import (
+    IngestBufferStatusAPIView,
+    MetricDetailAPIView,
     MetricListCreateAPIView,
+    MetricRecordAggregateAPIView,
+    MetricRecordBatchCreateAPIView,
     MetricRecordDetailAPIView,
+    MetricRecordExportAPIView,
     MetricRecordListCreateAPIView,
     TagListAPIView,
+    TaskQueueStatusAPIView,
 )
 
 urlpatterns = [
     path(
         "metrics/",
         MetricListCreateAPIView.as_view(),
+        name="metric-list-create",
+    ),
+    path(
+        "metrics/<int:metric_id>/",
+        MetricDetailAPIView.as_view(),
+        name="metric-detail",
+    ),
+    path(
+        "metrics/ingest/status/",
+        IngestBufferStatusAPIView.as_view(),
+        name="metric-ingest-status",
+    ),
+    path(
+        "metrics/tasks/status/",
+        TaskQueueStatusAPIView.as_view(),
+        name="task-queue-status",
     ),
     path(
         "tags/",
         TagListAPIView.as_view(),
+        name="tag-list",
     ),
     path(
         "metrics/<int:metric_id>/records/<int:record_id>/",
         MetricRecordDetailAPIView.as_view(),
     ),
+    path(
+        "metrics/<int:metric_id>/aggregate/",
+        MetricRecordAggregateAPIView.as_view(),
+        name="metric-record-aggregate",
+    ),
+    path(
+        "metrics/<int:metric_id>/records/export/",
+        MetricRecordExportAPIView.as_view(),
+        name="metric-record-export",
+    ),
+    path(
+        "metrics/<int:metric_id>/records/batch/",
+        MetricRecordBatchCreateAPIView.as_view(),
+        name="metric-record-batch-create",
+    ),
     path(
         "metrics/<int:metric_id>/records/",
         MetricRecordListCreateAPIView.as_view(),
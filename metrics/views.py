@@ -1,24 +1,83 @@
+import io
 import logging
+from urllib.parse import urlsplit
 
-from django.core.cache import cache
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from metrics.models import Metric, MetricRecord, Tag
-from metrics.serializers import MetricRecordSerializer, MetricSerializer, TagSerializer
+from metrics import cache as metrics_cache
+from metrics.aggregation import aggregate_metric_records, aggregate_metric_rollups
+from metrics.archive import archive_enabled, iter_archived_rows
+from metrics.export import EXPORT_FIELDS, iter_export_rows
+from metrics.filters import (
+    TagFilterBackend,
+    TimeRangeFilterBackend,
+    filter_metrics_by_tags,
+)
+from metrics.ingest import buffer_status, enqueue_metric_records
+from metrics.models import Metric, MetricRecord, MetricRecordChunk, MetricRollup, Tag
+from metrics.pagination import MetricRecordCursorPagination
+from metrics.renderers import CSVRenderer, NDJSONRenderer
+from metrics.responses import (
+    RenderedJSON,
+    Validators,
+    render_json,
+    rendered_json_response,
+)
+from metrics.serializers import (
+    MetricRecordAggregateQuerySerializer,
+    MetricRecordAggregateSerializer,
+    MetricRecordSerializer,
+    MetricSerializer,
+    OnConflictQuerySerializer,
+    TagFilterQuerySerializer,
+    TagSerializer,
+    TimeRangeQuerySerializer,
+    metric_record_row_data,
+    metric_record_rows,
+)
+from metrics.services import CONFLICT, CREATED, SKIPPED, write_metric_records
+from metrics.task_telemetry import queue_status
+from metrics.tasks import delete_metrics, refresh_metric_records_page
 
 logger = logging.getLogger("metrics.views")
 
 
 class MetricListCreateAPIView(APIView):
     def get(self, request):
-        metrics = Metric.objects.filter(author=request.user)
+        tag_filter = TagFilterQuerySerializer(data=request.query_params)
+        tag_filter.is_valid(raise_exception=True)
+        if tag_filter.validated_data:
+            # Теги записей меняются при каждой записи, версия списка метрик их не учитывает
+            metrics = filter_metrics_by_tags(
+                Metric.objects.active().filter(author=request.user),
+                tag_filter.validated_data.get("tags"),
+                tag_filter.validated_data.get("tags_all"),
+            )
+            return Response(MetricSerializer(metrics, many=True).data)
+
+        validators = Validators.for_version(
+            metrics_cache.user_metrics_version(request.user.id),
+            "metrics",
+            request.user.id,
+        )
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
+
+        metrics = Metric.objects.active().filter(author=request.user)
         serializer = MetricSerializer(metrics, many=True)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        validators.apply(response)
+        return response
 
     def post(self, request):
         serializer = MetricSerializer(data=request.data)
@@ -32,11 +91,44 @@ class MetricListCreateAPIView(APIView):
         )
 
 
+class MetricDetailAPIView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def delete(self, request, metric_id: int):
+        """
+        Метрика сразу скрывается из API, её записи удаляются в фоне
+        пачками (tasks.purge_deleted_metric_records).
+        """
+        metric = get_object_or_404(
+            Metric.objects.active(), id=metric_id, author=request.user
+        )
+        delete_metrics(Metric.objects.filter(pk=metric.pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class TagListAPIView(ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = TagSerializer
     queryset = Tag.objects.all().order_by("name")
 
+    def list(self, request, *args, **kwargs):
+        validators = Validators.for_version(metrics_cache.tags_version(), "tags")
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
+
+        rendered = metrics_cache.get_two_tier(metrics_cache.TAGS_CACHE_KEY)
+        if rendered is None:
+            rendered = render_json(super().list(request, *args, **kwargs).data)
+            metrics_cache.set_two_tier(
+                metrics_cache.TAGS_CACHE_KEY,
+                rendered,
+                timeout=metrics_cache.TAGS_CACHE_TIMEOUT,
+            )
+        response = rendered_json_response(request, rendered)
+        validators.apply(response)
+        return response
+
 
 class MetricRecordQSMixin:
     serializer_class = MetricRecordSerializer
@@ -47,53 +139,423 @@ class MetricRecordQSMixin:
         return MetricRecord.objects.filter(
             metric_id=self.kwargs["metric_id"],
             metric__author=self.request.user,
+            metric__deleted_at__isnull=True,
         ).order_by("-timestamp")
 
+    def get_archived_rows(
+        self,
+        descending: bool = False,
+        before: tuple[int, int] | None = None,
+        from_ts: int | None = None,
+        to_ts: int | None = None,
+    ):
+        """
+        Записи метрики из архивных чанков с фильтрами from/to/tags/tags_all
+        запроса, None - если архив выключен. from_ts/to_ts сужают диапазон.
+        """
+        if not archive_enabled():
+            return None
+        time_range = TimeRangeQuerySerializer(data=self.request.query_params)
+        time_range.is_valid(raise_exception=True)
+        tag_filter = TagFilterQuerySerializer(data=self.request.query_params)
+        tag_filter.is_valid(raise_exception=True)
+        return iter_archived_rows(
+            MetricRecordChunk.objects.filter(
+                metric_id=self.kwargs["metric_id"],
+                metric__author=self.request.user,
+                metric__deleted_at__isnull=True,
+            ),
+            from_ts=(
+                time_range.validated_data.get("from") if from_ts is None else from_ts
+            ),
+            to_ts=time_range.validated_data.get("to") if to_ts is None else to_ts,
+            tags=tag_filter.validated_data.get("tags"),
+            tags_all=tag_filter.validated_data.get("tags_all"),
+            descending=descending,
+            before=before,
+        )
+
     @staticmethod
     def metric_records_cache_key(metric_id: int, user_id: int) -> str:
-        return f"metric:{metric_id}:{user_id}:records"
+        return metrics_cache.metric_records_cache_key(metric_id, user_id)
+
+    def get_tag_context(self, items: list) -> dict:
+        """
+        Контекст сериализатора со всеми тегами элементов, переданными по id:
+        один запрос к БД вместо запроса на каждый тег.
+        """
+        tag_ids = set()
+        for item in items:
+            if hasattr(item, "getlist"):
+                tags = item.getlist("tags")
+            else:
+                tags = item.get("tags") if isinstance(item, dict) else None
+            if not isinstance(tags, list):
+                continue
+            for tag_id in tags:
+                if isinstance(tag_id, bool):
+                    continue
+                try:
+                    tag_ids.add(int(tag_id))
+                except (TypeError, ValueError):
+                    continue
+        return {**self.get_serializer_context(), "tags": Tag.objects.in_bulk(tag_ids)}
+
+    @staticmethod
+    def is_metric_owner(metric_id: int, user_id: int) -> bool:
+        """
+        Пользователь - автор активной метрики. Автор кешируется до его смены
+        или удаления метрики, поэтому на горячем пути запроса к БД нет.
+        """
+        key = metrics_cache.metric_owner_cache_key(metric_id)
+        owner_id = metrics_cache.get_two_tier(key)
+        if owner_id is None:
+            owner_id = (
+                Metric.objects.active()
+                .filter(pk=metric_id)
+                .values_list("author_id", flat=True)
+                .first()
+            ) or 0
+            metrics_cache.set_two_tier(
+                key, owner_id, timeout=metrics_cache.METRIC_RECORDS_CACHE_TIMEOUT
+            )
+        return owner_id == user_id
+
+    @staticmethod
+    def get_validators(metric_id: int, user_id: int, generation: int) -> Validators:
+        """ETag/Last-Modified записей метрики по поколению её кеша, без запросов к БД."""
+        return Validators.for_version(generation, metric_id, user_id)
 
 
 class MetricRecordListCreateAPIView(MetricRecordQSMixin, generics.GenericAPIView):
+    filter_backends = (TimeRangeFilterBackend, TagFilterBackend)
+    pagination_class = MetricRecordCursorPagination
+    cache_query_params = ("from", "to", "tags", "tags_all", "limit", "cursor")
+
     def get(self, request, metric_id: int):
         user_id = request.user.id
-        cache_key = self.metric_records_cache_key(metric_id, user_id)
-        cached_data = cache.get(cache_key)
+        parts = (
+            request.get_host(),
+            *(request.query_params.getlist(param) for param in self.cache_query_params),
+        )
 
-        if cached_data is not None:
-            logger.debug(f"Отдаю записи метрики ID {metric_id} из кеша.")
-            return Response(cached_data)
+        generation = metrics_cache.metric_cache_generation(metric_id)
+        # Чужой метрике валидаторы не отдаются: по ним видно время её изменения
+        owner = self.is_metric_owner(metric_id, user_id)
+        if owner:
+            not_modified = self.get_validators(
+                metric_id, user_id, generation
+            ).not_modified(request)
+            if not_modified is not None:
+                return not_modified
 
-        records = self.get_queryset()
-        serializer = self.get_serializer(records, many=True)
+        def enqueue_refresh(lock_key: str, lock_token: str) -> None:
+            refresh_metric_records_page.delay(
+                metric_id=metric_id,
+                user_id=user_id,
+                url=request.build_absolute_uri(),
+                parts=parts,
+                lock_key=lock_key,
+                lock_token=lock_token,
+            )
 
-        cache.set(cache_key, serializer.data, timeout=60 * 5)
+        generation, rendered = metrics_cache.get_or_build_metric_records_page(
+            metric_id,
+            user_id,
+            parts,
+            build=self.build_page,
+            refresh=enqueue_refresh if settings.METRIC_RECORDS_CACHE_SWR else None,
+            generation=generation,
+        )
+        response = rendered_json_response(request, rendered)
+        if owner:
+            self.get_validators(metric_id, user_id, generation).apply(response)
+        return response
 
-        return Response(serializer.data)
+    def build_page(self) -> RenderedJSON:
+        """Страница записей для текущего запроса в том виде, в котором она кешируется."""
+        logger.debug(f"Строю страницу записей метрики ID {self.kwargs['metric_id']}.")
+        rows = self.paginate_queryset(
+            metric_record_rows(self.filter_queryset(self.get_queryset()))
+        )
+        data = [metric_record_row_data(row) for row in rows]
+        return render_json(self.get_paginated_response(data).data)
+
+    @classmethod
+    def build_page_for_url(cls, metric_id: int, user, url: str) -> RenderedJSON:
+        """Строит страницу вне HTTP-запроса, например в фоновом обновлении кеша."""
+        parts = urlsplit(url)
+        http_request = WSGIRequest(
+            {
+                "REQUEST_METHOD": "GET",
+                "PATH_INFO": parts.path,
+                "QUERY_STRING": parts.query,
+                "HTTP_HOST": parts.netloc,
+                "SERVER_NAME": parts.hostname,
+                "SERVER_PORT": str(
+                    parts.port or (443 if parts.scheme == "https" else 80)
+                ),
+                "wsgi.url_scheme": parts.scheme,
+                "wsgi.input": io.BytesIO(),
+            }
+        )
+        view = cls()
+        view.setup(http_request, metric_id=metric_id)
+        view.request = view.initialize_request(http_request, metric_id=metric_id)
+        view.request.user = user
+        view.format_kwarg = None
+        return view.build_page()
 
     def post(self, request, metric_id: int):
-        user_id = request.user.id
         metric = get_object_or_404(
-            Metric,
+            Metric.objects.active(),
             id=metric_id,
             author=request.user,
         )
 
-        serializer = self.get_serializer(data=request.data)
+        query = OnConflictQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        serializer = self.get_serializer_class()(
+            data=request.data, context=self.get_tag_context([request.data])
+        )
         serializer.is_valid(raise_exception=True)
 
-        record = serializer.save(
-            metric=metric,
-            metric_name=metric.name,
+        if settings.METRIC_RECORDS_ASYNC_INGEST:
+            enqueue_metric_records(
+                metric.id,
+                [serializer.validated_data],
+                on_conflict=query.validated_data["on_conflict"],
+            )
+            return Response({"queued": 1}, status=status.HTTP_202_ACCEPTED)
+
+        [(result, record_id)] = write_metric_records(
+            metric,
+            [serializer.validated_data],
+            on_conflict=query.validated_data["on_conflict"],
         )
-        logger.debug(f"Сбрасываю кеш записей метрики ID {metric_id}.")
-        cache.delete(self.metric_records_cache_key(metric_id, user_id))
+        if result == CONFLICT:
+            raise ValidationError(
+                {"timestamp": "Запись на этот момент времени уже существует"}
+            )
+
+        if result == SKIPPED:
+            record = MetricRecord.objects.get(
+                metric=metric,
+                timestamp=serializer.validated_data["timestamp"],
+            )
+        else:
+            record = MetricRecord.objects.get(pk=record_id)
+            logger.debug(f"Сбрасываю кеш записей метрики ID {metric_id}.")
+            metrics_cache.invalidate_metric_cache(metric_id)
 
         return Response(
             self.get_serializer(record).data,
-            status=status.HTTP_201_CREATED,
+            status=status.HTTP_201_CREATED if result == CREATED else status.HTTP_200_OK,
+        )
+
+
+class MetricRecordAggregateAPIView(MetricRecordQSMixin, generics.GenericAPIView):
+    """
+    Агрегаты записей метрики по временным корзинам (avg/min/max/count/sum).
+    Без фильтра по тегам корзины собираются из MetricRollup.
+    """
+
+    serializer_class = MetricRecordAggregateSerializer
+    filter_backends = (TimeRangeFilterBackend, TagFilterBackend)
+    cache_query_params = ("bucket", "fn", "from", "to", "tags", "tags_all")
+
+    def get(self, request, metric_id: int):
+        user_id = request.user.id
+        generation = metrics_cache.metric_cache_generation(metric_id)
+        # Чужой метрике валидаторы не отдаются: по ним видно время её изменения
+        owner = self.is_metric_owner(metric_id, user_id)
+        if owner:
+            not_modified = self.get_validators(
+                metric_id, user_id, generation
+            ).not_modified(request)
+            if not_modified is not None:
+                return not_modified
+
+        parts = (
+            "aggregate",
+            *(request.query_params.getlist(param) for param in self.cache_query_params),
         )
+        generation, rendered = metrics_cache.get_or_build_metric_records_page(
+            metric_id, user_id, parts, build=self.build_buckets, generation=generation
+        )
+        response = rendered_json_response(request, rendered)
+        if owner:
+            self.get_validators(metric_id, user_id, generation).apply(response)
+        return response
+
+    def build_buckets(self) -> RenderedJSON:
+        """Корзины агрегатов для текущего запроса."""
+        request = self.request
+        metric_id = self.kwargs["metric_id"]
+        query = MetricRecordAggregateQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+
+        records = self.filter_queryset(self.get_queryset())
+        tag_filtered = params.get("tags") or params.get("tags_all")
+        if settings.METRIC_ROLLUPS_ENABLED and not tag_filtered:
+            buckets = aggregate_metric_rollups(
+                records,
+                MetricRollup.objects.filter(
+                    metric_id=metric_id,
+                    metric__author=request.user,
+                    metric__deleted_at__isnull=True,
+                ),
+                bucket=params["bucket"],
+                functions=params["fn"],
+                from_ts=params.get("from"),
+                to_ts=params.get("to"),
+                archived=self.get_archived_rows if archive_enabled() else None,
+            )
+        else:
+            buckets = aggregate_metric_records(
+                records,
+                bucket=params["bucket"],
+                functions=params["fn"],
+                archived=self.get_archived_rows(),
+            )
+        return render_json(self.get_serializer(buckets, many=True).data)
+
+
+class MetricRecordExportAPIView(MetricRecordQSMixin, generics.GenericAPIView):
+    """
+    Потоковая выгрузка записей метрики в CSV или NDJSON.
+    Формат выбирается через ?format=csv|ndjson или заголовок Accept.
+    """
+
+    renderer_classes = (CSVRenderer, NDJSONRenderer)
+    filter_backends = (TimeRangeFilterBackend, TagFilterBackend)
+
+    def get(self, request, metric_id: int):
+        get_object_or_404(Metric.objects.active(), id=metric_id, author=request.user)
+
+        records = self.filter_queryset(self.get_queryset())
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(
+                iter_export_rows(records, self.get_archived_rows()),
+                fields=EXPORT_FIELDS,
+            ),
+            content_type=f"{renderer.media_type}; charset={renderer.charset}",
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="metric_{metric_id}_records.{renderer.format}"'
+        )
+        return response
 
 
 class MetricRecordDetailAPIView(MetricRecordQSMixin, generics.RetrieveAPIView):
     lookup_url_kwarg = "record_id"
+
+
+class MetricRecordBatchCreateAPIView(MetricRecordQSMixin, generics.GenericAPIView):
+    """
+    Пакетное создание записей метрики.
+    Ошибки возвращаются по каждому элементу, валидные записи сохраняются.
+    """
+
+    def post(self, request, metric_id: int):
+        metric = get_object_or_404(
+            Metric.objects.active(),
+            id=metric_id,
+            author=request.user,
+        )
+
+        items = request.data
+        max_size = settings.METRIC_RECORDS_BATCH_MAX_SIZE
+        if not isinstance(items, list) or not items:
+            return Response(
+                {"non_field_errors": ["Ожидается непустой список записей."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(items) > max_size:
+            return Response(
+                {"non_field_errors": [f"Не больше {max_size} записей за запрос."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        query = OnConflictQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        context = self.get_tag_context(items)
+        valid, errors = [], []
+        for index, item in enumerate(items):
+            serializer = self.get_serializer_class()(data=item, context=context)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                errors.append({"index": index, "errors": serializer.errors})
+
+        if settings.METRIC_RECORDS_ASYNC_INGEST and valid:
+            enqueue_metric_records(
+                metric.id,
+                [data for _, data in valid],
+                on_conflict=query.validated_data["on_conflict"],
+            )
+            return Response(
+                {"queued": [{"index": index} for index, _ in valid], "errors": errors},
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        results = write_metric_records(
+            metric,
+            [data for _, data in valid],
+            on_conflict=query.validated_data["on_conflict"],
+        )
+        response_data = {"created": [], "updated": [], "skipped": [], "errors": errors}
+        for (index, _), (result, record_id) in zip(valid, results):
+            if result == CONFLICT:
+                errors.append(
+                    {
+                        "index": index,
+                        "errors": {
+                            "timestamp": [
+                                "Запись на этот момент времени уже существует"
+                            ]
+                        },
+                    }
+                )
+            elif result == SKIPPED:
+                response_data["skipped"].append({"index": index})
+            else:
+                response_data[result].append({"index": index, "id": record_id})
+
+        written = response_data["created"] or response_data["updated"]
+        if written:
+            logger.debug(f"Сбрасываю кеш записей метрики ID {metric_id}.")
+            metrics_cache.invalidate_metric_cache(metric_id)
+
+        errors.sort(key=lambda error: error["index"])
+        if response_data["created"]:
+            response_status = status.HTTP_201_CREATED
+        elif response_data["updated"] or response_data["skipped"]:
+            response_status = status.HTTP_200_OK
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(response_data, status=response_status)
+
+
+class IngestBufferStatusAPIView(APIView):
+    """Состояние буфера асинхронного приёма записей: глубина и отставание."""
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(buffer_status())
+
+
+class TaskQueueStatusAPIView(APIView):
+    """
+    Очереди Celery: глубина, возраст самой старой задачи и последний
+    успешный запуск задач расписания beat.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(queue_status())
@@ -2,6 +2,7 @@ import os
 
 from celery import Celery
 from celery.schedules import crontab
+from django.conf import settings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tatneft_metrics.settings")
 app = Celery("tatneft_metrics")
@@ -13,4 +14,28 @@ app.conf.beat_schedule = {
         "task": "metrics.tasks.generate_report",
         "schedule": 2 * 60,
     },
+    "flush-metric-records-buffer": {
+        "task": "metrics.tasks.flush_metric_records_buffer",
+        "schedule": settings.METRIC_RECORDS_INGEST_FLUSH_INTERVAL,
+    },
+    "repair-metric-rollups": {
+        "task": "metrics.tasks.repair_recent_metric_rollups",
+        "schedule": crontab(hour=3, minute=0),
+    },
+    "create-metric-record-partitions": {
+        "task": "metrics.tasks.create_metric_record_partitions",
+        "schedule": crontab(hour=2, minute=30),
+    },
+    "purge-expired-metric-records": {
+        "task": "metrics.tasks.purge_expired_metric_records",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "archive-old-metric-records": {
+        "task": "metrics.tasks.archive_old_metric_records",
+        "schedule": crontab(hour=4, minute=30),
+    },
+    "purge-deleted-metric-records": {
+        "task": "metrics.tasks.purge_deleted_metric_records",
+        "schedule": crontab(minute=15),
+    },
 }
@@ -36,6 +36,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "metrics.telemetry.TelemetryMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -112,11 +113,88 @@ REDIS_URL = os.getenv("REDIS_URL", "redis://:12345@127.0.0.1:6379")
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        # RedisCache со счётчиками попаданий и промахов для телеметрии
+        "BACKEND": "metrics.telemetry.InstrumentedRedisCache",
         "LOCATION": REDIS_URL,
     }
 }
 
+METRIC_RECORDS_PAGE_SIZE = int(os.getenv("METRIC_RECORDS_PAGE_SIZE", "1000"))
+METRIC_RECORDS_MAX_PAGE_SIZE = int(os.getenv("METRIC_RECORDS_MAX_PAGE_SIZE", "10000"))
+METRIC_RECORDS_BATCH_MAX_SIZE = int(os.getenv("METRIC_RECORDS_BATCH_MAX_SIZE", "1000"))
+# Пока страницу записей строит один воркер, остальные отдают предыдущую копию
+# или ждут METRIC_RECORDS_CACHE_LOCK_WAIT секунд
+METRIC_RECORDS_CACHE_LOCK_TIMEOUT = int(
+    os.getenv("METRIC_RECORDS_CACHE_LOCK_TIMEOUT", "30")
+)
+METRIC_RECORDS_CACHE_LOCK_WAIT = float(os.getenv("METRIC_RECORDS_CACHE_LOCK_WAIT", "2"))
+METRIC_RECORDS_CACHE_STALE_TIMEOUT = int(
+    os.getenv("METRIC_RECORDS_CACHE_STALE_TIMEOUT", "3600")
+)
+# stale-while-revalidate: при промахе отдаётся предыдущая копия, а новую строит Celery
+METRIC_RECORDS_CACHE_SWR = os.getenv("METRIC_RECORDS_CACHE_SWR", "False") == "True"
+# Локальный LRU-кеш процесса перед Redis для записей метрик и списка тегов.
+# Инвалидация рассылается через pub/sub Redis
+METRIC_LOCAL_CACHE_ENABLED = os.getenv("METRIC_LOCAL_CACHE_ENABLED", "True") == "True"
+METRIC_LOCAL_CACHE_MAX_ITEMS = int(os.getenv("METRIC_LOCAL_CACHE_MAX_ITEMS", "1000"))
+METRIC_LOCAL_CACHE_TTL = float(os.getenv("METRIC_LOCAL_CACHE_TTL", "30"))
+# Асинхронный приём записей: POST кладёт записи в буфер Redis и отвечает 202
+METRIC_RECORDS_ASYNC_INGEST = (
+    os.getenv("METRIC_RECORDS_ASYNC_INGEST", "False") == "True"
+)
+METRIC_RECORDS_INGEST_BATCH_SIZE = int(
+    os.getenv("METRIC_RECORDS_INGEST_BATCH_SIZE", "5000")
+)
+METRIC_RECORDS_INGEST_FLUSH_INTERVAL = float(
+    os.getenv("METRIC_RECORDS_INGEST_FLUSH_INTERVAL", "5")
+)
+METRIC_RECORDS_INGEST_FLUSH_SECONDS = int(
+    os.getenv("METRIC_RECORDS_INGEST_FLUSH_SECONDS", "60")
+)
+METRIC_ROLLUPS_ENABLED = os.getenv("METRIC_ROLLUPS_ENABLED", "True") == "True"
+METRIC_ROLLUPS_REPAIR_DAYS = int(os.getenv("METRIC_ROLLUPS_REPAIR_DAYS", "2"))
+# Секционирование MetricRecord по timestamp: включается до миграции 0005
+# или командой partition_metric_records, секции создаются заранее задачей Celery
+METRIC_RECORDS_PARTITIONING = (
+    os.getenv("METRIC_RECORDS_PARTITIONING", "False") == "True"
+)
+# day, week или month (по UTC)
+METRIC_RECORDS_PARTITION_INTERVAL = os.getenv(
+    "METRIC_RECORDS_PARTITION_INTERVAL", "month"
+)
+METRIC_RECORDS_PARTITIONS_AHEAD = int(os.getenv("METRIC_RECORDS_PARTITIONS_AHEAD", "3"))
+# Срок хранения записей, если у метрики он не задан (0 - хранить всегда).
+# Просроченные записи удаляет задача Celery пачками с паузами
+METRIC_RECORDS_RETENTION_DAYS = int(os.getenv("METRIC_RECORDS_RETENTION_DAYS", "0"))
+METRIC_RETENTION_BATCH_SIZE = int(os.getenv("METRIC_RETENTION_BATCH_SIZE", "5000"))
+METRIC_RETENTION_BATCH_PAUSE = float(os.getenv("METRIC_RETENTION_BATCH_PAUSE", "0.1"))
+METRIC_RETENTION_MAX_SECONDS = int(os.getenv("METRIC_RETENTION_MAX_SECONDS", "600"))
+# Архив: записи старше METRIC_ARCHIVE_AFTER_DAYS суток (0 - не архивировать)
+# упаковываются в сжатые чанки по окнам в METRIC_ARCHIVE_WINDOW секунд
+METRIC_ARCHIVE_AFTER_DAYS = int(os.getenv("METRIC_ARCHIVE_AFTER_DAYS", "0"))
+METRIC_ARCHIVE_WINDOW = int(os.getenv("METRIC_ARCHIVE_WINDOW", str(24 * 60 * 60)))
+# Телеметрия Prometheus (GET /metrics): значения процессов суммируются в Redis
+# и сбрасываются туда раз в METRIC_TELEMETRY_FLUSH_INTERVAL секунд.
+# Если задан METRIC_TELEMETRY_TOKEN, нужен заголовок Authorization: Bearer <токен>,
+# иначе /metrics доступен только персоналу
+METRIC_TELEMETRY_ENABLED = os.getenv("METRIC_TELEMETRY_ENABLED", "True") == "True"
+METRIC_TELEMETRY_FLUSH_INTERVAL = float(
+    os.getenv("METRIC_TELEMETRY_FLUSH_INTERVAL", "10")
+)
+METRIC_TELEMETRY_TOKEN = os.getenv("METRIC_TELEMETRY_TOKEN", "")
+# Запуск задачи расписания beat считается пропущенным, если опоздал больше чем
+# на METRIC_TASK_OVERDUE_GRACE секунд (GET /api/metrics/tasks/status/)
+METRIC_TASK_OVERDUE_GRACE = int(os.getenv("METRIC_TASK_OVERDUE_GRACE", "300"))
+# Журнал медленных запросов к БД (0 - выключен): запросы дольше порога в мс
+# попадают в кольцевой буфер Redis из METRIC_SLOW_QUERY_BUFFER_SIZE записей,
+# EXPLAIN (ANALYZE, BUFFERS) снимается не чаще раза в
+# METRIC_SLOW_QUERY_EXPLAIN_INTERVAL секунд (0 - не снимать)
+METRIC_SLOW_QUERY_THRESHOLD_MS = int(os.getenv("METRIC_SLOW_QUERY_THRESHOLD_MS", "0"))
+METRIC_SLOW_QUERY_BUFFER_SIZE = int(os.getenv("METRIC_SLOW_QUERY_BUFFER_SIZE", "200"))
+METRIC_SLOW_QUERY_EXPLAIN_INTERVAL = int(
+    os.getenv("METRIC_SLOW_QUERY_EXPLAIN_INTERVAL", "60")
+)
+
 CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = REDIS_URL
 